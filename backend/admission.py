@@ -0,0 +1,306 @@
+"""Controllo di ammissione: limite di frequenza delle scritture per client e numero massimo di import/export in corso"""
+from flask import current_app, jsonify, make_response, request
+from functools import wraps
+from threading import Condition, Lock, local
+import asyncio
+import math
+import os
+import sqlite3
+import time
+import uuid
+
+from tenants import current_tenant
+
+# Metodi soggetti al limite di frequenza (le letture restano libere)
+RATE_LIMITED_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# Nome del gruppo di posti condiviso da importazioni ed esportazioni
+HEAVY_SLOTS = 'import_export'
+
+# Ogni quanto un client in coda ricontrolla i posti liberati da altri processi (secondi)
+SLOT_POLL_INTERVAL = 0.1
+
+class MemoryStore:
+    """Secchi di token e posti occupati nella memoria del processo"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._buckets = {}
+        self._slots = {}
+        self._last_prune = time.monotonic()
+
+    def take_token(self, key, rate, burst):
+        """Preleva un token dal secchio del client; restituisce i secondi da attendere (0 se ammesso)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+
+            # I secchi tornati pieni equivalgono a quelli assenti: vengono rimossi per non crescere senza limite
+            if now - self._last_prune > burst / rate:
+                self._buckets = {k: v for k, v in self._buckets.items()
+                                 if v[0] + (now - v[1]) * rate < burst}
+                self._last_prune = now
+        return wait
+
+    def acquire_slot(self, name, limit, owner, lease):
+        """Occupa un posto del gruppo se ce n'è uno libero"""
+        with self._lock:
+            owners = self._slots.setdefault(name, set())
+            if len(owners) >= limit:
+                return False
+            owners.add(owner)
+            return True
+
+    def release_slot(self, name, owner):
+        """Libera il posto occupato"""
+        with self._lock:
+            self._slots.get(name, set()).discard(owner)
+
+    def slots_in_use(self, name):
+        """Numero di posti occupati del gruppo"""
+        with self._lock:
+            return len(self._slots.get(name, ()))
+
+    def clear_slots(self):
+        """Libera tutti i posti"""
+        with self._lock:
+            self._slots.clear()
+
+class SQLiteStore:
+    """Secchi di token e posti occupati in un file SQLite locale condiviso dai worker della stessa macchina"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS slots (owner TEXT PRIMARY KEY, name TEXT, expires REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_slots_name ON slots (name)')
+
+    def _connect(self):
+        # Una connessione per thread, in autocommit: le transazioni sono aperte esplicitamente
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return connection
+
+    def _transaction(self, work):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(connection)
+            connection.execute('COMMIT')
+            return result
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def take_token(self, key, rate, burst):
+        """Preleva un token dal secchio del client; restituisce i secondi da attendere (0 se ammesso)"""
+        def work(connection):
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            # I secchi fermi da più del tempo di riempimento sono di nuovo pieni
+            connection.execute('DELETE FROM buckets WHERE updated < ?', (now - burst / rate,))
+            return wait
+        return self._transaction(work)
+
+    def acquire_slot(self, name, limit, owner, lease):
+        """Occupa un posto del gruppo se ce n'è uno libero; il posto scade dopo lease secondi (worker terminati)"""
+        def work(connection):
+            now = time.time()
+            connection.execute('DELETE FROM slots WHERE expires < ?', (now,))
+            used = connection.execute('SELECT COUNT(*) FROM slots WHERE name = ?', (name,)).fetchone()[0]
+            if used >= limit:
+                return False
+            connection.execute('INSERT INTO slots (owner, name, expires) VALUES (?, ?, ?)', (owner, name, now + lease))
+            return True
+        return self._transaction(work)
+
+    def release_slot(self, name, owner):
+        """Libera il posto occupato"""
+        self._connect().execute('DELETE FROM slots WHERE owner = ?', (owner,))
+
+    def slots_in_use(self, name):
+        """Numero di posti occupati del gruppo"""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM slots WHERE name = ? AND expires >= ?', (name, time.time())).fetchone()[0]
+
+    def clear_slots(self):
+        """Libera tutti i posti (all'avvio: quelli rimasti appartengono a worker non più attivi)"""
+        self._connect().execute('DELETE FROM slots')
+
+class SlotQueue:
+    """Coda limitata dei client in attesa di un posto, svegliati quando un posto del processo si libera"""
+
+    def __init__(self):
+        self._condition = Condition()
+        self._waiting = {}
+
+    def acquire(self, store, name, limit, owner, lease, queue_size, timeout):
+        """Attende un posto libero fino a timeout secondi; False se la coda è piena o l'attesa scade"""
+        if store.acquire_slot(name, limit, owner, lease):
+            return True
+
+        with self._condition:
+            if self._waiting.get(name, 0) >= queue_size:
+                return False
+            self._waiting[name] = self._waiting.get(name, 0) + 1
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # I posti liberati da altri processi si vedono solo ricontrollando
+                with self._condition:
+                    self._condition.wait(min(SLOT_POLL_INTERVAL, remaining))
+                if store.acquire_slot(name, limit, owner, lease):
+                    return True
+        finally:
+            with self._condition:
+                self._waiting[name] -= 1
+
+    async def acquire_async(self, store, name, limit, owner, lease, queue_size, timeout):
+        """Come acquire, senza bloccare il ciclo di eventi della modalità ASGI (i posti vengono ricontrollati a intervalli)"""
+        if store.acquire_slot(name, limit, owner, lease):
+            return True
+
+        with self._condition:
+            if self._waiting.get(name, 0) >= queue_size:
+                return False
+            self._waiting[name] = self._waiting.get(name, 0) + 1
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                await asyncio.sleep(min(SLOT_POLL_INTERVAL, remaining))
+                if store.acquire_slot(name, limit, owner, lease):
+                    return True
+        finally:
+            with self._condition:
+                self._waiting[name] -= 1
+
+    def release(self, store, name, owner):
+        """Libera il posto e sveglia i client in coda"""
+        store.release_slot(name, owner)
+        with self._condition:
+            self._condition.notify_all()
+
+    def waiting(self, name):
+        """Numero di client in coda nel processo"""
+        with self._condition:
+            return self._waiting.get(name, 0)
+
+def init_admission(app):
+    """Configura i limiti e applica il limite di frequenza alle scritture"""
+    app.config.setdefault('RATE_LIMIT_PER_MINUTE', float(os.environ.get('RATE_LIMIT_PER_MINUTE', 60)))  # Scritture al minuto per client (0: nessun limite)
+    app.config.setdefault('RATE_LIMIT_BURST', int(os.environ.get('RATE_LIMIT_BURST', 20)))  # Scritture consecutive ammesse
+    app.config.setdefault('RATE_LIMIT_TRUST_PROXY', os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true')  # Client da X-Forwarded-For
+    app.config.setdefault('HEAVY_MAX_CONCURRENT', int(os.environ.get('HEAVY_MAX_CONCURRENT', 2)))  # Import/export contemporanei
+    app.config.setdefault('HEAVY_QUEUE_SIZE', int(os.environ.get('HEAVY_QUEUE_SIZE', 1)))  # Richieste in coda per processo
+    app.config.setdefault('HEAVY_QUEUE_TIMEOUT', float(os.environ.get('HEAVY_QUEUE_TIMEOUT', 10)))  # Attesa massima in coda (secondi)
+    app.config.setdefault('HEAVY_SLOT_LEASE', float(os.environ.get('HEAVY_SLOT_LEASE', 900)))  # Scadenza dei posti dei worker terminati
+
+    # Con ADMISSION_STORE (es. /dev/shm/crm_admission.db) i limiti valgono per tutti i worker della macchina
+    path = os.environ.get('ADMISSION_STORE')
+    app.extensions['admission'] = {
+        'store': SQLiteStore(path) if path else MemoryStore(),
+        'queue': SlotQueue()
+    }
+
+    @app.before_request
+    def rate_limit():
+        rate = app.config['RATE_LIMIT_PER_MINUTE'] / 60
+        # Per metodo e non per prefisso: anche le route senza /api/ (es. POST /clienti) sono scritture
+        if request.method not in RATE_LIMITED_METHODS or rate <= 0:
+            return None
+
+        store = app.extensions['admission']['store']
+        wait = store.take_token(f'{current_tenant()}:{client_address()}', rate, max(1, app.config['RATE_LIMIT_BURST']))
+        if wait:
+            return too_many_requests('Troppe richieste di modifica', wait)
+        return None
+
+def client_address():
+    """Indirizzo del client (il primo di X-Forwarded-For dietro un proxy fidato)"""
+    if current_app.config['RATE_LIMIT_TRUST_PROXY'] and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'sconosciuto'
+
+def too_many_requests(message, retry_after):
+    """Risposta 429 con il tempo di attesa suggerito in Retry-After"""
+    seconds = max(1, math.ceil(retry_after))
+    response = jsonify({
+        'success': False,
+        'error': f'{message}: riprova tra {seconds} secondi'
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+def limit_concurrency(view):
+    """Ammette la vista solo con un posto libero tra quelli di import/export, attendendo in coda per un tempo limitato"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        admission = current_app.extensions['admission']
+        store, queue = admission['store'], admission['queue']
+        owner = uuid.uuid4().hex
+        if not queue.acquire(store, HEAVY_SLOTS, config['HEAVY_MAX_CONCURRENT'], owner,
+                             config['HEAVY_SLOT_LEASE'], config['HEAVY_QUEUE_SIZE'], config['HEAVY_QUEUE_TIMEOUT']):
+            return too_many_requests('Troppe importazioni o esportazioni in corso', config['HEAVY_QUEUE_TIMEOUT'])
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            queue.release(store, HEAVY_SLOTS, owner)
+            raise
+
+        # Le risposte in streaming (ZIP, backup) tengono il posto finché non sono state inviate
+        if response.is_streamed:
+            response.call_on_close(lambda: queue.release(store, HEAVY_SLOTS, owner))
+        else:
+            queue.release(store, HEAVY_SLOTS, owner)
+        return response
+    return wrapper
+
+async def acquire_heavy_slot():
+    """Variante asincrona di limit_concurrency: restituisce il posto occupato, o None se la coda è piena o l'attesa scade"""
+    config = current_app.config
+    admission = current_app.extensions['admission']
+    owner = uuid.uuid4().hex
+    if await admission['queue'].acquire_async(admission['store'], HEAVY_SLOTS, config['HEAVY_MAX_CONCURRENT'], owner,
+                                              config['HEAVY_SLOT_LEASE'], config['HEAVY_QUEUE_SIZE'], config['HEAVY_QUEUE_TIMEOUT']):
+        return owner
+    return None
+
+def release_heavy_slot(app, owner):
+    """Libera il posto occupato con acquire_heavy_slot"""
+    admission = app.extensions['admission']
+    admission['queue'].release(admission['store'], HEAVY_SLOTS, owner)
+
+def admission_status():
+    """Posti di import/export occupati e client in coda nel processo"""
+    admission = current_app.extensions['admission']
+    return {
+        'importExport': admission['store'].slots_in_use(HEAVY_SLOTS),
+        'limite': current_app.config['HEAVY_MAX_CONCURRENT'],
+        'inCoda': admission['queue'].waiting(HEAVY_SLOTS)
+    }
@@ -1,43 +1,109 @@
-from flask import Flask, jsonify, send_from_directory, request
+from flask import Flask, Request, g, jsonify, request, current_app
 from flask_cors import CORS
+import click
+import importlib.util
 import os
 from dotenv import load_dotenv
 from datetime import datetime
+from tempfile import SpooledTemporaryFile
 
 # Importa moduli personalizzati
-from database import init_db, db
-from models import init_default_settings, Contatto
-from routes.contatti import contatti_bp
+from database import init_db, migrate_db, read_only, replica_status, db
+from tenants import DEFAULT_TENANT, init_tenants
+from admission import admission_status, init_admission
+from idempotency import idempotent, init_idempotency
+from instrumentation import init_instrumentation
+from metrics import init_metrics
+from compression import init_compression, send_static_asset
+from models import Contatto, ContattoEliminato
+from routes.contatti import (contatti_bp, apply_changes, archive_contatti, conflict_response, load_fields, parse_fields,
+                             restore_contatti, update_property)
 from routes.impostazioni import impostazioni_bp
+from routes.modifiche import modifiche_bp
+from routes.campagne import campagne_bp, rollover_campagna
+from routes.consegne import consegne_bp
+from routes.backup import backup_bp, iter_backup, load_backup
 
-# Tenta di importare il modulo excel, ma continua anche se fallisce
-try:
+# Verifica la disponibilità delle librerie Excel senza importarle (pandas è lento da caricare)
+has_excel_support = all(importlib.util.find_spec(module) is not None for module in ['pandas', 'openpyxl'])
+if has_excel_support:
     from routes.excel import excel_bp
-    has_excel_support = True
-except ImportError:
-    has_excel_support = False
-    # Crea un blueprint vuoto per evitare errori
-    from flask import Blueprint
-    excel_bp = Blueprint('excel', __name__)
-    print("AVVISO: Supporto Excel disabilitato a causa di errori di importazione")
+else:
+    print("AVVISO: Supporto Excel disabilitato: pandas o openpyxl non installati")
 
 # Carica variabili d'ambiente
 load_dotenv()
 
+class UploadFile(SpooledTemporaryFile):
+    """File temporaneo degli upload con readable()/seekable()/writable(), assenti prima di Python 3.11"""
+    
+    # pandas, zipfile e io.TextIOWrapper li richiedono; l'immagine Docker usa Python 3.9
+    def readable(self):
+        return self._file.readable()
+    
+    def seekable(self):
+        return self._file.seekable()
+    
+    def writable(self):
+        return self._file.writable()
+
+class UploadRequest(Request):
+    """Richiesta che mantiene in memoria gli upload fino a una soglia configurabile"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Oltre la soglia il contenuto viene riversato in un file temporaneo anonimo e univoco
+        max_size = current_app.config['UPLOAD_SPOOL_MAX_SIZE']
+        return UploadFile(max_size=max_size, mode='rb+')
+    
+    @property
+    def max_content_length(self):
+        # Il ripristino di un backup completo supera il limite degli upload ordinari
+        if self.endpoint == 'backup.restore_backup':
+            return current_app.config['BACKUP_MAX_CONTENT_LENGTH']
+        return super().max_content_length
+
 def create_app():
     """Factory per la creazione dell'app Flask"""
     app = Flask(__name__, static_folder='../frontend/build')
+    app.request_class = UploadRequest
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Max 16 MB per upload
+    app.config['UPLOAD_SPOOL_MAX_SIZE'] = int(os.environ.get('UPLOAD_SPOOL_MAX_SIZE', 8 * 1024 * 1024))  # Upload in memoria fino a 8 MB
+    app.config['IMPORT_WORKERS'] = int(os.environ.get('IMPORT_WORKERS', min(4, os.cpu_count() or 1)))  # Processi per l'import multiplo
+    app.config['CHANGES_LONG_POLL_TIMEOUT'] = float(os.environ.get('CHANGES_LONG_POLL_TIMEOUT', 25))  # Attesa massima del long-poll (secondi)
+    app.config['CHANGES_POLL_INTERVAL'] = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))  # Intervallo di controllo del database
+    app.config['BACKUP_MAX_CONTENT_LENGTH'] = int(os.environ.get('BACKUP_MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))  # Max 1 GB per il ripristino
     
     # Configura CORS
-    CORS(app)
+    CORS(app, expose_headers=['Retry-After', 'Idempotent-Replayed'])
+    
+    # Azienda di ogni richiesta (intestazione X-Tenant)
+    init_tenants(app)
+    
+    # Limite di frequenza delle scritture e coda per import/export
+    init_admission(app)
+    
+    # Risposte salvate delle scritture con Idempotency-Key
+    init_idempotency(app)
     
     # Inizializza database
     init_db(app)
     
+    # Misura tempi di richiesta, query SQL e serializzazione
+    init_instrumentation(app)
+    
+    # Metriche in formato Prometheus su /api/metrics
+    init_metrics(app)
+    
+    # Compressione gzip/brotli delle risposte API
+    init_compression(app)
+    
     # Registra le blueprints
     app.register_blueprint(contatti_bp)
     app.register_blueprint(impostazioni_bp)
+    app.register_blueprint(modifiche_bp)
+    app.register_blueprint(campagne_bp)
+    app.register_blueprint(consegne_bp)
+    app.register_blueprint(backup_bp)
     
     # Registra excel_bp solo se il supporto è disponibile
     if has_excel_support:
@@ -52,6 +118,13 @@ def create_app():
                 'data': []
             }), 503
         
+        @app.route('/api/import-excel-batch', methods=['POST'])
+        def import_excel_batch_fallback():
+            return jsonify({
+                'success': False,
+                'message': 'Funzionalità di importazione Excel non disponibile su questo server'
+            }), 503
+        
         @app.route('/api/export-gls', methods=['GET'])
         def export_gls_fallback():
             return jsonify({
@@ -64,9 +137,9 @@ def create_app():
     @app.route('/<path:path>')
     def serve(path):
         if path != "" and os.path.exists(app.static_folder + '/' + path):
-            return send_from_directory(app.static_folder, path)
+            return send_static_asset(app.static_folder, path)
         else:
-            return send_from_directory(app.static_folder, 'index.html')
+            return send_static_asset(app.static_folder, 'index.html')
     
     # Route per verificare lo stato dell'API
     @app.route('/api/status')
@@ -74,7 +147,9 @@ def create_app():
         return jsonify({
             'status': 'online',
             'version': '1.0.0',
-            'excel_support': has_excel_support
+            'excel_support': has_excel_support,
+            'replica': replica_status(),
+            'admission': admission_status()
         })
     
     # Versione senza prefisso /api
@@ -108,36 +183,26 @@ def create_app():
     
     # Clienti
     @app.route('/clienti')
+    @read_only
     def get_clienti_no_prefix():
         include_eliminati = request.args.get('include_eliminati', 'false').lower() == 'true'
         
         try:
-            # Query dal database direttamente
-            query = Contatto.query.filter_by(tipo='clienti')
-            
-            # Filtro per eliminati
-            if not include_eliminati:
-                query = query.filter_by(eliminato=False)
-                
-            clienti = query.all()
-            
-            # Converti oggetti a dizionario
-            clienti_dict = []
-            for c in clienti:
-                cliente_dict = {}
-                for column in c.__table__.columns:
-                    value = getattr(c, column.name)
-                    # Gestione di tipi di dati speciali
-                    if isinstance(value, datetime):
-                        cliente_dict[column.name] = value.isoformat()
-                    else:
-                        cliente_dict[column.name] = value
-                clienti_dict.append(cliente_dict)
+            # Solo le colonne richieste con ?fields= (gli eliminati sono nell'archivio)
+            fields = parse_fields(request.args.get('fields'))
+            clienti = load_fields(Contatto, fields, Contatto.tipo == 'clienti')
+            if include_eliminati:
+                clienti += load_fields(ContattoEliminato, fields, ContattoEliminato.tipo == 'clienti')
             
             return jsonify({
                 'success': True,
-                'data': clienti_dict
+                'data': clienti
             })
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
         except Exception as e:
             import traceback
             print(f"Errore durante il caricamento dei clienti: {str(e)}")
@@ -148,39 +213,18 @@ def create_app():
             }), 500
     
     @app.route('/clienti', methods=['POST'])
+    @idempotent
     def save_clienti_no_prefix():
         data = request.json
         
         try:
-            # Salva direttamente i nuovi clienti nel database
-            for item in data:
-                if 'id' in item and item['id']:
-                    # Cerca il cliente esistente
-                    cliente = Contatto.query.get(item['id'])
-                    if cliente:
-                        # Aggiorna i campi
-                        for key, value in item.items():
-                            if key != 'id' and hasattr(cliente, key):
-                                setattr(cliente, key, value)
-                        cliente.lastUpdate = datetime.utcnow()
-                    else:
-                        # Crea un nuovo cliente se non esiste
-                        new_cliente = Contatto(tipo='clienti')
-                        for key, value in item.items():
-                            if hasattr(new_cliente, key):
-                                setattr(new_cliente, key, value)
-                        new_cliente.createdAt = datetime.utcnow()
-                        new_cliente.lastUpdate = datetime.utcnow()
-                        db.session.add(new_cliente)
-                else:
-                    # Crea un nuovo cliente senza ID
-                    new_cliente = Contatto(tipo='clienti')
-                    for key, value in item.items():
-                        if hasattr(new_cliente, key):
-                            setattr(new_cliente, key, value)
-                    new_cliente.createdAt = datetime.utcnow()
-                    new_cliente.lastUpdate = datetime.utcnow()
-                    db.session.add(new_cliente)
+            # Aggiorna o crea i clienti con controllo di versione (senza eliminare quelli assenti)
+            conflicts = apply_changes(data, 'clienti')
+            
+            # In caso di conflitto non viene salvato niente
+            if conflicts:
+                db.session.rollback()
+                return conflict_response(conflicts)
             
             # Salva le modifiche
             db.session.commit()
@@ -217,36 +261,26 @@ def create_app():
     
     # Partner
     @app.route('/partner')
+    @read_only
     def get_partner_no_prefix():
         include_eliminati = request.args.get('include_eliminati', 'false').lower() == 'true'
         
         try:
-            # Query dal database direttamente
-            query = Contatto.query.filter_by(tipo='partner')
-            
-            # Filtro per eliminati
-            if not include_eliminati:
-                query = query.filter_by(eliminato=False)
-                
-            partners = query.all()
-            
-            # Converti oggetti a dizionario
-            partners_dict = []
-            for p in partners:
-                partner_dict = {}
-                for column in p.__table__.columns:
-                    value = getattr(p, column.name)
-                    # Gestione di tipi di dati speciali
-                    if isinstance(value, datetime):
-                        partner_dict[column.name] = value.isoformat()
-                    else:
-                        partner_dict[column.name] = value
-                partners_dict.append(partner_dict)
+            # Solo le colonne richieste con ?fields= (gli eliminati sono nell'archivio)
+            fields = parse_fields(request.args.get('fields'))
+            partners = load_fields(Contatto, fields, Contatto.tipo == 'partner')
+            if include_eliminati:
+                partners += load_fields(ContattoEliminato, fields, ContattoEliminato.tipo == 'partner')
             
             return jsonify({
                 'success': True,
-                'data': partners_dict
+                'data': partners
             })
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
         except Exception as e:
             import traceback
             print(f"Errore durante il caricamento dei partner: {str(e)}")
@@ -257,39 +291,18 @@ def create_app():
             }), 500
     
     @app.route('/partner', methods=['POST'])
+    @idempotent
     def save_partner_no_prefix():
         data = request.json
         
         try:
-            # Salva direttamente i nuovi partner nel database
-            for item in data:
-                if 'id' in item and item['id']:
-                    # Cerca il partner esistente
-                    partner = Contatto.query.get(item['id'])
-                    if partner:
-                        # Aggiorna i campi
-                        for key, value in item.items():
-                            if key != 'id' and hasattr(partner, key):
-                                setattr(partner, key, value)
-                        partner.lastUpdate = datetime.utcnow()
-                    else:
-                        # Crea un nuovo partner se non esiste
-                        new_partner = Contatto(tipo='partner')
-                        for key, value in item.items():
-                            if hasattr(new_partner, key):
-                                setattr(new_partner, key, value)
-                        new_partner.createdAt = datetime.utcnow()
-                        new_partner.lastUpdate = datetime.utcnow()
-                        db.session.add(new_partner)
-                else:
-                    # Crea un nuovo partner senza ID
-                    new_partner = Contatto(tipo='partner')
-                    for key, value in item.items():
-                        if hasattr(new_partner, key):
-                            setattr(new_partner, key, value)
-                    new_partner.createdAt = datetime.utcnow()
-                    new_partner.lastUpdate = datetime.utcnow()
-                    db.session.add(new_partner)
+            # Aggiorna o crea i partner con controllo di versione (senza eliminare quelli assenti)
+            conflicts = apply_changes(data, 'partner')
+            
+            # In caso di conflitto non viene salvato niente
+            if conflicts:
+                db.session.rollback()
+                return conflict_response(conflicts)
             
             # Salva le modifiche
             db.session.commit()
@@ -326,27 +339,20 @@ def create_app():
     
     # Eliminati
     @app.route('/eliminati')
+    @read_only
     def get_eliminati_no_prefix():
         try:
-            eliminati = Contatto.query.filter_by(eliminato=True).all()
-            
-            # Converti a dizionario
-            eliminati_dict = []
-            for e in eliminati:
-                item_dict = {}
-                for column in e.__table__.columns:
-                    value = getattr(e, column.name)
-                    # Gestione di tipi di dati speciali
-                    if isinstance(value, datetime):
-                        item_dict[column.name] = value.isoformat()
-                    else:
-                        item_dict[column.name] = value
-                eliminati_dict.append(item_dict)
+            eliminati = load_fields(ContattoEliminato, parse_fields(request.args.get('fields')))
             
             return jsonify({
                 'success': True,
-                'data': eliminati_dict
+                'data': eliminati
             })
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
         except Exception as e:
             import traceback
             print(f"Errore durante il caricamento degli eliminati: {str(e)}")
@@ -360,16 +366,12 @@ def create_app():
     @app.route('/move-to-eliminati/<string:tipo>/<int:id>', methods=['POST'])
     def move_to_eliminati_no_prefix(tipo, id):
         try:
-            contatto = Contatto.query.get(id)
-            if not contatto:
+            # Sposta il contatto nel cestino
+            if not archive_contatti([id]):
                 return jsonify({
                     'success': False,
                     'error': f'Contatto con ID {id} non trovato'
                 }), 404
-                
-            # Segna il contatto come eliminato
-            contatto.eliminato = True
-            contatto.eliminatoIl = datetime.utcnow()
             db.session.commit()
             
             return jsonify({'success': True})
@@ -387,16 +389,12 @@ def create_app():
     @app.route('/restore-from-eliminati/<int:id>', methods=['POST'])
     def restore_from_eliminati_no_prefix(id):
         try:
-            contatto = Contatto.query.get(id)
-            if not contatto:
+            # Ripristina il contatto (uno già attivo non ha nulla da ripristinare)
+            if not restore_contatti([id]) and not db.session.get(Contatto, id):
                 return jsonify({
                     'success': False,
                     'error': f'Contatto con ID {id} non trovato'
                 }), 404
-                
-            # Ripristina il contatto
-            contatto.eliminato = False
-            contatto.eliminatoIl = None
             db.session.commit()
             
             return jsonify({'success': True})
@@ -425,20 +423,8 @@ def create_app():
             }), 400
             
         try:
-            # Ottieni tutti i contatti corrispondenti
-            contatti = Contatto.query.filter(
-                Contatto.id.in_(ids),
-                Contatto.tipo == tipo
-            ).all()
-            
-            for contatto in contatti:
-                if hasattr(contatto, property_name):
-                    # Gestione speciale per grappa e gls (possono essere "1", 1, o True)
-                    if property_name in ['grappa', 'gls']:
-                        setattr(contatto, property_name, property_value in [True, 1, '1'])
-                    else:
-                        setattr(contatto, property_name, property_value)
-                    contatto.lastUpdate = datetime.utcnow()
+            # Un UPDATE per blocco di ID, senza caricare i contatti
+            update_property(ids, tipo, property_name, property_value)
             
             db.session.commit()
             
@@ -489,9 +475,62 @@ def create_app():
                 'message': 'Funzionalità di esportazione GLS non disponibile su questo server'
             }), 503
     
-    # Inizializza impostazioni predefinite
-    with app.app_context():
-        init_default_settings()
+    # Migrazione esplicita per deployment: flask --app app init-db
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Crea tabelle, colonne mancanti e impostazioni predefinite"""
+        migrate_db(force=True)
+    
+    def use_tenant(azienda):
+        """Imposta l'azienda su cui opera un comando"""
+        if azienda not in app.config['TENANTS']:
+            raise click.ClickException(f'Azienda sconosciuta: {azienda}')
+        g.tenant = azienda
+    
+    # Chiusura di fine stagione: flask --app app rollover-campagna [--anno 2025] [--reset] [--sovrascrivi] [--azienda nome]
+    @app.cli.command('rollover-campagna')
+    @click.option('--anno', type=int, default=None, help="Anno da storicizzare (predefinito: annoCorrente)")
+    @click.option('--reset', is_flag=True, help="Azzera i campi di campagna e passa all'anno successivo")
+    @click.option('--sovrascrivi', is_flag=True, help="Sostituisce uno storico già presente per l'anno")
+    @click.option('--azienda', default=DEFAULT_TENANT, help="Azienda di cui chiudere la campagna")
+    def rollover_campagna_command(anno, reset, sovrascrivi, azienda):
+        """Storicizza la campagna corrente nella tabella campagna"""
+        use_tenant(azienda)
+        try:
+            result = rollover_campagna(anno=anno, reset=reset, overwrite=sovrascrivi)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        db.session.commit()
+        print(f"Campagna {result['anno']} storicizzata: {result['contatti']} contatti")
+    
+    # Backup e ripristino da riga di comando, senza limiti di upload (senza --azienda: tutte le aziende):
+    # flask --app app backup dati.ndjson.gz / flask --app app restore dati.ndjson.gz
+    @app.cli.command('backup')
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--azienda', default=None, help="Salva solo i dati di questa azienda")
+    def backup_command(path, azienda):
+        """Salva contatti, impostazioni e storico campagne in NDJSON compresso"""
+        if azienda:
+            use_tenant(azienda)
+        with open(path, 'wb') as f:
+            for chunk in iter_backup(db.engine, tenant=azienda):
+                f.write(chunk)
+        print(f"Backup salvato in {path}")
+    
+    @app.cli.command('restore')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--azienda', default=None, help="Sostituisce solo i dati di questa azienda")
+    def restore_command(path, azienda):
+        """Sostituisce tutti i dati con quelli del backup indicato"""
+        if azienda:
+            use_tenant(azienda)
+        with open(path, 'rb') as f:
+            try:
+                counts = load_backup(f, tenant=azienda)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+        db.session.commit()
+        print(f"Backup ripristinato: {counts}")
     
     return app
 
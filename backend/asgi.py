@@ -0,0 +1,474 @@
+"""Modalità ASGI facoltativa: elenchi, statistiche, esportazioni e feed delle modifiche con accesso asincrono al database
+
+Le altre route restano quelle dell'app Flask, eseguite in un pool di thread limitato.
+Avvio (dalla cartella backend; richiede uvicorn e aiosqlite o asyncpg):
+    uvicorn --factory asgi:create_asgi_app --port 5000
+    SERVER_MODE=asgi gunicorn
+"""
+from flask import Response, current_app, g, jsonify, request, send_file
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+import asyncio
+import contextvars
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+from app import UploadFile, create_app
+from admission import acquire_heavy_slot, release_heavy_slot, too_many_requests
+from database import REPLICA_BIND, mark_replica_down, should_use_replica
+from metrics import EXPORT_BUILD_TIME
+from models import Contatto, ContattoEliminato, changes_condition
+from routes.backup import BackupEncoder, backup_options, backup_statements
+from routes.campagne import summarize_campagne
+from routes.contatti import load_fields, parse_fields
+from routes.excel import build_gls_workbook, load_gls_records
+from routes.modifiche import SSE_MAX_DURATION, latest_seq, load_changes, long_poll_timeout
+from tenants import current_tenant
+
+# Driver asincrono (modulo e nome per SQLAlchemy) di ogni database supportato
+ASYNC_DRIVERS = {
+    'sqlite': ('aiosqlite', 'sqlite+aiosqlite'),
+    'postgresql': ('asyncpg', 'postgresql+asyncpg')
+}
+
+def async_database_url(database_url):
+    """Converte l'URL del database in quello del driver asincrono corrispondente"""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'Modalità ASGI non disponibile per il database {backend}')
+    module, drivername = ASYNC_DRIVERS[backend]
+    if importlib.util.find_spec(module) is None:
+        raise RuntimeError(f'Modalità ASGI: installare {module} per accedere a {backend} in modo asincrono')
+
+    url = url.set(drivername=drivername)
+    # asyncpg indica il TLS con ssl= invece di sslmode=
+    if 'sslmode' in url.query:
+        url = url.update_query_dict({'ssl': url.query['sslmode']}).difference_update_query(['sslmode'])
+    return url
+
+def build_environ(scope, body):
+    """Ambiente WSGI equivalente alla richiesta ASGI, con il corpo già letto"""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'SERVER_NAME': scope['server'][0] if scope.get('server') else 'localhost',
+        'SERVER_PORT': str(scope['server'][1]) if scope.get('server') else '80',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # Il corpo è completo anche senza Content-Length (richieste chunked)
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def async_stream(body, **kwargs):
+    """Risposta Flask il cui corpo viene prodotto dal generatore asincrono body"""
+    # Un iteratore senza lunghezza: compressione e Content-Length la trattano come uno stream
+    response = Response(iter(()), **kwargs)
+    response.async_body = body
+    return response
+
+class AsyncApp:
+    """App ASGI: viste asincrone per letture ed esportazioni lente, le altre route all'app Flask in un pool di thread"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+        config.setdefault('ASGI_THREADS', int(os.environ.get('ASGI_THREADS', 8)))  # Thread per le route sincrone
+
+        self.executor = ThreadPoolExecutor(max_workers=config['ASGI_THREADS'], thread_name_prefix='wsgi')
+        self.engines = {None: create_async_engine(async_database_url(config['SQLALCHEMY_DATABASE_URI']))}
+        replica_url = config.get('SQLALCHEMY_BINDS', {}).get(REPLICA_BIND)
+        if replica_url:
+            self.engines[REPLICA_BIND] = create_async_engine(async_database_url(replica_url))
+            event.listen(self.engines[REPLICA_BIND].sync_engine, 'handle_error', replica_error)
+        self.sessions = {bind: async_sessionmaker(engine, expire_on_commit=False) for bind, engine in self.engines.items()}
+
+        # Endpoint Flask serviti dalle viste asincrone (solo GET)
+        self.views = {
+            'contatti.get_contatti': self.get_contatti,
+            'contatti.get_eliminati': self.get_eliminati,
+            'campagne.get_campagne': self.get_campagne,
+            'excel.export_gls': self.export_gls,
+            'backup.download_backup': self.download_backup,
+            'modifiche.get_changes': self.get_changes
+        }
+        self.changes_event = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        body = UploadFile(max_size=self.flask_app.config['UPLOAD_SPOOL_MAX_SIZE'], mode='rb+')
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+
+            environ = build_environ(scope, body)
+            view, view_args = self.match(environ)
+            if view is None:
+                await self.call_wsgi(environ, send)
+            else:
+                await self.call_view(view, view_args, environ, receive, send)
+        finally:
+            body.close()
+
+    async def lifespan(self, receive, send):
+        """Avvio e chiusura del server: all'arresto vengono chiuse le connessioni asincrone"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines.values():
+                    await engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def match(self, environ):
+        """Vista asincrona e argomenti della route richiesta (None: la gestisce l'app Flask)"""
+        adapter = self.flask_app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, view_args = adapter.match()
+        except HTTPException:
+            # 404, 405 e redirect restano a Flask
+            return None, None
+        return self.views.get(endpoint), view_args
+
+    async def call_wsgi(self, environ, send):
+        """Esegue la richiesta nell'app Flask in un thread del pool, inviando il corpo man mano che viene prodotto"""
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        iterable = await loop.run_in_executor(self.executor, self.flask_app, environ, start_response)
+        try:
+            iterator = iter(iterable)
+            chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send_start(send, started['status'], started['headers'])
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # Callback di chiusura della risposta (es. posti di import/export)
+            if hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, iterable.close)
+
+    async def call_view(self, view, view_args, environ, receive, send):
+        """Esegue una vista asincrona con gli stessi hook dell'app Flask (azienda, limiti, metriche, compressione)"""
+        app = self.flask_app
+        with app.request_context(environ):
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    try:
+                        rv = await view(**view_args)
+                    except OperationalError:
+                        if not g.get('replica_failed'):
+                            raise
+                        rv = None
+                    # La replica ha smesso di rispondere durante la lettura: la vista viene ripetuta una volta sul primario
+                    if g.get('replica_failed'):
+                        rv = await view(**view_args)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                response = app.handle_exception(e)
+
+            await send_start(send, response.status_code, response.get_wsgi_headers(environ).to_wsgi_list())
+            body = getattr(response, 'async_body', None)
+            if body is None:
+                for chunk in response.get_app_iter(environ):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                response.close()
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                # Il contesto della richiesta resta attivo per tutto lo stream (azienda delle query)
+                await stream_body(body, receive, send)
+
+    async def run_in_thread(self, function, *args):
+        """Esegue codice bloccante (CPU o librerie sincrone) fuori dal ciclo di eventi, con il contesto della richiesta"""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, function, *args)
+
+    async def read_session(self):
+        """Sessione asincrona sulla replica quando la richiesta può usarla, altrimenti sul primario"""
+        use_replica = REPLICA_BIND in self.engines and await self.run_in_thread(should_use_replica)
+        return self.sessions[REPLICA_BIND if use_replica else None]()
+
+    async def get_contatti(self, tipo):
+        """Versione asincrona di contatti.get_contatti"""
+        include_eliminati = request.args.get('include_eliminati', 'false').lower() == 'true'
+        try:
+            fields = parse_fields(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+
+        async with await self.read_session() as session:
+            data = await session.run_sync(lambda sync: load_fields(Contatto, fields, Contatto.tipo == tipo, session=sync))
+            if include_eliminati:
+                data += await session.run_sync(
+                    lambda sync: load_fields(ContattoEliminato, fields, ContattoEliminato.tipo == tipo, session=sync))
+        return jsonify({
+            'success': True,
+            'data': data
+        })
+
+    async def get_eliminati(self):
+        """Versione asincrona di contatti.get_eliminati"""
+        try:
+            fields = parse_fields(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+
+        async with await self.read_session() as session:
+            data = await session.run_sync(lambda sync: load_fields(ContattoEliminato, fields, session=sync))
+        return jsonify({
+            'success': True,
+            'data': data
+        })
+
+    async def get_campagne(self):
+        """Versione asincrona di campagne.get_campagne"""
+        try:
+            async with await self.read_session() as session:
+                data = await session.run_sync(summarize_campagne)
+            return jsonify({
+                'success': True,
+                'data': data
+            })
+        except Exception as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 500
+
+    async def export_gls(self):
+        """Versione asincrona di excel.export_gls: la lettura non occupa thread, il file viene creato nel pool"""
+        owner = await acquire_heavy_slot()
+        if owner is None:
+            return too_many_requests('Troppe importazioni o esportazioni in corso', current_app.config['HEAVY_QUEUE_TIMEOUT'])
+
+        start = time.perf_counter()
+        try:
+            async with await self.read_session() as session:
+                all_records = await session.run_sync(load_gls_records)
+            if not all_records:
+                return jsonify({
+                    'success': False,
+                    'message': 'Nessun record da esportare per GLS'
+                }), 404
+
+            output = await self.run_in_thread(build_gls_workbook, all_records)
+            EXPORT_BUILD_TIME.observe(time.perf_counter() - start, export='gls')
+            return send_file(
+                output,
+                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                as_attachment=True,
+                download_name='Spedizioni_GLS.xlsx'
+            )
+        except Exception as e:
+            return jsonify({
+                'success': False,
+                'message': f'Errore durante l\'esportazione: {str(e)}'
+            }), 500
+        finally:
+            release_heavy_slot(current_app, owner)
+
+    async def download_backup(self):
+        """Versione asincrona di backup.download_backup: il backup viene letto dal cursore senza occupare un thread"""
+        owner = await acquire_heavy_slot()
+        if owner is None:
+            return too_many_requests('Troppe importazioni o esportazioni in corso', current_app.config['HEAVY_QUEUE_TIMEOUT'])
+
+        tenant = current_tenant()
+        filename = f"crm_natale_{tenant}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz"
+        return async_stream(self.iter_backup(tenant, owner), mimetype='application/gzip',
+                            headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+    async def iter_backup(self, tenant, owner):
+        """Versione asincrona di backup.iter_backup; libera il posto di import/export alla fine"""
+        app = current_app._get_current_object()
+        engine = self.engines[None]
+        dialect = engine.dialect.name
+        encoder = BackupEncoder()
+        try:
+            async with engine.connect() as connection:
+                # Su SQLite la transazione va aperta prima di passare ai cursori in streaming
+                if dialect == 'sqlite':
+                    await connection.exec_driver_sql('BEGIN')
+                connection = await connection.execution_options(**backup_options(dialect))
+
+                encoder.header(dialect, tenant)
+                for table, statement in backup_statements(tenant):
+                    encoder.table(table)
+                    result = await connection.stream(statement)
+                    async for row in result:
+                        data = encoder.row(row)
+                        if data:
+                            yield data
+                await connection.rollback()
+            yield encoder.finish()
+        finally:
+            release_heavy_slot(app, owner)
+
+    async def get_changes(self):
+        """Versione asincrona di modifiche.get_changes: long-poll e SSE attendono senza occupare un thread"""
+        tipo = request.args.get('tipo')
+        since = request.args.get('since', request.headers.get('Last-Event-ID'))
+
+        if since is None:
+            async with self.sessions[None]() as session:
+                seq = await session.run_sync(latest_seq)
+            return jsonify({'success': True, 'seq': seq, 'changes': [], 'deleted': []})
+
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'Parametro since non valido'
+            }), 400
+
+        if request.args.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', ''):
+            return async_stream(self.stream_changes(since, tipo), mimetype='text/event-stream',
+                                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        timeout = long_poll_timeout()
+        if timeout is None:
+            return jsonify({
+                'success': False,
+                'error': 'Parametro timeout non valido'
+            }), 400
+        return jsonify({'success': True, **await self.wait_for_changes(since, tipo, timeout)})
+
+    async def wait_for_changes(self, since, tipo, timeout):
+        """Versione asincrona di modifiche.wait_for_changes"""
+        interval = current_app.config['CHANGES_POLL_INTERVAL']
+        deadline = time.monotonic() + timeout
+        while True:
+            # Una sessione per controllo: durante l'attesa non resta occupata nessuna connessione
+            async with self.sessions[None]() as session:
+                result = await session.run_sync(lambda sync: load_changes(since, tipo, session=sync))
+
+            remaining = deadline - time.monotonic()
+            if result['changes'] or result['deleted'] or result['reset'] or remaining <= 0:
+                return result
+            await self.changes_notified(min(interval, remaining))
+
+    async def stream_changes(self, since, tipo):
+        """Versione asincrona di modifiche.stream_changes"""
+        timeout = current_app.config['CHANGES_LONG_POLL_TIMEOUT']
+        deadline = time.monotonic() + SSE_MAX_DURATION
+
+        yield b'retry: 2000\n\n'
+        while time.monotonic() < deadline:
+            result = await self.wait_for_changes(since, tipo, min(timeout, deadline - time.monotonic()))
+            if result['changes'] or result['deleted'] or result['reset']:
+                since = result['seq']
+                yield f"id: {since}\ndata: {json.dumps(result)}\n\n".encode('utf-8')
+            else:
+                yield b': keep-alive\n\n'
+
+    async def changes_notified(self, timeout):
+        """Attende fino a timeout secondi un salvataggio di modifiche in un thread del processo"""
+        if self.changes_event is None:
+            self.changes_event = asyncio.Event()
+            threading.Thread(target=self.watch_changes, args=(asyncio.get_running_loop(),), daemon=True).start()
+        try:
+            await asyncio.wait_for(self.changes_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def watch_changes(self, loop):
+        """Thread che inoltra al ciclo di eventi le notifiche dei salvataggi (un solo thread per processo)"""
+        while True:
+            with changes_condition:
+                changes_condition.wait()
+            loop.call_soon_threadsafe(self.wake_changes)
+
+    def wake_changes(self):
+        """Risveglia le attese in corso; le successive aspettano la prossima notifica"""
+        self.changes_event.set()
+        self.changes_event = asyncio.Event()
+
+def replica_error(context):
+    """Replica irraggiungibile anche dal driver asincrono: le letture tornano al primario"""
+    if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+        mark_replica_down(str(context.original_exception))
+
+async def send_start(send, status, headers):
+    """Invia stato e intestazioni della risposta"""
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    })
+
+async def stream_body(body, receive, send):
+    """Invia il corpo prodotto dal generatore asincrono; si interrompe se il client si disconnette"""
+    async def produce():
+        async for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(produce()), asyncio.ensure_future(disconnected())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await body.aclose()
+
+def create_asgi_app():
+    """Factory dell'app ASGI (uvicorn --factory asgi:create_asgi_app)"""
+    return AsyncApp(create_app())
@@ -0,0 +1 @@
+"""Benchmark del backend CRM Natale (eseguire dalla cartella backend con python -m benchmarks.<nome>)"""
@@ -0,0 +1,218 @@
+"""Confronta gunicorn sincrono e la modalità ASGI con molte connessioni aperte sul feed delle modifiche
+
+Una parte delle connessioni resta in long-poll su /api/changes, le altre chiedono elenchi,
+riepilogo campagne e di tanto in tanto l'esportazione GLS. Un client scrive ogni pochi secondi
+per risvegliare i long-poll.
+
+Esempi (dalla cartella backend; la modalità asgi richiede uvicorn e aiosqlite):
+    python -m benchmarks.bench_asgi --connections 200 --duration 30
+    python -m benchmarks.bench_asgi --modes asgi --holders 150 --size 5000
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.load import percentile
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Percorsi richiesti dai lettori, con il peso relativo
+READ_MIX = [('elenco', '/api/clienti?fields=table', 60), ('campagne', '/api/campagne', 35),
+            ('export', '/api/export-gls', 5)]
+
+# Attesa massima di una singola richiesta lato client
+REQUEST_TIMEOUT = 60
+
+
+class Stats:
+    """Latenze ed esiti raccolti dai thread client"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self.rejected = defaultdict(int)
+
+    def record(self, name, started, status=None, timeout=False):
+        with self.lock:
+            if timeout:
+                self.timeouts[name] += 1
+            elif status == 429:
+                self.rejected[name] += 1
+            elif status != 200:
+                self.errors[name] += 1
+            else:
+                self.latencies[name].append(time.perf_counter() - started)
+
+
+def fetch(base_url, path, stats, name, data=None):
+    """Esegue una richiesta e registra la durata; restituisce il corpo JSON se presente"""
+    headers = {'Content-Type': 'application/json'} if data is not None else {}
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(base_url + path, data=data, headers=headers),
+                                    timeout=REQUEST_TIMEOUT) as response:
+            body = response.read()
+            stats.record(name, started, response.status)
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                return json.loads(body)
+    except urllib.error.HTTPError as e:
+        stats.record(name, started, e.code)
+    except (socket.timeout, TimeoutError):
+        stats.record(name, started, timeout=True)
+    except (urllib.error.URLError, ConnectionError):
+        stats.record(name, started)
+    return None
+
+
+def holder(base_url, stats, deadline, poll_timeout):
+    """Connessione che resta in long-poll sul feed delle modifiche"""
+    seq = (fetch(base_url, '/api/changes', stats, 'seq') or {}).get('seq', 0)
+    while time.time() < deadline:
+        result = fetch(base_url, f'/api/changes?since={seq}&timeout={poll_timeout}', stats, 'long-poll')
+        if result:
+            seq = result.get('seq', seq)
+        else:
+            time.sleep(0.5)
+
+
+def reader(base_url, stats, deadline, index):
+    """Connessione che alterna elenchi, campagne ed esportazioni secondo READ_MIX"""
+    schedule = [(name, path) for name, path, weight in READ_MIX for _ in range(weight)]
+    step = index * 7
+    while time.time() < deadline:
+        name, path = schedule[step % len(schedule)]
+        fetch(base_url, path, stats, name)
+        step += 13
+
+
+def writer(base_url, stats, deadline, interval):
+    """Crea un contatto ogni interval secondi per risvegliare i long-poll"""
+    number = 0
+    while time.time() < deadline:
+        number += 1
+        payload = json.dumps([{'nome': f'Bench {number}', 'tipo': 'clienti'}]).encode('utf-8')
+        fetch(base_url, '/api/clienti', stats, 'scrittura', data=payload)
+        time.sleep(interval)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, database_url, port, args):
+    """Avvia gunicorn con gunicorn.conf.py nella modalità indicata e attende /api/status"""
+    env = dict(os.environ, DATABASE_URL=database_url, INSTRUMENTATION_ENABLED='false', PORT=str(port),
+               SERVER_MODE=mode, WEB_CONCURRENCY=str(args.workers), GUNICORN_THREADS=str(args.threads),
+               CHANGES_LONG_POLL_TIMEOUT=str(args.poll_timeout))
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--timeout', str(REQUEST_TIMEOUT * 2)],
+                               cwd=BACKEND_FOLDER, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/api/status', timeout=2).read()
+            return process
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            if process.poll() is not None:
+                raise RuntimeError(f'gunicorn ({mode}) terminato con codice {process.returncode}')
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f'gunicorn ({mode}) non risponde')
+
+
+def run_mode(mode, database_url, args):
+    """Esegue la prova su un server appena avviato e restituisce le statistiche"""
+    port = free_port()
+    process = start_server(mode, database_url, port, args)
+    base_url = f'http://127.0.0.1:{port}'
+    stats = Stats()
+    start = time.time()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=holder, args=(base_url, stats, deadline, args.poll_timeout))
+               for _ in range(args.holders)]
+    threads += [threading.Thread(target=reader, args=(base_url, stats, deadline, i))
+                for i in range(args.connections - args.holders)]
+    threads.append(threading.Thread(target=writer, args=(base_url, stats, deadline, args.write_interval)))
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        # SIGINT: arresto immediato senza attendere le richieste ancora in coda
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return stats, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='wsgi,asgi', help='modalità da confrontare (wsgi, asgi)')
+    parser.add_argument('--connections', type=int, default=200, help='connessioni simultanee in totale')
+    parser.add_argument('--holders', type=int, default=150, help='connessioni in long-poll sul feed')
+    parser.add_argument('--duration', type=float, default=30, help='durata di ogni prova in secondi')
+    parser.add_argument('--poll-timeout', type=float, default=10, help='attesa massima di un long-poll')
+    parser.add_argument('--write-interval', type=float, default=2, help='secondi tra le scritture')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='thread per worker in modalità wsgi')
+    parser.add_argument('--size', type=int, default=2000, help='contatti nel database')
+    parser.add_argument('--output', help='salva il riepilogo in JSON')
+    args = parser.parse_args()
+    if args.holders > args.connections:
+        parser.error('--holders non può superare --connections')
+
+    temp_dir = tempfile.TemporaryDirectory()
+    database_url = f'sqlite:///{os.path.join(temp_dir.name, "bench.db")}'
+    from benchmarks.run import create_bench_app, load_dataset
+    load_dataset(create_bench_app(database_url), args.size)
+
+    summary = {'connections': args.connections, 'holders': args.holders, 'modes': {}}
+    for mode in args.modes.split(','):
+        stats, elapsed = run_mode(mode, database_url, args)
+        print(f'\n{mode}: {args.connections} connessioni ({args.holders} in long-poll), {elapsed:.0f} s')
+        print(f'{"endpoint":>10} {"risposte":>8} {"req/s":>7} {"p50 ms":>9} {"p95 ms":>9} '
+              f'{"errori":>7} {"timeout":>7} {"429":>5}')
+        endpoints = {}
+        for name in sorted(set(stats.latencies) | set(stats.errors) | set(stats.timeouts) | set(stats.rejected)):
+            latencies = stats.latencies[name]
+            entry = {
+                'responses': len(latencies),
+                'throughput_rps': round(len(latencies) / elapsed, 2),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+                'errors': stats.errors[name],
+                'timeouts': stats.timeouts[name],
+                'rejected': stats.rejected[name]
+            }
+            endpoints[name] = entry
+            print(f'{name:>10} {entry["responses"]:>8} {entry["throughput_rps"]:>7} {str(entry["p50_ms"]):>9} '
+                  f'{str(entry["p95_ms"]):>9} {entry["errors"]:>7} {entry["timeouts"]:>7} {entry["rejected"]:>5}')
+        summary['modes'][mode] = endpoints
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Confronta la velocità di lettura e normalizzazione degli import XLSX, CSV e NDJSON sugli stessi dati"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from routes.excel import detect_import_format, read_import_records
+from benchmarks.bench_upload import sample_rows
+
+
+def build_files(rows):
+    """Serializza le stesse righe nei tre formati supportati"""
+    data = sample_rows(rows)
+
+    xlsx = io.BytesIO()
+    pd.DataFrame(data).to_excel(xlsx, sheet_name='Clienti', index=False)
+
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=list(data[0].keys()), delimiter=';')
+    writer.writeheader()
+    writer.writerows(data)
+
+    ndjson = '\n'.join(json.dumps(row, ensure_ascii=False) for row in data)
+
+    return {
+        'clienti.xlsx': xlsx.getvalue(),
+        'clienti.csv': text.getvalue().encode('utf-8'),
+        'clienti.ndjson': ndjson.encode('utf-8')
+    }
+
+
+def measure(filename, content, repeat):
+    """Restituisce il tempo medio di lettura e il numero di righe normalizzate"""
+    count = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        stream = io.BytesIO(content)
+        import_format = detect_import_format(stream, filename)
+        count = sum(1 for _ in read_import_records(stream, 'clienti', import_format))
+    return (time.perf_counter() - start) / repeat, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    files = build_files(args.rows)
+    baseline = None
+    for filename, content in files.items():
+        seconds, count = measure(filename, content, args.repeat)
+        baseline = baseline or seconds
+        print(f'{filename:>16}: {len(content) / 1024:8.0f} KB, {seconds * 1000:8.1f} ms, '
+              f'{count / seconds:10.0f} righe/s, {baseline / seconds:5.1f}x rispetto a XLSX')
+
+
+if __name__ == '__main__':
+    main()
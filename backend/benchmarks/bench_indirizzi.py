@@ -0,0 +1,60 @@
+"""Misura la validazione in blocco di CAP, località e provincia con l'indice dei comuni"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indirizzi import correct_addresses, get_index, normalize_address
+from benchmarks.synthetic import generate_contatti
+
+
+def dirty_addresses(count, seed=42):
+    """Contatti con gli errori tipici dei fogli compilati a mano (CAP numerici, province errate, maiuscole)"""
+    rng = random.Random(f'{seed}-indirizzi')
+    rows = []
+    for contatto in generate_contatti(count, seed=seed):
+        row = {field: contatto[field] for field in ['nome', 'azienda', 'cap', 'localita', 'provincia', 'gls']}
+        error = rng.random()
+        if error < 0.1:
+            row['cap'] = str(int(row['cap']))
+        elif error < 0.2:
+            row['provincia'] = rng.choice(['UD', 'PN', 'XX', ''])
+        elif error < 0.3:
+            row['localita'] = row['localita'].upper()
+        elif error < 0.35:
+            row['cap'] = None
+        # Frazioni con nomi sempre diversi per misurare anche le ricerche non in cache
+        elif error < 0.5:
+            row['localita'] = f"{row['localita']} frazione {rng.randint(1, 10 ** 6)}"
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=50000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    get_index()
+    print(f'caricamento indice: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    rows = dirty_addresses(args.rows)
+    for label in ['cache vuota', 'cache calda']:
+        if label == 'cache vuota':
+            normalize_address.cache_clear()
+        report = {}
+        batch = [dict(row) for row in rows]
+        start = time.perf_counter()
+        for _ in correct_addresses(batch, report):
+            pass
+        seconds = time.perf_counter() - start
+        print(f'{label:>12}: {len(rows)} righe in {seconds * 1000:7.1f} ms ({len(rows) / seconds:9.0f} righe/s), '
+              f'{report["corretti"]} corretti, {len(report["da_verificare"])} da verificare')
+
+
+if __name__ == '__main__':
+    main()
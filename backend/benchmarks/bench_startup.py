@@ -0,0 +1,59 @@
+"""Misura tempo di avvio e memoria di un worker con import pigro o anticipato delle librerie Excel"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Eseguito in un processo nuovo per ogni misura: con eager=True simula il vecchio avvio
+WORKER_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+if {eager}:
+    import pandas, numpy, openpyxl
+from app import create_app
+app = create_app()
+ready = time.perf_counter() - start
+with app.test_client() as client:
+    client.get('/api/status')
+first_request = time.perf_counter() - start
+print(json.dumps({{
+    'startup_s': ready,
+    'first_request_s': first_request,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'pandas_loaded': 'pandas' in sys.modules
+}}))
+"""
+
+
+def run_worker(eager, database_url):
+    """Avvia un processo Python che crea l'app e restituisce le misure"""
+    env = dict(os.environ, DATABASE_URL=database_url, INSTRUMENTATION_ENABLED='false')
+    output = subprocess.check_output([sys.executable, '-c', WORKER_SCRIPT.format(eager=eager)],
+                                     cwd=BACKEND_FOLDER, env=env, text=True, stderr=subprocess.DEVNULL)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        database_url = f'sqlite:///{os.path.join(folder, "startup.db")}'
+        run_worker(False, database_url)  # crea lo schema e riscalda la cache dei file
+
+        for label, eager in [('anticipato', True), ('pigro', False)]:
+            runs = [run_worker(eager, database_url) for _ in range(args.repeat)]
+            print(f'{label:>10}: avvio {statistics.median(r["startup_s"] for r in runs) * 1000:7.0f} ms, '
+                  f'prima risposta {statistics.median(r["first_request_s"] for r in runs) * 1000:7.0f} ms, '
+                  f'RSS {statistics.median(r["max_rss_mb"] for r in runs):6.1f} MB, '
+                  f'pandas caricato: {"sì" if runs[0]["pandas_loaded"] else "no"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Confronta la lettura degli upload Excel via disco con la lettura diretta dallo stream"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from routes.excel import detect_excel_engine, read_excel_stream, determine_sheet_name
+from benchmarks.synthetic import messy_rows
+
+
+def io_counters():
+    """Restituisce i byte letti e scritti dal processo (solo Linux, altrimenti zero)"""
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError):
+        return 0, 0
+
+
+def sample_rows(rows):
+    """Genera righe di esempio con intestazioni come quelle dei fogli reali"""
+    return messy_rows(rows)
+
+
+def build_workbook(rows):
+    """Crea in memoria una cartella Excel con un foglio Clienti di esempio"""
+    output = io.BytesIO()
+    pd.DataFrame(sample_rows(rows)).to_excel(output, sheet_name='Clienti', index=False)
+    return output.getvalue()
+
+
+def read_via_disk(content, folder):
+    """Percorso precedente: salva il file, apre la cartella e la rilegge per il foglio"""
+    file_path = os.path.join(folder, 'upload.xlsx')
+    with open(file_path, 'wb') as f:
+        f.write(content)
+    xls = pd.ExcelFile(file_path)
+    sheet_name = determine_sheet_name(xls.sheet_names, 'clienti')
+    df = pd.read_excel(file_path, sheet_name=sheet_name)
+    os.remove(file_path)
+    return df
+
+
+def read_via_stream(content, folder):
+    """Percorso attuale: legge il foglio direttamente dallo stream in memoria"""
+    stream = io.BytesIO(content)
+    return read_excel_stream(stream, 'clienti', detect_excel_engine(stream))
+
+
+def measure(func, content, repeat):
+    """Esegue la funzione più volte e restituisce tempo medio e I/O medio per upload"""
+    with tempfile.TemporaryDirectory() as folder:
+        func(content, folder)  # riscaldamento
+        read_start, write_start = io_counters()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(content, folder)
+        elapsed = time.perf_counter() - start
+        read_end, write_end = io_counters()
+    return {
+        'seconds': elapsed / repeat,
+        'read_bytes': (read_end - read_start) / repeat,
+        'written_bytes': (write_end - write_start) / repeat
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    content = build_workbook(args.rows)
+    print(f'Cartella di prova: {args.rows} righe, {len(content) / 1024:.0f} KB')
+
+    results = {
+        'disco': measure(read_via_disk, content, args.repeat),
+        'stream': measure(read_via_stream, content, args.repeat)
+    }
+    for name, result in results.items():
+        print(f"{name:>8}: {result['seconds'] * 1000:8.1f} ms/upload, "
+              f"letti {result['read_bytes'] / 1024:8.0f} KB, scritti {result['written_bytes'] / 1024:8.0f} KB")
+
+    saved = results['disco']['seconds'] - results['stream']['seconds']
+    print(f'Risparmio per upload: {saved * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
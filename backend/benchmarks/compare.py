@@ -0,0 +1,39 @@
+"""Confronta due file di risultati di benchmarks.run e segnala le regressioni"""
+import argparse
+import json
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('baseline', help='risultati di riferimento (JSON)')
+    parser.add_argument('current', help='risultati da confrontare (JSON)')
+    parser.add_argument('--threshold', type=float, default=0.10, help='peggioramento tollerato (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    print(f'{baseline.get("commit")} -> {current.get("commit")} '
+          f'({current.get("database")}, {current.get("size")} contatti)')
+
+    regressions = 0
+    for name, result in current['scenarios'].items():
+        previous = baseline['scenarios'].get(name)
+        if not previous:
+            print(f'{name:>12}: {result["median_ms"]:10.1f} ms (nuovo scenario)')
+            continue
+
+        ratio = result['median_ms'] / previous['median_ms'] if previous['median_ms'] else 1
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  REGRESSIONE'
+            regressions += 1
+        print(f'{name:>12}: {previous["median_ms"]:10.1f} ms -> {result["median_ms"]:10.1f} ms ({ratio:5.2f}x){flag}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,234 @@
+"""Prova di carico: simula più operatori che lavorano insieme su un server avviato in locale
+
+Ogni utente virtuale esegue in ciclo operazioni scelte a caso secondo i pesi del mix
+(elenco, salvataggio dell'elenco completo, aggiornamento multiplo, importazione,
+esportazione GLS, impostazioni) e alla fine vengono riportati latenze p50/p95/p99,
+throughput ed errori per endpoint, contando a parte gli errori di lock del database
+e i conflitti di versione (409).
+
+Esempio (dalla cartella backend, con il server avviato su localhost:5000):
+    python -m benchmarks.load --users 8 --duration 60 --mix list=60,save=15,bulk=10,import=5,export=5,settings=5
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import messy_workbook
+
+DEFAULT_MIX = 'list=60,save=15,bulk=10,import=5,export=5,settings=5'
+
+# Nome dell'operazione nel mix -> metodo dell'utente virtuale
+OPERATIONS = {
+    'list': 'list',
+    'save': 'save',
+    'bulk': 'bulk',
+    'import': 'import_excel',
+    'export': 'export',
+    'settings': 'settings'
+}
+
+# Frammenti dei messaggi d'errore che indicano attese o conflitti sui lock del database
+LOCK_ERRORS = ['database is locked', 'deadlock', 'could not obtain lock', 'lock timeout', 'could not serialize']
+
+
+class Stats:
+    """Raccoglie latenze ed errori per endpoint da più thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock_errors = defaultdict(int)
+        self.conflicts = defaultdict(int)
+
+    def record(self, name, elapsed, status, body):
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            if status == 409:
+                # Conflitto di versione: previsto con più operatori, non è un errore del server
+                self.conflicts[name] += 1
+            elif status >= 400 or status == 0:
+                self.errors[name] += 1
+                if any(fragment in body.lower() for fragment in LOCK_ERRORS):
+                    self.lock_errors[name] += 1
+
+
+class VirtualUser(threading.Thread):
+    """Operatore simulato che esegue operazioni finché non scade il tempo"""
+
+    def __init__(self, base_url, mix, stats, deadline, think_time, workbook, tipo, seed):
+        super().__init__(daemon=True)
+        self.base_url = base_url.rstrip('/')
+        self.mix = mix
+        self.stats = stats
+        self.deadline = deadline
+        self.think_time = think_time
+        self.workbook = workbook
+        self.tipo = tipo
+        self.rng = random.Random(seed)
+        self.contatti = None
+
+    def request(self, name, method, path, body=None, headers=None):
+        """Esegue una richiesta HTTP e ne registra l'esito; restituisce il JSON se presente"""
+        request = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        start = time.perf_counter()
+        status, payload = 0, b''
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                status, payload = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        except (urllib.error.URLError, OSError) as e:
+            payload = str(e).encode()
+        elapsed = time.perf_counter() - start
+
+        text = payload.decode('utf-8', errors='replace')
+        self.stats.record(name, elapsed, status, text)
+        if status in (200, 409) and payload[:1] == b'{':
+            return json.loads(text)
+        return None
+
+    def send_json(self, name, path, data):
+        return self.request(name, 'POST', path, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+
+    def ensure_list(self):
+        if self.contatti is None:
+            self.list()
+        return self.contatti or []
+
+    def list(self):
+        result = self.request('list', 'GET', f'/api/{self.tipo}')
+        if result:
+            self.contatti = result['data']
+
+    def save(self):
+        # Come il frontend: modifica un contatto e rinvia l'elenco completo (anche se ormai vecchio)
+        data = [dict(row) for row in self.ensure_list()]
+        if data:
+            self.rng.choice(data)['note'] = f'Modifica {uuid.uuid4().hex[:8]}'
+        result = self.send_json('save', f'/api/{self.tipo}', data)
+        if result and result.get('success'):
+            self.contatti = result['data']
+        elif result and result.get('conflicts'):
+            # Unisci le versioni aggiornate dei soli contatti in conflitto, senza ricaricare l'elenco
+            updated = {row['id']: row for row in result['conflicts']}
+            self.contatti = [updated.get(row['id'], row) for row in self.contatti]
+
+    def bulk(self):
+        contatti = self.ensure_list()
+        ids = [row['id'] for row in self.rng.sample(contatti, min(len(contatti), 50))]
+        if ids:
+            self.send_json('bulk', f'/api/update-bulk/{self.tipo}',
+                           {'ids': ids, 'propertyName': 'grappa', 'propertyValue': self.rng.random() < 0.5})
+
+    def import_excel(self):
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{self.tipo}.xlsx"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(self.workbook)
+        body.write(f'\r\n--{boundary}--\r\n'.encode())
+        self.request('import', 'POST', f'/api/import-excel/{self.tipo}', body.getvalue(),
+                     {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+    def export(self):
+        self.request('export', 'GET', '/api/export-gls')
+
+    def settings(self):
+        self.request('settings', 'GET', '/api/settings')
+
+    def run(self):
+        names = list(self.mix.keys())
+        weights = list(self.mix.values())
+        while time.time() < self.deadline:
+            name = self.rng.choices(names, weights)[0]
+            getattr(self, OPERATIONS[name])()
+            if self.think_time:
+                time.sleep(self.rng.uniform(0, self.think_time * 2))
+
+
+def parse_mix(value):
+    """Converte 'list=60,save=15' in un dizionario di pesi"""
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(OPERATIONS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f'operazioni sconosciute: {", ".join(sorted(unknown))}')
+    return mix
+
+
+def percentile(values, fraction):
+    """Percentile con il metodo nearest-rank"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=5, help='operatori simultanei')
+    parser.add_argument('--duration', type=float, default=30, help='durata della prova in secondi')
+    parser.add_argument('--ramp', type=float, default=2, help='secondi per avviare tutti gli utenti')
+    parser.add_argument('--think-time', type=float, default=0.5, help='pausa media tra operazioni (secondi)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--tipo', default='clienti', choices=['clienti', 'partner'])
+    parser.add_argument('--import-rows', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='salva il riepilogo in JSON')
+    args = parser.parse_args()
+
+    workbook = messy_workbook(args.import_rows, args.tipo, seed=args.seed)
+    stats = Stats()
+    start = time.time()
+    deadline = start + args.duration
+
+    users = []
+    for i in range(args.users):
+        user = VirtualUser(args.url, args.mix, stats, deadline, args.think_time, workbook, args.tipo, args.seed + i)
+        user.start()
+        users.append(user)
+        time.sleep(args.ramp / max(args.users, 1))
+    for user in users:
+        user.join()
+    elapsed = time.time() - start
+
+    summary = {'users': args.users, 'duration_s': round(elapsed, 1), 'endpoints': {}}
+    print(f'{"endpoint":>10} {"richieste":>9} {"req/s":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} '
+          f'{"errori":>7} {"lock":>5} {"conflitti":>9}')
+    for name, latencies in sorted(stats.latencies.items()):
+        entry = {
+            'requests': len(latencies),
+            'throughput_rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+            'errors': stats.errors[name],
+            'lock_errors': stats.lock_errors[name],
+            'conflicts': stats.conflicts[name]
+        }
+        summary['endpoints'][name] = entry
+        print(f'{name:>10} {entry["requests"]:>9} {entry["throughput_rps"]:>7} {entry["p50_ms"]:>9} '
+              f'{entry["p95_ms"]:>9} {entry["p99_ms"]:>9} {entry["errors"]:>7} {entry["lock_errors"]:>5} '
+              f'{entry["conflicts"]:>9}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Generatore di contatti sintetici realistici per benchmark e prove di carico"""
+import io
+import random
+from datetime import datetime
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import compute_content_hash
+
+# Comuni di esempio: (località, CAP, provincia)
+COMUNI = [
+    ('Udine', '33100', 'UD'), ('Pordenone', '33170', 'PN'), ('Trieste', '34121', 'TS'),
+    ('Gorizia', '34170', 'GO'), ('Tolmezzo', '33028', 'UD'), ('Cividale del Friuli', '33043', 'UD'),
+    ('San Daniele del Friuli', '33038', 'UD'), ('Codroipo', '33033', 'UD'), ('Latisana', '33053', 'UD'),
+    ('Sacile', '33077', 'PN'), ('Spilimbergo', '33097', 'PN'), ('Monfalcone', '34074', 'GO'),
+    ('Venezia', '30121', 'VE'), ('Mestre', '30171', 'VE'), ('Treviso', '31100', 'TV'),
+    ('Conegliano', '31015', 'TV'), ('Padova', '35121', 'PD'), ('Vicenza', '36100', 'VI'),
+    ('Verona', '37121', 'VR'), ('Belluno', '32100', 'BL'), ('Milano', '20121', 'MI'),
+    ('Monza', '20900', 'MB'), ('Bergamo', '24121', 'BG'), ('Brescia', '25121', 'BS'),
+    ('Torino', '10121', 'TO'), ('Genova', '16121', 'GE'), ('Bologna', '40121', 'BO'),
+    ('Modena', '41121', 'MO'), ('Firenze', '50122', 'FI'), ('Roma', '00184', 'RM'),
+    ('Napoli', '80133', 'NA'), ('Bari', '70121', 'BA'), ('Palermo', '90133', 'PA'),
+    ('Cagliari', '09124', 'CA'), ('Trento', '38122', 'TN'), ('Bolzano', '39100', 'BZ')
+]
+
+NOMI = ['Marco', 'Andrea', 'Giulia', 'Francesca', 'Luca', 'Matteo', 'Sara', 'Chiara', 'Alessandro',
+        'Paolo', 'Elena', 'Davide', 'Federica', 'Giorgio', 'Martina', 'Stefano', 'Laura', 'Roberto']
+COGNOMI = ['Rossi', 'Bianchi', 'Russo', 'Ferrari', 'Esposito', 'Romano', 'Colombo', 'Ricci', 'Marino',
+           'Greco', 'Bruno', 'Gallo', 'Conti', 'De Luca', 'Costa', 'Fabbro', 'Zanutta', 'Del Piero']
+VIE = ['Via Roma', 'Via Garibaldi', 'Via Mazzini', 'Viale Venezia', 'Piazza della Libertà',
+       'Via Cavour', 'Via Aquileia', 'Corso Italia', 'Via dei Mille', 'Via Nazionale', 'Via Cividale']
+SETTORI = ['Meccanica', 'Impianti', 'Costruzioni', 'Consulting', 'Trasporti', 'Alimentari', 'Legno', 'Servizi']
+FORME = ['Srl', 'S.p.A.', 'Snc', 'Sas', '& C.']
+TIPOLOGIE = ['Fornitore', 'Consulente', 'Rivenditore', 'Installatore']
+CONSEGNATARI = ['Andrea Gosgnach', 'Marco Crasnich', 'Massimo Cendron', 'Matteo Rocchetto']
+
+# Intestazioni alternative usate nei fogli "disordinati" (tutte riconosciute dall'importazione)
+HEADER_ALIASES = {
+    'nome': ['Nome', 'NOMINATIVO', 'Referente', 'nome e cognome'],
+    'azienda': ['Azienda', 'Ragione Sociale', 'Società', 'DITTA'],
+    'indirizzo': ['Indirizzo', 'Via/Piazza', 'indirizzo spedizione'],
+    'civico': ['Civico', 'N. civico', 'Num.'],
+    'cap': ['CAP', 'C.A.P.', 'Codice Postale'],
+    'localita': ['Località', 'Comune', 'Città'],
+    'provincia': ['Provincia', 'Prov.', 'Sigla provincia'],
+    'telefono': ['Telefono', 'Tel.', 'Cellulare'],
+    'email': ['Email', 'E-mail', 'Posta elettronica'],
+    'note': ['Note', 'Annotazioni'],
+    'grappa': ['Grappa', 'Omaggio grappa'],
+    'consegnaSpedizione': ['Consegna/Spedizione', 'Consegnatario'],
+    'gls': ['GLS', 'Corriere GLS']
+}
+
+
+def generate_contatti(count, tipo='clienti', seed=42):
+    """Genera dizionari di contatti pronti per l'inserimento nella tabella contatti"""
+    rng = random.Random(f'{seed}-{tipo}')
+    now = datetime.utcnow()
+    for i in range(count):
+        localita, cap, provincia = rng.choice(COMUNI)
+        cognome = rng.choice(COGNOMI)
+        gls = rng.random() < 0.6
+        row = {
+            'tipo': tipo,
+            'nome': f'{rng.choice(NOMI)} {cognome} {i}',
+            'azienda': f'{cognome} {rng.choice(SETTORI)} {rng.choice(FORME)}' if rng.random() < 0.8 else None,
+            'indirizzo': rng.choice(VIE),
+            'civico': str(rng.randint(1, 250)),
+            'cap': cap,
+            'localita': localita,
+            'provincia': provincia,
+            'telefono': f'0{rng.randint(10, 99)} {rng.randint(100000, 999999)}',
+            'email': f'{cognome.lower().replace(" ", "")}.{i}@example.it',
+            'note': 'Consegnare in orario d\'ufficio' if rng.random() < 0.1 else None,
+            'tipologia': rng.choice(TIPOLOGIE) if tipo == 'partner' else None,
+            'grappa': rng.random() < 0.7,
+            'extraAltro': 'Panettone' if rng.random() < 0.2 else None,
+            'consegnaSpedizione': None if gls else rng.choice(CONSEGNATARI),
+            'gls': gls,
+            'eliminato': rng.random() < 0.05,
+            'eliminatoIl': None,
+            'createdAt': now,
+            'lastUpdate': now
+        }
+        row['contentHash'] = compute_content_hash(row)
+        yield row
+
+
+def messy_rows(count, tipo='clienti', seed=42):
+    """Genera righe come quelle di un foglio Excel compilato a mano (intestazioni alternative, valori sporchi)"""
+    rng = random.Random(f'{seed}-messy')
+    headers = {field: rng.choice(aliases) for field, aliases in HEADER_ALIASES.items()}
+    rows = []
+    for contatto in generate_contatti(count, tipo, seed):
+        row = {}
+        for field, header in headers.items():
+            value = contatto.get(field)
+            if field in ['grappa', 'gls']:
+                value = rng.choice(['x', 'Sì', '1', 'TRUE']) if value else rng.choice(['', 'no', None])
+            elif field == 'cap' and value and rng.random() < 0.3:
+                value = int(value)  # Excel converte spesso i CAP in numeri
+            elif isinstance(value, str) and rng.random() < 0.1:
+                value = f'  {value} '
+            row[header] = value
+        rows.append(row)
+        # Righe vuote o incomplete sparse nel foglio
+        if rng.random() < 0.02:
+            rows.append({header: None for header in headers.values()})
+    return rows
+
+
+def messy_workbook(count, tipo='clienti', seed=42):
+    """Crea in memoria una cartella Excel disordinata con il foglio del tipo e un foglio estraneo"""
+    import pandas as pd
+
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        pd.DataFrame(messy_rows(count, tipo, seed)).to_excel(writer, sheet_name=tipo.capitalize(), index=False)
+        pd.DataFrame([{'Nota': 'Foglio di appunti'}]).to_excel(writer, sheet_name='Appunti', index=False)
+    return output.getvalue()
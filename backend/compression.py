@@ -0,0 +1,116 @@
+from flask import request, send_from_directory
+import mimetypes
+import gzip
+import os
+import re
+
+# Brotli è opzionale: senza il modulo le risposte vengono compresse solo con gzip
+try:
+    import brotli
+    has_brotli = True
+except ImportError:
+    has_brotli = False
+
+# Tipi di contenuto che conviene comprimere
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/javascript', 'application/x-ndjson', 'application/xml',
+    'image/svg+xml', 'text/csv', 'text/css', 'text/html', 'text/javascript', 'text/plain'
+}
+
+# File della build React con hash nel nome (es. main.3f2a9c1b.js): non cambiano mai
+HASHED_ASSET = re.compile(r'\.[0-9a-f]{8,}\.(?:chunk\.)?(?:js|css|map|svg|png|jpg|woff2?|ttf)$')
+
+# Varianti precompresse cercate accanto ai file statici, in ordine di preferenza
+PRECOMPRESSED_VARIANTS = [('br', '.br'), ('gzip', '.gz')]
+
+def init_compression(app):
+    """Comprime le risposte dinamiche in base all'Accept-Encoding del client"""
+    app.config.setdefault('COMPRESS_MIN_SIZE', int(os.environ.get('COMPRESS_MIN_SIZE', 1024)))
+    app.config.setdefault('COMPRESS_LEVEL', int(os.environ.get('COMPRESS_LEVEL', 6)))
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4)))
+    
+    @app.after_request
+    def compress_response(response):
+        # File inviati con send_file e stream (es. SSE) non vengono toccati
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code < 200 or response.status_code in (204, 206, 304)
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding()
+        if encoding is None or (response.content_length or 0) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        
+        data = response.get_data()
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY']))
+        else:
+            response.set_data(gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+def choose_encoding(available=None):
+    """Sceglie la codifica migliore accettata dal client tra quelle disponibili"""
+    available = available or (['br', 'gzip'] if has_brotli else ['gzip'])
+    for encoding in available:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+def send_static_asset(folder, path):
+    """Invia un file della build usando, se presente, la variante .br/.gz precompressa"""
+    response = None
+    for encoding, extension in PRECOMPRESSED_VARIANTS:
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(folder, path + extension)):
+            mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            response = send_from_directory(folder, path + extension, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    
+    if response is None:
+        response = send_from_directory(folder, path)
+    response.vary.add('Accept-Encoding')
+    
+    if HASHED_ASSET.search(path):
+        # Il nome cambia ad ogni build: il browser può tenerlo in cache per sempre
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        # index.html e gli altri file vanno sempre riconvalidati (ETag/If-Modified-Since)
+        response.cache_control.no_cache = True
+        response.cache_control.max_age = None
+    return response
+
+def precompress_folder(folder, min_size=1024):
+    """Crea accanto ai file comprimibili le varianti .gz (e .br se disponibile)"""
+    created = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(('.gz', '.br')):
+                continue
+            mimetype = mimetypes.guess_type(name)[0]
+            path = os.path.join(root, name)
+            if mimetype not in COMPRESSIBLE_MIMETYPES or os.path.getsize(path) < min_size:
+                continue
+            
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            created += 1
+            if has_brotli:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+                created += 1
+    return created
+
+if __name__ == '__main__':
+    import sys
+    
+    # Uso: python compression.py [cartella build]
+    build_folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '../frontend/build')
+    print(f"Create {precompress_folder(build_folder)} varianti precompresse in {build_folder}")
@@ -1,34 +1,88 @@
+from flask import g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from functools import wraps
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import OperationalError
+from datetime import datetime
+import hashlib
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 # Carica variabili d'ambiente
 load_dotenv()
 
+class RoutingSession(Session):
+    """Sessione che invia le SELECT alla replica di lettura nelle richieste marcate con read_only"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        # Flush, INSERT/UPDATE/DELETE e istruzioni testuali restano sul primario
+        if (bind is None and not self._flushing and has_request_context() and g.get('use_replica')
+                and getattr(clause, 'is_select', False)):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 # Inizializzazione dell'oggetto SQLAlchemy
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-def init_db(app):
-    """Inizializza il database con l'applicazione Flask"""
-    database_url = os.getenv('DATABASE_URL', 'sqlite:///crm_natale.db')
-    
-    # Controlla se l'URL è per PostgreSQL e ha il formato corretto
-    # Render fornisce URL che iniziano con postgres://, ma SQLAlchemy si aspetta postgresql://
-    if database_url.startswith('postgres://'):
+# Tabella con l'impronta dello schema applicato, esclusa dall'impronta stessa
+SCHEMA_TABLE = 'schema_info'
+
+# Chiave di SQLALCHEMY_BINDS per la replica di lettura
+REPLICA_BIND = 'replica'
+
+# Cookie con l'istante dell'ultima scrittura del client, per leggere dal primario subito dopo
+REPLICA_STICKY_COOKIE = 'crm_ultima_scrittura'
+
+# Ritardo della replica in secondi: 0 se è allineata o se il database non è una replica Postgres
+REPLICA_LAG_QUERY = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+# Esito dell'ultimo controllo della replica, condiviso dai thread del processo
+_replica_state = {'checked': 0.0, 'healthy': False, 'lag': None, 'error': None}
+_replica_lock = threading.Lock()
+
+def normalize_database_url(database_url):
+    """Render e Heroku forniscono URL che iniziano con postgres://, ma SQLAlchemy si aspetta postgresql://"""
+    if database_url and database_url.startswith('postgres://'):
         database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    return database_url
+
+def init_db(app, replica_url=None):
+    """Inizializza il database con l'applicazione Flask, con una replica di lettura facoltativa"""
+    database_url = normalize_database_url(os.getenv('DATABASE_URL', 'sqlite:///crm_natale.db'))
+    replica_url = normalize_database_url(replica_url or os.getenv('DATABASE_REPLICA_URL'))
     
     # Configura il database
     app.config['SQLALCHEMY_DATABASE_URI'] = database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if replica_url:
+        app.config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA_BIND] = replica_url
+    # Secondi in cui un client che ha appena scritto legge dal primario
+    app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    # Ritardo oltre il quale la replica viene scartata e si legge dal primario
+    app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 10))
+    # Intervallo tra due controlli dello stato della replica
+    app.config['REPLICA_CHECK_INTERVAL'] = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+    # Con gunicorn la migrazione viene eseguita una volta dal master (gunicorn.conf.py) e i worker la saltano
+    app.config['DB_MIGRATE_ON_START'] = os.environ.get('DB_MIGRATE_ON_START', 'true').lower() == 'true'
     
     # Inizializza il database con l'app
     db.init_app(app)
+    if replica_url:
+        init_replica(app)
+    
+    if not app.config['DB_MIGRATE_ON_START']:
+        return
     
-    # Crea tutte le tabelle se non esistono
+    # Crea tabelle e impostazioni solo se lo schema non è aggiornato
     with app.app_context():
         try:
-            db.create_all()
-            print(f"Database inizializzato con successo: {database_url.split('@')[0].split('://')[0]}")
+            migrate_db()
         except Exception as e:
             print(f"Errore durante l'inizializzazione del database: {e}")
             # Se siamo in sviluppo, possiamo fallback su SQLite
@@ -37,4 +91,278 @@ def init_db(app):
                 print(f"Tentativo di fallback su SQLite: {fallback_url}")
                 app.config['SQLALCHEMY_DATABASE_URI'] = fallback_url
                 db.init_app(app)
-                db.create_all()
+                migrate_db()
+
+
+def init_replica(app):
+    """Registra il controllo della replica e la persistenza delle letture sul primario dopo una scrittura"""
+    with app.app_context():
+        replica_engine = db.engines[REPLICA_BIND]
+    
+    @event.listens_for(replica_engine, 'handle_error')
+    def replica_error(context):
+        # Replica irraggiungibile: le richieste successive leggono dal primario fino al prossimo controllo
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+            mark_replica_down(str(context.original_exception))
+    
+    @app.after_request
+    def remember_write(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            response.set_cookie(REPLICA_STICKY_COOKIE, f'{time.time():.3f}',
+                                max_age=int(app.config['REPLICA_STICKY_SECONDS']) + 1,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+def read_only(view):
+    """Marca una vista di sola lettura: le sue SELECT vanno alla replica quando è utilizzabile"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = should_use_replica()
+        try:
+            response = view(*args, **kwargs)
+        except OperationalError:
+            if not g.get('replica_failed'):
+                raise
+            response = None
+        # La replica ha smesso di rispondere durante la lettura: la vista viene ripetuta una volta sul primario
+        if g.use_replica and g.get('replica_failed'):
+            db.session.rollback()
+            g.use_replica = False
+            response = view(*args, **kwargs)
+        return response
+    return wrapper
+
+
+def should_use_replica():
+    """Decide se la richiesta corrente può leggere dalla replica"""
+    from flask import current_app
+    
+    if REPLICA_BIND not in current_app.config.get('SQLALCHEMY_BINDS', {}) or g.get('replica_failed'):
+        return False
+    
+    # Lettura delle proprie scritture: il client ha scritto da poco, la replica potrebbe non averle ancora
+    try:
+        last_write = float(request.cookies.get(REPLICA_STICKY_COOKIE, 0))
+    except ValueError:
+        last_write = 0
+    if time.time() - last_write < current_app.config['REPLICA_STICKY_SECONDS']:
+        return False
+    
+    return replica_status()['healthy']
+
+
+def replica_status():
+    """Restituisce lo stato della replica, ricontrollato al più una volta per intervallo"""
+    from flask import current_app
+    
+    if REPLICA_BIND not in current_app.config.get('SQLALCHEMY_BINDS', {}):
+        return {'configured': False}
+    
+    now = time.monotonic()
+    if now - _replica_state['checked'] >= current_app.config['REPLICA_CHECK_INTERVAL']:
+        # Un solo thread esegue il controllo, gli altri usano l'esito precedente
+        if _replica_lock.acquire(blocking=False):
+            try:
+                check_replica(current_app.config['REPLICA_MAX_LAG'])
+            finally:
+                _replica_lock.release()
+    
+    return {'configured': True, **{key: value for key, value in _replica_state.items() if key != 'checked'}}
+
+
+def check_replica(max_lag):
+    """Misura il ritardo della replica e la segna come non utilizzabile se è ferma o troppo indietro"""
+    engine = db.engines[REPLICA_BIND]
+    try:
+        with engine.connect() as connection:
+            if engine.dialect.name == 'postgresql':
+                lag = float(connection.execute(text(REPLICA_LAG_QUERY)).scalar() or 0)
+            else:
+                # Sostituto locale (es. una copia SQLite): basta che risponda
+                connection.execute(text('SELECT 1'))
+                lag = 0.0
+        _replica_state.update(healthy=lag <= max_lag, lag=round(lag, 3), error=None if lag <= max_lag else 'Replica in ritardo')
+    except Exception as e:
+        _replica_state.update(healthy=False, lag=None, error=str(e))
+    _replica_state['checked'] = time.monotonic()
+
+
+def mark_replica_down(error):
+    """Esclude la replica fino al prossimo controllo"""
+    _replica_state.update(healthy=False, error=error, checked=time.monotonic())
+    if has_request_context():
+        # La richiesta in corso ripete la lettura sul primario (read_only)
+        g.replica_failed = True
+
+
+def migrate_db(force=False):
+    """Applica schema e impostazioni predefinite se l'impronta salvata non corrisponde ai modelli"""
+    from models import init_default_settings, archive_soft_deleted
+    from routes.contatti import backfill_content_hashes
+    
+    fingerprint = schema_fingerprint()
+    if not force and get_schema_version() == fingerprint:
+        return False
+    
+    db.create_all()
+    add_missing_columns()
+    drop_stale_unique_constraints()
+    sync_sqlite_autoincrement()
+    sync_indexes()
+    init_default_settings()
+    # I contatti eliminati prima dell'introduzione dell'archivio lasciano la tabella principale
+    archive_soft_deleted()
+    # Le righe precedenti alla colonna contentHash ricevono l'hash, altrimenti ogni import lo ricalcola
+    backfill_content_hashes()
+    db.session.commit()
+    set_schema_version(fingerprint)
+    print(f"Database inizializzato con successo: {db.engine.url.get_backend_name()}")
+    return True
+
+
+def schema_fingerprint():
+    """Calcola un'impronta di tabelle, colonne e indici definiti nei modelli"""
+    digest = hashlib.blake2b(digest_size=16)
+    for table in db.metadata.sorted_tables:
+        if table.name == SCHEMA_TABLE:
+            continue
+        digest.update(table.name.encode())
+        for column in table.columns:
+            server_default = column.server_default.arg if column.server_default is not None else ''
+            digest.update(f"|{column.name}:{column.type}:{column.nullable}:{server_default}".encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ''):
+            digest.update(f"|{index.name}:{','.join(column.name for column in index.columns)}".encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def get_schema_version():
+    """Legge l'impronta dello schema applicato (None se il database è nuovo)"""
+    try:
+        with db.engine.connect() as connection:
+            return connection.execute(text(f'SELECT versione FROM {SCHEMA_TABLE} WHERE id = 1')).scalar()
+    except Exception:
+        # Tabella non ancora creata
+        return None
+
+
+def set_schema_version(fingerprint):
+    """Salva l'impronta dello schema appena applicato"""
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {SCHEMA_TABLE} '
+            '(id INTEGER PRIMARY KEY, versione VARCHAR(32) NOT NULL, "aggiornatoIl" TIMESTAMP NOT NULL)'
+        ))
+        connection.execute(text(f'DELETE FROM {SCHEMA_TABLE}'))
+        connection.execute(
+            text(f'INSERT INTO {SCHEMA_TABLE} (id, versione, "aggiornatoIl") VALUES (1, :versione, :aggiornato)'),
+            {'versione': fingerprint, 'aggiornato': datetime.utcnow()}
+        )
+
+
+def add_missing_columns():
+    """Aggiunge alle tabelle esistenti le colonne introdotte dopo la loro creazione"""
+    inspector = inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            
+            # create_all non modifica le tabelle esistenti: aggiungi la colonna a mano
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            if column.server_default is not None:
+                # Il valore predefinito viene applicato anche alle righe già presenti
+                column_type += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    column_type += " NOT NULL"
+            with db.engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+            print(f"Aggiunta colonna {table.name}.{column.name}")
+
+
+def drop_stale_unique_constraints():
+    """Rimuove i vincoli UNIQUE non più presenti nei modelli (es. chiave unica solo per azienda)"""
+    inspector = inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        
+        declared = {frozenset([column.name]) for column in table.columns if column.unique}
+        declared |= {frozenset(column.name for column in index.columns) for index in table.indexes if index.unique}
+        stale = [constraint for constraint in inspector.get_unique_constraints(table.name)
+                 if frozenset(constraint['column_names']) not in declared]
+        if not stale:
+            continue
+        
+        if db.engine.dialect.name == 'sqlite':
+            # SQLite non elimina i vincoli: la tabella viene ricreata e i dati copiati
+            rebuild_sqlite_table(table, inspector)
+        else:
+            with db.engine.begin() as connection:
+                for constraint in stale:
+                    connection.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT "{constraint["name"]}"'))
+        print(f"Rimossi vincoli UNIQUE obsoleti da {table.name}")
+
+
+def rebuild_sqlite_table(table, inspector):
+    """Ricrea una tabella SQLite secondo il modello mantenendo i dati delle colonne comuni"""
+    existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+    columns = ', '.join(f'"{column.name}"' for column in table.columns if column.name in existing_columns)
+    with db.engine.begin() as connection:
+        # Gli indici seguono la tabella rinominata: vanno eliminati per poterli ricreare
+        for index in inspector.get_indexes(table.name):
+            connection.execute(text(f'DROP INDEX "{index["name"]}"'))
+        connection.execute(text(f'ALTER TABLE {table.name} RENAME TO {table.name}_old'))
+        table.create(connection)
+        connection.execute(text(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {table.name}_old'))
+        connection.execute(text(f'DROP TABLE {table.name}_old'))
+
+
+def sync_sqlite_autoincrement():
+    """Ricrea le tabelle SQLite esistenti che nei modelli richiedono AUTOINCREMENT"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    inspector = inspect(db.engine)
+    
+    for table in db.metadata.sorted_tables:
+        if not table.dialect_options['sqlite']['autoincrement']:
+            continue
+        with db.engine.connect() as connection:
+            sql = connection.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                     {'name': table.name}).scalar()
+        if sql and 'AUTOINCREMENT' not in sql.upper():
+            rebuild_sqlite_table(table, inspector)
+            print(f"Tabella {table.name} ricreata con AUTOINCREMENT")
+
+
+def sync_indexes():
+    """Crea gli indici dei modelli mancanti sulle tabelle esistenti ed elimina quelli ix_ non più definiti"""
+    inspector = inspect(db.engine)
+    existing_tables = inspector.get_table_names()
+    
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        declared = {index.name for index in table.indexes}
+        with db.engine.begin() as connection:
+            for name in existing - declared:
+                if name and name.startswith('ix_'):
+                    connection.execute(text(f'DROP INDEX "{name}"'))
+                    print(f"Eliminato indice {name}")
+            # create_all non aggiunge indici alle tabelle già presenti
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    print(f"Creato indice {index.name}")
+
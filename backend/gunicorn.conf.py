@@ -0,0 +1,27 @@
+"""Configurazione gunicorn: la migrazione del database viene eseguita una volta dal master prima dei worker"""
+import os
+
+if os.environ.get('SERVER_MODE', 'wsgi') == 'asgi':
+    # Modalità ASGI (richiede uvicorn): elenchi, esportazioni e feed delle modifiche non occupano un thread
+    wsgi_app = 'asgi:create_asgi_app()'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Import/export in corso o in coda occupano un thread: gli altri restano per elenchi e stato
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+
+def on_starting(server):
+    """Applica lo schema nel master, libera i posti di import/export rimasti e disattiva il controllo nei worker"""
+    from app import create_app
+    from database import db
+    
+    app = create_app()
+    with app.app_context():
+        db.engine.dispose()
+    app.extensions['admission']['store'].clear_slots()
+    
+    # I worker ereditano l'ambiente del master
+    os.environ['DB_MIGRATE_ON_START'] = 'false'
@@ -0,0 +1,161 @@
+"""Scritture idempotenti: i tentativi ripetuti con la stessa Idempotency-Key ricevono la risposta salvata senza rifare il lavoro"""
+from flask import Response, current_app, jsonify, make_response, request
+from datetime import datetime, timedelta
+from functools import wraps
+from sqlalchemy.exc import IntegrityError
+import hashlib
+import os
+import time
+import zlib
+
+from models import RichiestaIdempotente, db
+from tenants import current_tenant
+
+# Intestazione con cui il client identifica la scrittura, uguale in tutti i tentativi
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# Intestazione aggiunta alle risposte restituite dalla tabella
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# Lunghezza massima della chiave (colonna chiave)
+MAX_KEY_LENGTH = 255
+
+# Blocchi letti dai file caricati per calcolare l'impronta della richiesta
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Ogni quanto (secondi) vengono eliminate le risposte scadute, per processo
+PRUNE_INTERVAL = 600
+_last_prune = [0.0]
+
+def init_idempotency(app):
+    """Configura la durata delle risposte salvate"""
+    app.config.setdefault('IDEMPOTENCY_TTL_HOURS', float(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24)))  # Conservazione delle risposte
+    app.config.setdefault('IDEMPOTENCY_LOCK_TIMEOUT', float(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 300)))  # Dopo questo tempo una richiesta in corso è considerata interrotta
+
+def idempotent(view):
+    """Esegue la vista una sola volta per Idempotency-Key e restituisce la risposta salvata ai tentativi successivi"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({
+                'success': False,
+                'error': f'{IDEMPOTENCY_HEADER} troppo lunga (massimo {MAX_KEY_LENGTH} caratteri)'
+            }), 400
+
+        entry_id, replay = reserve_key(key, request_fingerprint())
+        if replay is not None:
+            return replay
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            forget_key(entry_id)
+            raise
+        store_response(entry_id, response)
+        return response
+    return wrapper
+
+def request_fingerprint():
+    """Impronta di metodo, percorso e corpo: la stessa chiave non può essere riusata per una richiesta diversa"""
+    digest = hashlib.sha256(f'{request.method} {request.full_path}\n'.encode('utf-8'))
+    if request.mimetype == 'multipart/form-data':
+        # I file caricati vengono letti a blocchi e riavvolti per la vista
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f'{name}={value}\n'.encode('utf-8'))
+        for name, file in request.files.items(multi=True):
+            digest.update(f'{name}:{file.filename}\n'.encode('utf-8'))
+            while chunk := file.stream.read(HASH_CHUNK_SIZE):
+                digest.update(chunk)
+            file.stream.seek(0)
+    else:
+        digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+def reserve_key(key, fingerprint):
+    """Registra la richiesta come in corso; restituisce (id della voce, None) o (None, risposta da inviare)"""
+    table = RichiestaIdempotente.__table__
+    now = datetime.utcnow()
+    expires = now + timedelta(hours=current_app.config['IDEMPOTENCY_TTL_HOURS'])
+    prune_expired(now)
+
+    for _ in range(2):
+        try:
+            entry_id = db.session.execute(table.insert().values(
+                tenantId=current_tenant(), chiave=key, richiestaHash=fingerprint, createdAt=now, scadeIl=expires
+            )).inserted_primary_key[0]
+            db.session.commit()
+            return entry_id, None
+        except IntegrityError:
+            db.session.rollback()
+
+        entry = db.session.query(RichiestaIdempotente.id, RichiestaIdempotente.richiestaHash, RichiestaIdempotente.stato,
+                                 RichiestaIdempotente.tipoContenuto, RichiestaIdempotente.risposta,
+                                 RichiestaIdempotente.createdAt, RichiestaIdempotente.scadeIl).filter_by(chiave=key).first()
+        if entry is None:
+            # Eliminata nel frattempo: nuovo tentativo di inserimento
+            continue
+
+        abandoned = entry.stato is None and entry.createdAt < now - timedelta(seconds=current_app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+        if entry.scadeIl < now or abandoned:
+            # Voce scaduta o di una richiesta interrotta: la riprende un solo client (UPDATE condizionato)
+            result = db.session.execute(table.update().where(
+                table.c.id == entry.id, table.c.createdAt == entry.createdAt
+            ).values(richiestaHash=fingerprint, stato=None, tipoContenuto=None, risposta=None, createdAt=now, scadeIl=expires))
+            db.session.commit()
+            if result.rowcount == 1:
+                return entry.id, None
+            return None, in_progress_response()
+
+        if entry.richiestaHash != fingerprint:
+            return None, (jsonify({
+                'success': False,
+                'error': f'{IDEMPOTENCY_HEADER} già usata per una richiesta diversa'
+            }), 422)
+        if entry.stato is None:
+            return None, in_progress_response()
+
+        response = Response(zlib.decompress(entry.risposta or b''), status=entry.stato, content_type=entry.tipoContenuto)
+        response.headers[REPLAYED_HEADER] = 'true'
+        return None, response
+    return None, in_progress_response()
+
+def in_progress_response():
+    """Risposta 409 per un tentativo arrivato mentre la richiesta originale è ancora in corso"""
+    response = jsonify({
+        'success': False,
+        'error': 'Richiesta già in elaborazione: riprova tra poco'
+    })
+    response.status_code = 409
+    response.headers['Retry-After'] = '1'
+    return response
+
+def store_response(entry_id, response):
+    """Salva la risposta della richiesta originale; errori del server e rifiuti per carico restano ripetibili"""
+    if response.status_code >= 500 or response.status_code == 429 or response.is_streamed:
+        forget_key(entry_id)
+        return
+
+    table = RichiestaIdempotente.__table__
+    db.session.execute(table.update().where(table.c.id == entry_id).values(
+        stato=response.status_code, tipoContenuto=response.content_type, risposta=zlib.compress(response.get_data())
+    ))
+    db.session.commit()
+
+def forget_key(entry_id):
+    """Elimina la voce: un nuovo tentativo con la stessa chiave rifà la richiesta"""
+    table = RichiestaIdempotente.__table__
+    db.session.execute(table.delete().where(table.c.id == entry_id))
+    db.session.commit()
+
+def prune_expired(now):
+    """Elimina le risposte scadute di tutte le aziende al massimo una volta ogni PRUNE_INTERVAL secondi per processo"""
+    if time.monotonic() - _last_prune[0] < PRUNE_INTERVAL and _last_prune[0]:
+        return
+    _last_prune[0] = time.monotonic()
+    table = RichiestaIdempotente.__table__
+    db.session.execute(table.delete().where(table.c.scadeIl < now), execution_options={'all_tenants': True})
+    db.session.commit()
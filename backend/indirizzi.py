@@ -0,0 +1,192 @@
+"""Normalizzazione offline di CAP, località e provincia tramite un indice in memoria dei comuni"""
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import csv
+import os
+import re
+import unicodedata
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Elenco comune;provincia;cap (un CAP o un intervallo "00118-00199" per i comuni con più CAP).
+# Il file incluso copre capoluoghi e comuni del Nord-Est: il dataset ISTAT completo nello
+# stesso formato può sostituirlo o essere indicato con ADDRESS_DATASET
+COMUNI_FILE = os.environ.get('ADDRESS_DATASET', os.path.join(DATA_FOLDER, 'comuni_cap.csv'))
+PROVINCE_FILE = os.path.join(DATA_FOLDER, 'province.csv')
+
+# Varianti abbreviate dei nomi (es. "S. Daniele del Friuli")
+NAME_PREFIXES = {'s': ['san', 'santa', 'santo', 'sant'], 'st': ['santo'], 'sta': ['santa']}
+
+CAP_PATTERN = re.compile(r'^\d{5}$')
+
+class AddressIndex:
+    """Indice dei comuni: dizionario per nome, array ordinati per nome e per intervalli di CAP"""
+
+    def __init__(self, comuni, province):
+        # comuni: tuple (nome, sigla provincia, primo CAP, ultimo CAP)
+        self.by_name = {}
+        for entry in comuni:
+            self.by_name.setdefault(normalize_name(entry[0]), []).append(entry)
+        self.names = sorted(self.by_name)
+
+        # Intervalli ordinati per CAP iniziale: la ricerca è una bisezione più una breve scansione
+        ranges = sorted(comuni, key=lambda entry: entry[2])
+        self.cap_starts = [entry[2] for entry in ranges]
+        self.cap_entries = ranges
+        self.max_span = max((entry[3] - entry[2] for entry in ranges), default=0)
+
+        self.province = {sigla: nome for sigla, nome in province}
+        self.province_by_name = {normalize_name(nome): sigla for sigla, nome in province}
+
+    def find_comune(self, localita):
+        """Cerca un comune per nome esatto, variante abbreviata o prefisso univoco; restituisce (comuni, esatto)"""
+        name = normalize_name(localita)
+        if not name:
+            return [], True
+        if name in self.by_name:
+            return self.by_name[name], True
+
+        first, _, rest = name.partition(' ')
+        for expanded in NAME_PREFIXES.get(first, []):
+            candidate = f'{expanded} {rest}'
+            if candidate in self.by_name:
+                return self.by_name[candidate], False
+
+        # Prefisso univoco sull'elenco ordinato (es. "Cividale" -> "Cividale del Friuli")
+        position = bisect_left(self.names, name)
+        matches = self.names[position:position + 2]
+        matches = [match for match in matches if match.startswith(name + ' ')]
+        if len(matches) == 1:
+            return self.by_name[matches[0]], False
+        return [], True
+
+    def find_cap(self, cap):
+        """Restituisce i comuni il cui intervallo di CAP contiene il CAP indicato"""
+        value = int(cap)
+        end = bisect_right(self.cap_starts, value)
+        start = bisect_left(self.cap_starts, value - self.max_span, 0, end)
+        return [entry for entry in self.cap_entries[start:end] if entry[3] >= value]
+
+    def find_provincia(self, provincia):
+        """Restituisce la sigla di una provincia indicata per sigla o per nome"""
+        value = str(provincia or '').strip()
+        if value.upper() in self.province:
+            return value.upper()
+        return self.province_by_name.get(normalize_name(value))
+
+def normalize_name(value):
+    """Riduce un nome di località alla forma di confronto (minuscolo, senza accenti e punteggiatura)"""
+    value = unicodedata.normalize('NFKD', str(value or '')).encode('ascii', 'ignore').decode('ascii')
+    value = re.sub(r"[^a-z0-9]+", ' ', value.lower())
+    return value.strip()
+
+def normalize_cap(value):
+    """Porta il CAP a cinque cifre (Excel elimina gli zeri iniziali e può aggiungere '.0')"""
+    value = str(value or '').strip()
+    if value.endswith('.0'):
+        value = value[:-2]
+    value = value.replace(' ', '')
+    if value.isdigit() and len(value) < 5:
+        value = value.zfill(5)
+    return value
+
+def format_cap(value):
+    """Formatta un CAP numerico dell'indice"""
+    return f'{value:05d}'
+
+def load_index(comuni_file=COMUNI_FILE, province_file=PROVINCE_FILE):
+    """Costruisce l'indice dai file CSV del dataset"""
+    comuni = []
+    with open(comuni_file, encoding='utf-8', newline='') as handle:
+        for row in csv.DictReader(handle, delimiter=';'):
+            first, _, last = row['cap'].partition('-')
+            comuni.append((row['comune'], row['provincia'].upper(), int(first), int(last or first)))
+
+    with open(province_file, encoding='utf-8', newline='') as handle:
+        province = [(row['sigla'].upper(), row['provincia']) for row in csv.DictReader(handle, delimiter=';')]
+
+    return AddressIndex(comuni, province)
+
+_index = None
+
+def get_index():
+    """Restituisce l'indice, caricato alla prima richiesta"""
+    global _index
+    if _index is None:
+        _index = load_index()
+    return _index
+
+@lru_cache(maxsize=65536)
+def normalize_address(cap, localita, provincia):
+    """Valida e corregge una terna CAP/località/provincia; restituisce (cap, localita, provincia, problema)"""
+    index = get_index()
+    cap = normalize_cap(cap)
+    localita = ' '.join(str(localita or '').split())
+    sigla = index.find_provincia(provincia)
+    provincia = sigla or str(provincia or '').strip().upper()
+
+    candidates, exact = index.find_comune(localita)
+    if not exact:
+        # Abbreviazione o prefisso: accettati solo se provincia e CAP indicati corrispondono,
+        # altrimenti "San Giovanni" (MI) diventerebbe "San Giovanni al Natisone" (UD)
+        candidates = [
+            entry for entry in candidates
+            if (not sigla or entry[1] == sigla) and CAP_PATTERN.match(cap) and entry[2] <= int(cap) <= entry[3]
+        ]
+    if sigla and len(candidates) > 1:
+        # Comuni omonimi: la provincia indicata decide, se corrisponde a uno di essi
+        candidates = [entry for entry in candidates if entry[1] == sigla] or candidates
+
+    if not cap and len(candidates) == 1 and candidates[0][2] == candidates[0][3]:
+        # CAP mancante ma ricavabile da un comune con un solo CAP
+        cap = format_cap(candidates[0][2])
+    if not cap or not localita:
+        return cap, localita, provincia, 'Indirizzo incompleto'
+    if not CAP_PATTERN.match(cap):
+        return cap, localita, provincia, 'CAP non valido'
+
+    if candidates:
+        matching = [entry for entry in candidates if entry[2] <= int(cap) <= entry[3]]
+        if matching:
+            entry = matching[0]
+        elif len(candidates) == 1 and candidates[0][2] == candidates[0][3]:
+            # Il comune ha un solo CAP: quello indicato è sicuramente sbagliato
+            entry = candidates[0]
+            cap = format_cap(entry[2])
+        else:
+            return cap, localita, provincia, f'CAP {cap} non valido per {candidates[0][0]}'
+        return cap, entry[0], entry[1], None
+
+    # Località sconosciuta (frazione o comune fuori dal dataset): la provincia si ricava dal CAP
+    by_cap = index.find_cap(cap)
+    province_of_cap = {entry[1] for entry in by_cap}
+    if len(province_of_cap) == 1:
+        provincia = province_of_cap.pop()
+
+    if not sigla and provincia not in index.province:
+        return cap, localita, provincia, 'Provincia sconosciuta'
+    return cap, localita, provincia, None
+
+def correct_addresses(records, report):
+    """Corregge CAP, località e provincia di una sequenza di contatti, annotando gli esiti in report"""
+    report.setdefault('corretti', 0)
+    report.setdefault('da_verificare', [])
+
+    for record in records:
+        current = (record.get('cap'), record.get('localita'), record.get('provincia'))
+        if any(current):
+            cap, localita, provincia, problema = normalize_address(*(value or '' for value in current))
+            corrected = {'cap': cap, 'localita': localita, 'provincia': provincia}
+            changed = {field: value for field, value in corrected.items() if value and value != record.get(field)}
+            if changed:
+                record.update(changed)
+                report['corretti'] += 1
+            # Un indirizzo incompleto è un problema solo per le spedizioni GLS
+            if problema and (problema != 'Indirizzo incompleto' or record.get('gls') in [True, 1, '1']):
+                report['da_verificare'].append({
+                    'nome': record.get('nome'),
+                    'azienda': record.get('azienda'),
+                    **corrected,
+                    'problema': problema
+                })
+        yield record
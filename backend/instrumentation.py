@@ -0,0 +1,140 @@
+from flask import g, request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
+from collections import Counter
+import logging
+import json
+import os
+import time
+
+# Logger per le righe strutturate di ogni richiesta
+logger = logging.getLogger('crm_natale.richieste')
+
+# Numero massimo di query conservate per richiesta (per il log delle richieste lente)
+MAX_LOGGED_QUERIES = 200
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Provider JSON che misura il tempo di codifica delle risposte"""
+    
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            record_timing('json', time.perf_counter() - start)
+
+def init_instrumentation(app):
+    """Registra la misurazione dei tempi di richiesta, SQL e serializzazione"""
+    app.config.setdefault('INSTRUMENTATION_ENABLED', os.environ.get('INSTRUMENTATION_ENABLED', 'true').lower() == 'true')
+    app.config.setdefault('SLOW_REQUEST_MS', float(os.environ.get('SLOW_REQUEST_MS', 500)))
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10)))
+    
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return
+    
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    
+    app.json = TimedJSONProvider(app)
+    
+    @app.before_request
+    def start_timing():
+        g.timing = {
+            'start': time.perf_counter(),
+            'sql': 0.0,
+            'serialize': 0.0,
+            'json': 0.0,
+            'query_count': 0,
+            'queries': []
+        }
+    
+    @app.after_request
+    def finish_timing(response):
+        timing = g.pop('timing', None)
+        if timing is None:
+            return response
+        
+        total = time.perf_counter() - timing['start']
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={timing["sql"] * 1000:.1f};desc="{timing["query_count"]} query"',
+            f'serialize;dur={timing["serialize"] * 1000:.1f}',
+            f'json;dur={timing["json"] * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}'
+        ])
+        
+        entry = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'sql_ms': round(timing['sql'] * 1000, 1),
+            'query_count': timing['query_count'],
+            'serialize_ms': round(timing['serialize'] * 1000, 1),
+            'json_ms': round(timing['json'] * 1000, 1)
+        }
+        
+        # Segnala le query ripetute identiche (tipico dei cicli di Contatto.query.get)
+        repeated = Counter(statement for statement, _ in timing['queries'])
+        suspects = [
+            {'statement': statement, 'count': count}
+            for statement, count in repeated.items()
+            if count >= app.config['N_PLUS_ONE_THRESHOLD']
+        ]
+        if suspects:
+            entry['n_plus_one'] = suspects
+        
+        if entry['total_ms'] >= app.config['SLOW_REQUEST_MS']:
+            entry['queries'] = [
+                {'statement': statement, 'ms': round(duration * 1000, 2)}
+                for statement, duration in timing['queries']
+            ]
+            logger.warning('richiesta lenta %s', json.dumps(entry, ensure_ascii=False))
+        elif suspects:
+            logger.warning('possibile N+1 %s', json.dumps(entry, ensure_ascii=False))
+        else:
+            logger.info('richiesta %s', json.dumps(entry, ensure_ascii=False))
+        
+        return response
+
+def record_timing(name, seconds):
+    """Somma una durata alla voce indicata della richiesta corrente, se misurata"""
+    if has_request_context():
+        timing = g.get('timing')
+        if timing is not None:
+            timing[name] += seconds
+
+@contextmanager
+def timed(name):
+    """Misura il blocco e somma la durata alla voce indicata (es. 'serialize')"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Annota l'inizio dell'esecuzione di una query"""
+    conn.info['query_start'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Somma durata e numero delle query alla richiesta corrente"""
+    if not has_request_context():
+        return
+    
+    timing = g.get('timing')
+    if timing is None:
+        return
+    
+    duration = time.perf_counter() - conn.info.pop('query_start', time.perf_counter())
+    timing['sql'] += duration
+    timing['query_count'] += 1
+    if len(timing['queries']) < MAX_LOGGED_QUERIES:
+        timing['queries'].append((statement, duration))
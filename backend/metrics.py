@@ -0,0 +1,132 @@
+from flask import Response, g, request
+from sqlalchemy import func
+from bisect import bisect_left
+from threading import Lock
+import time
+
+from database import db
+from tenants import current_tenant
+
+# Limiti superiori (in secondi o byte) dei bucket degli istogrammi
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [1024, 10 * 1024, 100 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024, 5 * 1024 * 1024, 10 * 1024 * 1024]
+ROWS_PER_SECOND_BUCKETS = [100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000]
+
+class Histogram:
+    """Istogramma in memoria nel formato di esposizione Prometheus"""
+    
+    def __init__(self, name, description, buckets, labelnames=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = Lock()
+    
+    def observe(self, value, **labels):
+        """Registra un'osservazione (costo costante: una ricerca binaria e due somme)"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+    
+    def render(self):
+        """Restituisce le righe di testo dell'istogramma"""
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        
+        for key, counts, total in sorted(values):
+            labels = [f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                bucket_labels = ','.join(labels + [f'le="{bound}"'])
+                lines.append(f'{self.name}_bucket{{{bucket_labels}}} {cumulative}')
+            suffix = '{' + ','.join(labels) + '}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+REQUEST_LATENCY = Histogram(
+    'crm_request_duration_seconds', 'Durata delle richieste HTTP per route', LATENCY_BUCKETS, ('route', 'method', 'status'))
+RESPONSE_SIZE = Histogram(
+    'crm_response_size_bytes', 'Dimensione del corpo delle risposte per route', SIZE_BUCKETS, ('route', 'method'))
+IMPORT_ROWS_PER_SECOND = Histogram(
+    'crm_import_rows_per_second', 'Righe elaborate al secondo per importazione', ROWS_PER_SECOND_BUCKETS, ('format',))
+EXPORT_BUILD_TIME = Histogram(
+    'crm_export_build_seconds', 'Tempo di generazione dei file esportati', LATENCY_BUCKETS, ('export',))
+
+HISTOGRAMS = [REQUEST_LATENCY, RESPONSE_SIZE, IMPORT_ROWS_PER_SECOND, EXPORT_BUILD_TIME]
+
+def escape_label(value):
+    """Applica l'escape richiesto dal formato Prometheus ai valori delle etichette"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def init_metrics(app):
+    """Registra la raccolta delle metriche e l'endpoint /api/metrics"""
+    
+    @app.before_request
+    def start_metrics():
+        g.metrics_start = time.perf_counter()
+    
+    @app.after_request
+    def record_metrics(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        
+        # La regola della route (es. /api/<string:tipo>) tiene bassa la cardinalità delle etichette
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - start, route=route, method=request.method, status=response.status_code)
+        if response.content_length is not None:
+            RESPONSE_SIZE.observe(response.content_length, route=route, method=request.method)
+        return response
+    
+    @app.route('/api/metrics')
+    def metrics():
+        lines = []
+        for histogram in HISTOGRAMS:
+            lines.extend(histogram.render())
+        lines.extend(render_pool_metrics())
+        lines.extend(render_contatti_metrics())
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def render_pool_metrics():
+    """Restituisce lo stato del pool di connessioni al database"""
+    pool = db.engine.pool
+    lines = []
+    for name, method, description in [
+        ('crm_db_pool_size', 'size', 'Dimensione configurata del pool di connessioni'),
+        ('crm_db_pool_checked_out', 'checkedout', 'Connessioni attualmente in uso'),
+        ('crm_db_pool_checked_in', 'checkedin', 'Connessioni libere nel pool'),
+        ('crm_db_pool_overflow', 'overflow', 'Connessioni aperte oltre la dimensione del pool')
+    ]:
+        # Non tutti i pool (es. StaticPool di SQLite in memoria) espongono questi valori
+        if hasattr(pool, method):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {getattr(pool, method)()}')
+    return lines
+
+def render_contatti_metrics():
+    """Restituisce il numero di contatti dell'azienda della richiesta per tipo e stato di eliminazione"""
+    from models import Contatto, ContattoEliminato
+    
+    # /api/metrics non è autenticato: i conteggi restano limitati all'azienda indicata (X-Tenant),
+    # senza esporre nomi e dimensioni delle altre
+    tenant = current_tenant()
+    rows = []
+    for model, eliminato in [(Contatto, False), (ContattoEliminato, True)]:
+        rows += [(tipo, eliminato, count) for tipo, count in db.session.query(
+            model.tipo, func.count(model.id)).group_by(model.tipo)]
+    
+    lines = ['# HELP crm_contatti Numero di contatti per azienda, tipo e stato', '# TYPE crm_contatti gauge']
+    for tipo, eliminato, count in rows:
+        lines.append(f'crm_contatti{{azienda="{escape_label(tenant)}",tipo="{escape_label(tipo or "")}",'
+                     f'eliminato="{str(bool(eliminato)).lower()}"}} {count}')
+    return lines
@@ -1,7 +1,20 @@
 from database import db
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy import Table, event, literal, select
+from sqlalchemy.orm import Session, with_loader_criteria
+from sqlalchemy.sql import Delete, Join, Select, Update
+from tenants import DEFAULT_TENANT, current_tenant
+import threading
+import hashlib
 import json
 
+# Campi anagrafici e di campagna su cui viene calcolato l'hash del contenuto
+HASH_FIELDS = [
+    'nome', 'azienda', 'indirizzo', 'civico', 'cap', 'localita', 'provincia',
+    'telefono', 'email', 'note', 'tipologia', 'grappa', 'extraAltro',
+    'consegnaSpedizione', 'gls'
+]
+
 class BaseModel:
     """Classe base per i modelli con metodi di utilità"""
     
@@ -21,7 +34,11 @@ class BaseModel:
         """Converte l'oggetto in una stringa JSON"""
         return json.dumps(self.to_dict())
 
-class Contatto(db.Model, BaseModel):
+class TenantMixin:
+    """Colonna dell'azienda proprietaria: le query via sessione vengono filtrate automaticamente"""
+    tenantId = db.Column(db.String(50), nullable=False, default=current_tenant, server_default=db.text(f"'{DEFAULT_TENANT}'"))
+
+class Contatto(db.Model, BaseModel, TenantMixin):
     """Modello per Clienti e Partner"""
     __tablename__ = 'contatti'
     
@@ -46,24 +63,251 @@ class Contatto(db.Model, BaseModel):
     eliminatoIl = db.Column(db.DateTime)
     createdAt = db.Column(db.DateTime, default=datetime.utcnow)
     lastUpdate = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    contentHash = db.Column(db.String(32))  # Hash dei campi normalizzati (vedi HASH_FIELDS)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # Versione per il controllo di concorrenza ottimistico
+    
+    # Ogni UPDATE via ORM incrementa la versione e verifica quella letta (WHERE version = ?)
+    __mapper_args__ = {'version_id_col': version}
+    
+    # Gli elenchi di un'azienda leggono solo il suo intervallo dell'indice, qualunque sia la dimensione delle altre.
+    # Su SQLite AUTOINCREMENT evita di riassegnare l'ID di un contatto spostato nel cestino
+    __table_args__ = (
+        db.Index('ix_contatti_tenant_tipo_eliminato', 'tenantId', 'tipo', 'eliminato'),
+        {'sqlite_autoincrement': True},
+    )
     
     def __repr__(self):
         return f"<Contatto {self.nome} ({self.tipo})>"
+    
+    def hash_values(self):
+        """Restituisce i valori dei campi su cui viene calcolato l'hash"""
+        return {field: getattr(self, field) for field in HASH_FIELDS}
+
+def normalize_hash_value(field, value):
+    """Normalizza un valore per il calcolo dell'hash ('1'/'' per i booleani, '' per i valori mancanti)"""
+    if field in ['grappa', 'gls']:
+        return '1' if value in [True, 1, '1'] else ''
+    if value is None:
+        return ''
+    return str(value)
+
+def compute_content_hash(values):
+    """Calcola l'hash del contenuto di un contatto a partire da un dizionario di valori"""
+    parts = [normalize_hash_value(field, values.get(field)) for field in HASH_FIELDS]
+    return hashlib.blake2b('\x1f'.join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+@event.listens_for(Contatto, 'before_insert')
+@event.listens_for(Contatto, 'before_update')
+def update_content_hash(mapper, connection, target):
+    """Mantiene aggiornato l'hash del contenuto ad ogni scrittura via ORM"""
+    target.contentHash = compute_content_hash(target.hash_values())
+
+def archive_columns():
+    """Colonne dell'archivio: le stesse di contatti, con l'ID copiato e non generato"""
+    columns = [column._copy() for column in Contatto.__table__.columns]
+    for column in columns:
+        if column.primary_key:
+            column.autoincrement = False
+    return columns
+
+class ContattoEliminato(db.Model, BaseModel, TenantMixin):
+    """Archivio dei contatti nel cestino: la tabella contatti contiene solo quelli attivi"""
+    __table__ = db.Table(
+        'contatti_eliminati', db.metadata,
+        *archive_columns(),
+        db.Index('ix_contatti_eliminati_tenant_tipo', 'tenantId', 'tipo'),
+    )
+    
+    def __repr__(self):
+        return f"<ContattoEliminato {self.nome} ({self.tipo})>"
+
+def move_contatti(source, target, condition, values, execution_options=None):
+    """Sposta da una tabella all'altra (contatti/contatti_eliminati) le righe che soddisfano la condizione
+
+    Un INSERT ... SELECT e un DELETE: i contatti non passano dall'ORM e mantengono l'ID.
+    """
+    columns = []
+    for column in target.columns:
+        if column.name in values:
+            columns.append(literal(values[column.name], column.type))
+        elif column.name == 'version':
+            columns.append(source.c.version + 1)
+        else:
+            columns.append(source.c[column.name])
+    
+    options = execution_options or {}
+    db.session.execute(target.insert().from_select([column.name for column in target.columns],
+                                                   select(*columns).where(condition)), execution_options=options)
+    db.session.execute(source.delete().where(condition), execution_options=options)
+
+def archive_soft_deleted():
+    """Sposta nell'archivio i contatti segnati come eliminati nella tabella principale (dati precedenti all'archivio)"""
+    table = Contatto.__table__
+    move_contatti(table, ContattoEliminato.__table__, table.c.eliminato == True,
+                  {'lastUpdate': datetime.utcnow()}, execution_options={'all_tenants': True})
+
+class ModificaContatto(db.Model, BaseModel, TenantMixin):
+    """Registro append-only delle modifiche ai contatti (feed delle modifiche)"""
+    __tablename__ = 'contatti_changes'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Numero di sequenza crescente
+    contattoId = db.Column(db.Integer, nullable=False)
+    tipo = db.Column(db.String(20))
+    operazione = db.Column(db.String(10), nullable=False)  # 'insert', 'update' o 'delete'
+    createdAt = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        db.Index('ix_contatti_changes_tenant_id', 'tenantId', 'id'),
+    )
+    
+    def __repr__(self):
+        return f"<ModificaContatto {self.id} {self.operazione} {self.contattoId}>"
+
+class Campagna(db.Model, BaseModel, TenantMixin):
+    """Storico compatto per anno dei dati di campagna di ogni contatto"""
+    __tablename__ = 'campagna'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    anno = db.Column(db.Integer, nullable=False)
+    contattoId = db.Column(db.Integer, nullable=False)  # Senza FK: lo storico resta dopo lo svuotamento del cestino
+    tipo = db.Column(db.String(20), nullable=False)
+    regalo = db.Column(db.String(100))  # Valore di regaloCorrente al momento della chiusura
+    grappa = db.Column(db.Boolean, default=False)
+    extraAltro = db.Column(db.Text)
+    consegnaSpedizione = db.Column(db.String(100))
+    gls = db.Column(db.Boolean, default=False)
+    
+    # Le query per anno leggono solo l'intervallo dell'indice, a prescindere dagli anni accumulati
+    __table_args__ = (
+        db.Index('ix_campagna_anno_contatto', 'anno', 'contattoId', unique=True),
+        db.Index('ix_campagna_tenant_anno_tipo', 'tenantId', 'anno', 'tipo'),
+    )
+    
+    def __repr__(self):
+        return f"<Campagna {self.anno} {self.contattoId}>"
+
+# Giorni di conservazione del registro delle modifiche
+CHANGES_RETENTION_DAYS = 7
+
+# Notifica i long-poll dello stesso processo quando vengono salvate nuove modifiche
+changes_condition = threading.Condition()
+_last_changes_prune = [0.0]
+
+def record_changes(entries, connection=None):
+    """Registra con un solo INSERT le modifiche indicate come (id contatto, tipo, operazione)"""
+    if not entries:
+        return
+    
+    now = datetime.utcnow()
+    rows = [
+        {'contattoId': contatto_id, 'tipo': tipo, 'operazione': operazione, 'createdAt': now}
+        for contatto_id, tipo, operazione in entries
+    ]
+    if connection is None:
+        db.session.execute(ModificaContatto.__table__.insert(), rows)
+        db.session.info['changes_recorded'] = True
+    else:
+        connection.execute(ModificaContatto.__table__.insert(), rows)
+    
+    # Elimina le voci più vecchie al massimo una volta all'ora per processo
+    if now.timestamp() - _last_changes_prune[0] > 3600:
+        _last_changes_prune[0] = now.timestamp()
+        statement = ModificaContatto.__table__.delete().where(
+            ModificaContatto.createdAt < now - timedelta(days=CHANGES_RETENTION_DAYS))
+        (connection or db.session).execute(statement, execution_options={'all_tenants': True})
+
+@event.listens_for(Session, 'do_orm_execute')
+def scope_to_tenant(state):
+    """Limita all'azienda corrente le istruzioni eseguite dalla sessione (salvo execution_options all_tenants)"""
+    if state.execution_options.get('all_tenants') or state.is_column_load or state.is_relationship_load:
+        return
+    tenant = current_tenant()
+    statement = state.statement
+    
+    if isinstance(statement, (Update, Delete)):
+        if 'tenantId' in statement.table.c:
+            state.statement = statement.where(statement.table.c.tenantId == tenant)
+    elif isinstance(statement, Select):
+        # Entità ORM ovunque compaiano (anche in join e subquery)
+        statement = statement.options(with_loader_criteria(
+            TenantMixin, lambda cls: cls.tenantId == tenant, include_aliases=True, track_closure_variables=False))
+        # Tabelle Core: filtra la tabella principale di ogni FROM (il lato sinistro dei join)
+        entities = {getattr(description.get('entity'), '__table__', None) for description in statement.column_descriptions}
+        for source in statement.get_final_froms():
+            while isinstance(source, Join):
+                source = source.left
+            if isinstance(source, Table) and 'tenantId' in source.c and source not in entities:
+                statement = statement.where(source.c.tenantId == tenant)
+        state.statement = statement
 
-class Impostazione(db.Model, BaseModel):
+@event.listens_for(Session, 'after_flush')
+def record_orm_changes(session, flush_context):
+    """Registra le modifiche ai contatti scritte tramite ORM"""
+    entries = []
+    for operazione, objects in [('insert', session.new), ('update', session.dirty), ('delete', session.deleted)]:
+        for obj in objects:
+            if not isinstance(obj, Contatto):
+                continue
+            if operazione == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+            entries.append((obj.id, obj.tipo, operazione))
+    
+    if entries:
+        record_changes(entries, session.connection())
+        session.info['changes_recorded'] = True
+
+@event.listens_for(Session, 'after_commit')
+def notify_changes(session):
+    """Risveglia i long-poll in attesa dopo il salvataggio di nuove modifiche"""
+    if session.info.pop('changes_recorded', False):
+        with changes_condition:
+            changes_condition.notify_all()
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    """Dopo un rollback non ci sono modifiche da notificare"""
+    session.info.pop('changes_recorded', None)
+
+class RichiestaIdempotente(db.Model, BaseModel, TenantMixin):
+    """Risposte delle scritture inviate con Idempotency-Key, restituite ai tentativi ripetuti dal client"""
+    __tablename__ = 'richieste_idempotenti'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    chiave = db.Column(db.String(255), nullable=False)
+    richiestaHash = db.Column(db.String(64), nullable=False)  # Metodo, percorso e corpo della richiesta originale
+    stato = db.Column(db.Integer)  # Codice HTTP della risposta; NULL finché la richiesta originale è in corso
+    tipoContenuto = db.Column(db.String(100))
+    risposta = db.Column(db.LargeBinary)  # Corpo compresso con zlib
+    createdAt = db.Column(db.DateTime, default=datetime.utcnow)
+    scadeIl = db.Column(db.DateTime, nullable=False, index=True)
+    
+    # Una chiave per azienda; la ricerca di ogni richiesta legge una sola voce dell'indice
+    __table_args__ = (
+        db.Index('ix_richieste_idempotenti_tenant_chiave', 'tenantId', 'chiave', unique=True),
+    )
+    
+    def __repr__(self):
+        return f"<RichiestaIdempotente {self.chiave} ({self.stato})>"
+
+class Impostazione(db.Model, BaseModel, TenantMixin):
     """Modello per le impostazioni dell'applicazione"""
     __tablename__ = 'impostazioni'
     
     id = db.Column(db.Integer, primary_key=True)
-    chiave = db.Column(db.String(50), unique=True, nullable=False)
+    chiave = db.Column(db.String(50), nullable=False)
     valore = db.Column(db.Text, nullable=False)
     
+    # Ogni azienda ha le proprie impostazioni
+    __table_args__ = (
+        db.Index('ix_impostazioni_tenant_chiave', 'tenantId', 'chiave', unique=True),
+    )
+    
     def __repr__(self):
         return f"<Impostazione {self.chiave}>"
 
 # Funzioni di inizializzazione dati predefiniti
 def init_default_settings():
-    """Inizializza le impostazioni predefinite"""
+    """Inizializza le impostazioni predefinite dell'azienda corrente"""
     defaults = {
         'regaloCorrente': 'Grappa',
         'annoCorrente': str(datetime.now().year),
@@ -75,13 +319,20 @@ def init_default_settings():
         ])
     }
     
-    for chiave, valore in defaults.items():
-        # Controlla se l'impostazione esiste già
-        setting = Impostazione.query.filter_by(chiave=chiave).first()
-        if not setting:
-            # Crea nuova impostazione con il valore predefinito
-            new_setting = Impostazione(chiave=chiave, valore=valore)
-            db.session.add(new_setting)
+    tenant = current_tenant()
+    rows = [{'tenantId': tenant, 'chiave': chiave, 'valore': valore} for chiave, valore in defaults.items()]
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        # Un solo INSERT ... ON CONFLICT DO NOTHING: le impostazioni già presenti restano invariate
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(Impostazione.__table__).values(rows).on_conflict_do_nothing(index_elements=['tenantId', 'chiave'])
+        db.session.execute(statement)
+    else:
+        existing = {chiave for chiave, in db.session.query(Impostazione.chiave).filter(Impostazione.chiave.in_(defaults))}
+        db.session.add_all(Impostazione(**row) for row in rows if row['chiave'] not in existing)
     
     # Salva le modifiche
     db.session.commit()
\ No newline at end of file
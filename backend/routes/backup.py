@@ -0,0 +1,284 @@
+from flask import Blueprint, Response, request, jsonify
+from datetime import datetime
+from sqlalchemy import and_, select, func, text, distinct
+import gzip
+import io
+import json
+import time
+import zlib
+from models import Campagna, Contatto, ContattoEliminato, Impostazione, ModificaContatto, db, compute_content_hash, move_contatti
+from tenants import DEFAULT_TENANT, current_tenant
+from admission import limit_concurrency
+
+backup_bp = Blueprint('backup', __name__)
+
+# Tabelle salvate, nell'ordine di ripristino (il registro delle modifiche non fa parte del backup)
+BACKUP_TABLES = [Impostazione.__table__, Contatto.__table__, ContattoEliminato.__table__, Campagna.__table__]
+
+# Versione del formato: una riga di intestazione, poi per ogni tabella
+# {"tabella": ..., "colonne": [...]} seguita da una riga JSON (array di valori) per record
+BACKUP_FORMAT_VERSION = 1
+
+# Righe lette dal cursore e inserite per ogni istruzione
+BACKUP_CHUNK_SIZE = 5000
+
+# Byte di testo accumulati prima di passarli al compressore
+BACKUP_BUFFER_SIZE = 256 * 1024
+
+@backup_bp.route('/api/backup', methods=['GET'])
+@limit_concurrency
+def download_backup():
+    """Scarica tutti i dati dell'azienda come NDJSON compresso, generato a memoria costante"""
+    tenant = current_tenant()
+    filename = f"crm_natale_{tenant}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz"
+    response = Response(iter_backup(db.engine, tenant=tenant), mimetype='application/gzip')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+@backup_bp.route('/api/backup', methods=['POST'])
+@limit_concurrency
+def restore_backup():
+    """Sostituisce i dati dell'azienda con quelli di un backup (file caricato o corpo della richiesta)"""
+    stream = request.files['file'].stream if 'file' in request.files else request.stream
+
+    start = time.perf_counter()
+    try:
+        counts = load_backup(stream, tenant=current_tenant())
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': f'Backup ripristinato in {time.perf_counter() - start:.1f} s',
+            'data': counts
+        })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': f'Errore durante il ripristino: {str(e)}'
+        }), 500
+
+def iter_backup(engine, compress=True, tenant=None):
+    """Genera il backup a blocchi leggendo le tabelle con cursori lato server in un'unica istantanea
+
+    Con tenant=None vengono salvate tutte le aziende.
+    """
+    encoder = BackupEncoder(compress)
+    with engine.connect().execution_options(**backup_options(engine.dialect.name)) as connection:
+        if engine.dialect.name == 'sqlite':
+            connection.exec_driver_sql('BEGIN')
+
+        encoder.header(engine.dialect.name, tenant)
+        for table, statement in backup_statements(tenant):
+            encoder.table(table)
+            for row in connection.execute(statement):
+                data = encoder.row(row)
+                if data:
+                    yield data
+        connection.rollback()
+    yield encoder.finish()
+
+def backup_options(dialect):
+    """Opzioni della connessione di lettura del backup"""
+    # Postgres: istantanea coerente senza bloccare le scritture
+    # SQLite: la transazione di lettura tiene fermi i commit fino alla fine del backup
+    options = {'stream_results': True, 'yield_per': BACKUP_CHUNK_SIZE}
+    if dialect == 'postgresql':
+        options['isolation_level'] = 'REPEATABLE READ'
+    return options
+
+def backup_statements(tenant):
+    """Tabelle del backup con la SELECT che ne legge le righe (tenant=None: tutte le aziende)"""
+    for table in BACKUP_TABLES:
+        # La connessione diretta non passa dal filtro automatico della sessione
+        yield table, tenant_filter(select(table).order_by(table.c.id), table, tenant)
+
+class BackupEncoder:
+    """Codifica le righe del backup in NDJSON e restituisce blocchi (compressi) ogni BACKUP_BUFFER_SIZE byte"""
+
+    def __init__(self, compress=True):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.encode = json.JSONEncoder(default=json_default, separators=(',', ':'), ensure_ascii=False).encode
+        self.buffer = []
+        self.size = 0
+
+    def emit(self, line):
+        self.buffer.append(line)
+        self.size += len(line)
+
+    def flush(self):
+        data = ''.join(self.buffer).encode('utf-8')
+        self.buffer.clear()
+        self.size = 0
+        return self.compressor.compress(data) if self.compressor else data
+
+    def header(self, dialect, tenant):
+        """Riga di intestazione del backup"""
+        self.emit(json.dumps({'backup': BACKUP_FORMAT_VERSION, 'creatoIl': datetime.utcnow().isoformat(),
+                              'database': dialect, 'azienda': tenant}) + '\n')
+
+    def table(self, table):
+        """Riga di intestazione di una tabella con l'elenco delle colonne"""
+        self.emit(json.dumps({'tabella': table.name, 'colonne': [column.name for column in table.columns]}) + '\n')
+
+    def row(self, row):
+        """Aggiunge una riga; restituisce il blocco da inviare quando il buffer è pieno"""
+        self.emit(self.encode(tuple(row)) + '\n')
+        if self.size >= BACKUP_BUFFER_SIZE:
+            return self.flush()
+        return None
+
+    def finish(self):
+        """Ultimo blocco, con la chiusura del flusso compresso"""
+        data = self.flush()
+        if self.compressor:
+            data += self.compressor.flush()
+        return data
+
+def json_default(value):
+    """Serializza le date in formato ISO"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Valore non serializzabile: {value!r}')
+
+def load_backup(stream, tenant=None):
+    """Svuota le tabelle e carica il backup a blocchi nella transazione corrente; restituisce le righe per tabella
+
+    Con un'azienda indicata vengono sostituiti solo i suoi dati; con tenant=None l'intero database,
+    o solo l'azienda di cui il backup contiene i dati.
+    """
+    lines = io.TextIOWrapper(open_backup_stream(stream), encoding='utf-8')
+    header = json.loads(lines.readline() or 'null')
+    if not isinstance(header, dict) or header.get('backup') != BACKUP_FORMAT_VERSION:
+        raise ValueError('Il file non è un backup valido')
+
+    # Gli ID sono condivisi tra le aziende: un backup si ripristina solo sull'azienda da cui proviene
+    # (i backup precedenti alla suddivisione per azienda non la indicano e valgono per qualunque azienda)
+    if tenant is None:
+        tenant = header.get('azienda')
+    elif 'azienda' in header and header['azienda'] != tenant:
+        raise ValueError(f"Il backup contiene i dati di {header['azienda'] or 'tutte le aziende'}, non di {tenant}")
+
+    tables = {table.name: table for table in BACKUP_TABLES}
+    for table in reversed(BACKUP_TABLES):
+        db.session.execute(tenant_filter(table.delete(), table, tenant), execution_options={'all_tenants': True})
+
+    counts = {}
+    table = None
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        value = json.loads(line)
+        if isinstance(value, dict):
+            insert_chunk(table, chunk)
+            chunk = []
+            table = tables.get(value.get('tabella'))
+            if table is None:
+                raise ValueError(f"Tabella sconosciuta nel backup: {value.get('tabella')}")
+            # Le colonne assenti nello schema attuale vengono ignorate
+            columns = [(position, table.c[name]) for position, name in enumerate(value['colonne']) if name in table.c]
+            dates = {column.name for _, column in columns if isinstance(column.type, db.DateTime)}
+            needs_hash = table in (Contatto.__table__, ContattoEliminato.__table__) and 'contentHash' not in value['colonne']
+            counts[table.name] = 0
+            continue
+
+        if table is None:
+            raise ValueError('Riga di dati prima dell\'intestazione della tabella')
+        row = {}
+        for position, column in columns:
+            item = value[position]
+            row[column.name] = datetime.fromisoformat(item) if item is not None and column.name in dates else item
+        if needs_hash:
+            row['contentHash'] = compute_content_hash(row)
+        if tenant is not None:
+            row['tenantId'] = tenant
+        elif not row.get('tenantId'):
+            # Backup precedenti alla suddivisione per azienda
+            row['tenantId'] = DEFAULT_TENANT
+        chunk.append(row)
+        counts[table.name] += 1
+        if len(chunk) >= BACKUP_CHUNK_SIZE:
+            insert_chunk(table, chunk)
+            chunk = []
+    insert_chunk(table, chunk)
+
+    # I backup precedenti all'archivio hanno i contatti eliminati nella tabella principale
+    contatti = Contatto.__table__
+    condition = contatti.c.eliminato == True
+    if tenant is not None:
+        condition = and_(condition, contatti.c.tenantId == tenant)
+    move_contatti(contatti, ContattoEliminato.__table__, condition, {}, execution_options={'all_tenants': True})
+
+    reset_change_feed(tenant)
+    reset_sequences()
+    return counts
+
+def tenant_filter(statement, table, tenant):
+    """Limita l'istruzione all'azienda indicata (tenant=None: tutte le aziende)"""
+    return statement.where(table.c.tenantId == tenant) if tenant is not None else statement
+
+def open_backup_stream(stream):
+    """Restituisce uno stream binario leggibile, decomprimendo i backup gzip"""
+    head = stream.read(2)
+    source = io.BufferedReader(PrefixedStream(head, stream))
+    if head == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=source)
+    return source
+
+class PrefixedStream(io.RawIOBase):
+    """Stream che restituisce prima i byte già letti per riconoscere il formato e poi il resto dell'originale"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            data, self.prefix = self.prefix[:len(buffer)], self.prefix[len(buffer):]
+        else:
+            data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def insert_chunk(table, chunk):
+    """Inserisce un blocco di righe con un'unica istruzione executemany"""
+    if table is not None and chunk:
+        db.session.execute(table.insert(), chunk)
+
+def reset_sequences():
+    """Riallinea le sequenze degli ID di Postgres dopo l'inserimento di ID espliciti"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in BACKUP_TABLES + [ModificaContatto.__table__]:
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"
+        ))
+
+def reset_change_feed(tenant=None):
+    """Svuota il registro delle modifiche lasciando un salto di sequenza che obbliga i client a ricaricare tutto"""
+    table = ModificaContatto.__table__
+    options = {'all_tenants': True}
+    # La sequenza è condivisa tra le aziende
+    latest = db.session.execute(select(func.max(table.c.id)), execution_options=options).scalar() or 0
+    db.session.execute(tenant_filter(table.delete(), table, tenant), execution_options=options)
+
+    # Una voce di azzeramento per ogni azienda i cui client devono ricaricare
+    if tenant is not None:
+        tenants = [tenant]
+    else:
+        tenants = sorted(db.session.execute(select(distinct(Contatto.tenantId)), execution_options=options).scalars())
+    now = datetime.utcnow()
+    db.session.execute(table.insert(), [
+        {'id': latest + 2 + position, 'tenantId': name, 'contattoId': 0, 'operazione': 'reset', 'createdAt': now}
+        for position, name in enumerate(tenants or [DEFAULT_TENANT])
+    ])
+    db.session.info['changes_recorded'] = True
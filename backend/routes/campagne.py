@@ -0,0 +1,153 @@
+from flask import Blueprint, request, jsonify
+from datetime import datetime
+from sqlalchemy import select, func, literal
+from models import Campagna, Contatto, Impostazione, db, record_changes
+from routes.contatti import refresh_content_hashes
+from database import read_only
+from tenants import current_tenant
+
+campagne_bp = Blueprint('campagne', __name__)
+
+# Campi di Contatto che descrivono la campagna in corso e vengono storicizzati a fine anno
+CAMPAIGN_FIELDS = ['grappa', 'extraAltro', 'consegnaSpedizione', 'gls']
+
+# Valori con cui ripartono i contatti dopo la chiusura della campagna
+CAMPAIGN_RESET_VALUES = {'grappa': False, 'extraAltro': '', 'consegnaSpedizione': '', 'gls': False}
+
+@campagne_bp.route('/api/campagne', methods=['GET'])
+@read_only
+def get_campagne():
+    """Elenca gli anni storicizzati con il numero di contatti per tipo"""
+    try:
+        return jsonify({
+            'success': True,
+            'data': summarize_campagne()
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def summarize_campagne(session=None):
+    """Numero di contatti storicizzati per anno e tipo, dal più recente"""
+    rows = (session or db.session).execute(
+        select(Campagna.anno, Campagna.tipo, func.count())
+        .group_by(Campagna.anno, Campagna.tipo)
+        .order_by(Campagna.anno.desc())
+    ).all()
+
+    result = {}
+    for anno, tipo, count in rows:
+        result.setdefault(anno, {'anno': anno, 'clienti': 0, 'partner': 0})[tipo] = count
+    return list(result.values())
+
+@campagne_bp.route('/api/campagne/<int:anno>', methods=['GET'])
+@read_only
+def get_campagna(anno):
+    """Recupera lo storico di un anno, filtrabile per tipo e per consegnatario"""
+    try:
+        statement = (
+            select(Campagna.__table__, Contatto.nome, Contatto.azienda)
+            .outerjoin(Contatto, Contatto.id == Campagna.contattoId)
+            .where(Campagna.anno == anno)
+            .order_by(Campagna.contattoId)
+        )
+        if request.args.get('tipo'):
+            statement = statement.where(Campagna.tipo == request.args['tipo'])
+        if request.args.get('consegnaSpedizione'):
+            statement = statement.where(Campagna.consegnaSpedizione == request.args['consegnaSpedizione'])
+
+        rows = db.session.execute(statement).mappings().all()
+        return jsonify({
+            'success': True,
+            'data': [dict(row) for row in rows]
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@campagne_bp.route('/api/campagne/chiusura', methods=['POST'])
+def close_campagna():
+    """Storicizza la campagna corrente ed eventualmente prepara i contatti per l'anno successivo"""
+    data = request.json or {}
+    anno = data.get('anno')
+    if anno not in (None, ''):
+        try:
+            anno = int(anno)
+        except (TypeError, ValueError):
+            anno = 0
+        if anno < 1:
+            return jsonify({
+                'success': False,
+                'error': f"Parametro anno non valido: {data.get('anno')}"
+            }), 400
+
+    try:
+        result = rollover_campagna(anno=anno, reset=bool(data.get('reset', False)),
+                                   overwrite=bool(data.get('sovrascrivi', False)))
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'message': f"Campagna {result['anno']} storicizzata: {result['contatti']} contatti",
+            'data': result
+        })
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def rollover_campagna(anno=None, reset=False, overwrite=False):
+    """Copia i dati di campagna di tutti i contatti attivi nello storico con un solo INSERT ... SELECT"""
+    settings = dict(db.session.query(Impostazione.chiave, Impostazione.valore)
+                    .filter(Impostazione.chiave.in_(['annoCorrente', 'regaloCorrente'])))
+    anno = int(anno or settings.get('annoCorrente') or datetime.now().year)
+
+    # Una seconda chiusura dello stesso anno (magari dopo l'azzeramento) sovrascriverebbe lo storico
+    if db.session.query(Campagna.id).filter(Campagna.anno == anno).first():
+        if not overwrite:
+            raise ValueError(f"La campagna {anno} è già stata storicizzata")
+        db.session.execute(Campagna.__table__.delete().where(Campagna.anno == anno))
+
+    # La SELECT interna a un INSERT non passa dal filtro automatico per azienda
+    tenant = current_tenant()
+    source = select(
+        literal(tenant), literal(anno), Contatto.id, Contatto.tipo, literal(settings.get('regaloCorrente')),
+        *[getattr(Contatto, field) for field in CAMPAIGN_FIELDS]
+    ).where(Contatto.tenantId == tenant, Contatto.eliminato == False)
+    target_columns = ['tenantId', 'anno', 'contattoId', 'tipo', 'regalo'] + CAMPAIGN_FIELDS
+    count = db.session.execute(Campagna.__table__.insert().from_select(target_columns, source)).rowcount
+
+    result = {'anno': anno, 'contatti': count, 'reset': reset}
+    if reset:
+        result['annoCorrente'] = anno + 1
+        reset_campagna(anno + 1)
+    return result
+
+def reset_campagna(anno):
+    """Azzera i campi di campagna dei contatti attivi e imposta il nuovo anno corrente"""
+    contatti = db.session.query(Contatto.id, Contatto.tipo).filter(Contatto.eliminato == False).all()
+
+    db.session.execute(
+        Contatto.__table__.update()
+        .where(Contatto.eliminato == False)
+        .values(**CAMPAIGN_RESET_VALUES, version=Contatto.version + 1, lastUpdate=datetime.utcnow())
+    )
+    refresh_content_hashes([row.id for row in contatti])
+    record_changes([(row.id, row.tipo, 'update') for row in contatti])
+
+    setting = Impostazione.query.filter_by(chiave='annoCorrente').first()
+    if setting:
+        setting.valore = str(anno)
+    else:
+        db.session.add(Impostazione(chiave='annoCorrente', valore=str(anno)))
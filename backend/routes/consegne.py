@@ -0,0 +1,481 @@
+from flask import Blueprint, Response, request, jsonify, send_file, current_app
+from concurrent.futures import as_completed
+from datetime import datetime
+from itertools import groupby
+from math import ceil
+from sqlalchemy import select, bindparam, func
+import hashlib
+import importlib.util
+import io
+import json
+import re
+import zipfile
+from models import Contatto, Impostazione, db, record_changes
+from indirizzi import normalize_address
+from database import read_only
+from admission import limit_concurrency
+from tenants import current_tenant
+from routes.contatti import refresh_content_hashes
+from routes.excel import get_import_pool
+
+consegne_bp = Blueprint('consegne', __name__)
+
+# reportlab viene importato solo nei processi che generano i PDF
+has_pdf_support = importlib.util.find_spec('reportlab') is not None
+
+# Carico massimo di un consegnatario rispetto alla media (10% in più)
+BALANCE_TOLERANCE = 0.1
+
+# Iterazioni di ricalcolo dei centri delle zone assegnate
+REFINE_ITERATIONS = 3
+
+# Colonne dei fogli di consegna: (campo, intestazione, larghezza)
+SHEET_COLUMNS = [
+    ('nome', 'Nome', 25), ('azienda', 'Azienda', 25), ('indirizzo', 'Indirizzo', 30),
+    ('cap', 'CAP', 7), ('localita', 'Località', 18), ('provincia', 'Prov', 5),
+    ('telefono', 'Telefono', 14), ('regalo', 'Regalo', 18), ('note', 'Note', 25), ('consegnato', 'Consegnato', 12)
+]
+
+# Ultimo archivio generato per (azienda, formato): (chiave dei dati, contenuto ZIP)
+_sheets_cache = {}
+
+@consegne_bp.route('/api/consegne/assegna', methods=['POST'])
+def assign_consegne():
+    """Distribuisce i contatti da consegnare a mano tra i consegnatari, raggruppandoli per zona"""
+    data = request.json or {}
+    dry_run = request.args.get('dry_run', '0').lower() in ['1', 'true']
+
+    try:
+        consegnatari = data.get('consegnatari') or get_consegnatari()
+        if not consegnatari:
+            return jsonify({
+                'success': False,
+                'error': 'Nessun consegnatario configurato'
+            }), 400
+
+        tipi = [data['tipo']] if data.get('tipo') else ['clienti', 'partner']
+        result = plan_consegne(consegnatari, tipi, reassign=bool(data.get('riassegna', False)))
+
+        if not dry_run:
+            write_assignments(result['assignments'])
+            db.session.commit()
+
+        prefix = 'Anteprima assegnazione' if dry_run else 'Assegnazione completata'
+        return jsonify({
+            'success': True,
+            'dry_run': dry_run,
+            'message': f"{prefix}: {len(result['assignments'])} contatti tra {len(consegnatari)} consegnatari",
+            'data': result['summary']
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def get_consegnatari():
+    """Legge l'elenco dei consegnatari dalle impostazioni"""
+    setting = Impostazione.query.filter_by(chiave='consegnatari').first()
+    return json.loads(setting.valore) if setting else []
+
+def plan_consegne(consegnatari, tipi, reassign=False):
+    """Calcola le assegnazioni senza scrivere nulla: restituisce {'assignments': {id: (nome, tipo)}, 'summary': [...]}"""
+    table = Contatto.__table__
+    rows = db.session.execute(
+        select(table.c.id, table.c.tipo, table.c.cap, table.c.localita, table.c.provincia,
+               table.c.indirizzo, table.c.consegnaSpedizione)
+        .where(table.c.tipo.in_(tipi), table.c.eliminato == False, table.c.gls == False, table.c.grappa == True)
+    ).all()
+
+    # Le consegne già assegnate restano e contano nel carico di ciascuno
+    existing = {nome: [] for nome in consegnatari}
+    pending = []
+    for row in rows:
+        current = (row.consegnaSpedizione or '').strip()
+        if current and (not reassign or current not in existing):
+            if current in existing:
+                existing[current].append(row)
+            continue
+        pending.append(row)
+
+    # Zone: contatti con lo stesso CAP e la stessa provincia, a distanza zero tra loro
+    zones = {}
+    def zone_of(row):
+        cap, localita, provincia, _ = normalize_address(row.cap or '', row.localita or '', row.provincia or '')
+        zone = zones.setdefault((cap, provincia), {'localita': set(), 'pending': [], 'existing': {}})
+        zone['localita'].add(localita)
+        return zone
+
+    for row in pending:
+        zone_of(row)['pending'].append(row)
+    for nome, assigned in existing.items():
+        for row in assigned:
+            zone = zone_of(row)
+            zone['existing'][nome] = zone['existing'].get(nome, 0) + 1
+
+    keys = list(zones)
+    distances = distance_table(keys)
+    weights = [len(zones[key]['pending']) for key in keys]
+    loads = [len(existing[nome]) for nome in consegnatari]
+    capacity = ceil((sum(weights) + sum(loads)) / len(consegnatari) * (1 + BALANCE_TOLERANCE))
+
+    centers = initial_centers(keys, zones, weights, distances, consegnatari)
+    for _ in range(REFINE_ITERATIONS):
+        allocation = allocate_zones(weights, loads, distances, centers, capacity)
+        new_centers = [medoid(members, weights, distances) if members else center
+                       for members, center in zip(cluster_members(allocation, len(centers)), centers)]
+        if new_centers == centers:
+            break
+        centers = new_centers
+
+    assignments = {}
+    summary = [{'consegnatario': nome, 'esistenti': len(existing[nome]), 'nuovi': 0, 'localita': set()}
+               for nome in consegnatari]
+    for index, shares in allocation.items():
+        # Contatti della zona ordinati per località e via, così una zona divisa resta compatta
+        contatti = sorted(zones[keys[index]]['pending'], key=lambda row: (row.localita or '', row.indirizzo or ''))
+        for consegnatario, count in shares:
+            for row in contatti[:count]:
+                assignments[row.id] = (consegnatari[consegnatario], row.tipo)
+            contatti = contatti[count:]
+            summary[consegnatario]['nuovi'] += count
+            summary[consegnatario]['localita'].update(zones[keys[index]]['localita'])
+
+    for item in summary:
+        item['totale'] = item['esistenti'] + item['nuovi']
+        item['localita'] = sorted(filter(None, item['localita']))
+    return {'assignments': assignments, 'summary': summary}
+
+def zone_distance(a, b):
+    """Distanza tra due zone (cap, provincia) dalla gerarchia dei CAP: cifre iniziali comuni = zone vicine"""
+    if a == b:
+        return 0
+    cap_a, provincia_a = a
+    cap_b, provincia_b = b
+    if len(cap_a) == 5 and len(cap_b) == 5 and cap_a.isdigit() and cap_b.isdigit():
+        common = 0
+        while common < 5 and cap_a[common] == cap_b[common]:
+            common += 1
+        distance = 5 - common
+        if common == 0:
+            # Aree postali diverse: le prime due cifre crescono grosso modo lungo la penisola
+            distance += abs(int(cap_a[:2]) - int(cap_b[:2])) / 10
+    else:
+        distance = 10
+    if provincia_a and provincia_a == provincia_b:
+        distance = min(distance, 3)
+    return distance
+
+def distance_table(keys):
+    """Precalcola la matrice delle distanze tra tutte le zone"""
+    return [[zone_distance(a, b) for b in keys] for a in keys]
+
+def initial_centers(keys, zones, weights, distances, consegnatari):
+    """Sceglie una zona di partenza per consegnatario: quella già servita, altrimenti la più lontana dalle scelte"""
+    centers = []
+    for nome in consegnatari:
+        served = [(zones[key]['existing'].get(nome, 0), index) for index, key in enumerate(keys)]
+        count, index = max(served, default=(0, None))
+        centers.append(index if count else None)
+
+    for position, center in enumerate(centers):
+        if center is not None or not keys:
+            continue
+        chosen = [c for c in centers if c is not None]
+        if chosen:
+            # Zona con più contatti tra quelle più lontane dai centri già scelti
+            center = max(range(len(keys)), key=lambda i: (min(distances[i][c] for c in chosen), weights[i]))
+        else:
+            center = max(range(len(keys)), key=lambda i: weights[i])
+        centers[position] = center
+    return centers
+
+def allocate_zones(weights, loads, distances, centers, capacity):
+    """Assegna le zone al centro più vicino con capacità residua, dividendo le zone solo se necessario"""
+    loads = list(loads)
+    allocation = {}
+    # Prima le zone con una preferenza netta (più vicine a un centro che agli altri), poi le più numerose
+    def regret(i):
+        nearest = sorted(distances[i][center] for center in centers)
+        return nearest[1] - nearest[0] if len(nearest) > 1 else 0
+
+    for index in sorted(range(len(weights)), key=lambda i: (-regret(i), -weights[i])):
+        remaining = weights[index]
+        if not remaining or not centers:
+            continue
+        order = sorted(range(len(centers)), key=lambda c: (distances[index][centers[c]], loads[c]))
+        fit = next((c for c in order if loads[c] + remaining <= capacity), None)
+        if fit is not None:
+            shares = [(fit, remaining)]
+        else:
+            # Nessuno può prendere tutta la zona: riempi i più vicini e assegna il resto al meno carico
+            shares = []
+            for c in order:
+                take = min(remaining, capacity - loads[c])
+                if take > 0:
+                    shares.append((c, take))
+                    loads[c] += take
+                    remaining -= take
+            if remaining:
+                c = min(range(len(centers)), key=lambda c: loads[c])
+                shares.append((c, remaining))
+                loads[c] += remaining
+            for c, count in shares:
+                loads[c] -= count
+        for c, count in shares:
+            loads[c] += count
+        allocation[index] = shares
+    return allocation
+
+def cluster_members(allocation, count):
+    """Raggruppa le zone assegnate per consegnatario"""
+    members = [[] for _ in range(count)]
+    for index, shares in allocation.items():
+        for c, _ in shares:
+            members[c].append(index)
+    return members
+
+def medoid(members, weights, distances):
+    """Zona che minimizza la distanza pesata dalle altre zone del gruppo"""
+    return min(members, key=lambda i: sum(distances[i][j] * weights[j] for j in members))
+
+def write_assignments(assignments):
+    """Scrive tutte le assegnazioni con un solo UPDATE eseguito in blocco (executemany)"""
+    if not assignments:
+        return
+
+    table = Contatto.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == bindparam('row_id'))
+        .values(consegnaSpedizione=bindparam('row_value'), version=table.c.version + 1, lastUpdate=datetime.utcnow()),
+        [{'row_id': id, 'row_value': nome} for id, (nome, _) in assignments.items()]
+    )
+    refresh_content_hashes(list(assignments))
+    record_changes([(id, tipo, 'update') for id, (_, tipo) in assignments.items()])
+
+@consegne_bp.route('/api/consegne/fogli', methods=['GET'])
+@limit_concurrency
+@read_only
+def delivery_sheets():
+    """Scarica uno ZIP con un foglio di consegna (xlsx o pdf) per ogni consegnatario"""
+    formato = request.args.get('formato', 'xlsx').lower()
+    if formato not in ['xlsx', 'pdf']:
+        return jsonify({
+            'success': False,
+            'error': 'Formato non supportato: usare xlsx o pdf'
+        }), 400
+    if formato == 'pdf' and not has_pdf_support:
+        return jsonify({
+            'success': False,
+            'error': 'Generazione PDF non disponibile su questo server'
+        }), 503
+
+    try:
+        settings = dict(db.session.query(Impostazione.chiave, Impostazione.valore)
+                        .filter(Impostazione.chiave.in_(['annoCorrente', 'regaloCorrente'])))
+        key = delivery_sheets_key(formato, settings)
+        download_name = f"Consegne_{settings['annoCorrente']}.zip" if settings.get('annoCorrente') else 'Consegne.zip'
+
+        # L'archivio resta valido finché i contatti assegnati non cambiano
+        if key in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{key}"'})
+        cached = _sheets_cache.get((current_tenant(), formato))
+        if cached and cached[0] == key:
+            response = send_file(io.BytesIO(cached[1]), mimetype='application/zip',
+                                 as_attachment=True, download_name=download_name)
+            response.set_etag(key)
+            return response
+
+        groups = load_delivery_groups(settings.get('regaloCorrente') or '')
+        if not groups:
+            return jsonify({
+                'success': False,
+                'error': 'Nessun contatto assegnato ai consegnatari'
+            }), 404
+
+        titolo = f"Consegne {settings.get('annoCorrente', '')}".strip()
+        if len(groups) == 1:
+            results = [render_delivery_sheet(*groups[0], formato, titolo)]
+        else:
+            # Un foglio per consegnatario, generati in parallelo e aggiunti allo ZIP appena pronti
+            pool = get_import_pool(current_app.config.get('IMPORT_WORKERS'))
+            results = as_completed([pool.submit(render_delivery_sheet, nome, rows, formato, titolo)
+                                    for nome, rows in groups])
+
+        response = Response(stream_zip(results, formato, key, current_tenant()), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+        response.set_etag(key)
+        return response
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+def delivery_sheets_key(formato, settings):
+    """Impronta dei contatti assegnati: cambia con ogni scrittura che incrementa la versione"""
+    table = Contatto.__table__
+    count, max_id, versions, last_update = db.session.execute(
+        select(func.count(), func.max(table.c.id), func.sum(table.c.version), func.max(table.c.lastUpdate))
+        .where(table.c.eliminato == False, table.c.consegnaSpedizione.isnot(None), table.c.consegnaSpedizione != '')
+    ).one()
+    fingerprint = f"{current_tenant()}|{formato}|{count}|{max_id}|{versions}|{last_update}|{settings.get('annoCorrente')}|{settings.get('regaloCorrente')}"
+    return hashlib.blake2b(fingerprint.encode('utf-8'), digest_size=16).hexdigest()
+
+def load_delivery_groups(regalo):
+    """Legge con una sola query i contatti assegnati, raggruppati per consegnatario e ordinati per zona"""
+    table = Contatto.__table__
+    consegnatario = func.trim(table.c.consegnaSpedizione)
+    rows = db.session.execute(
+        select(consegnatario.label('consegnatario'), table.c.nome, table.c.azienda, table.c.indirizzo, table.c.civico,
+               table.c.cap, table.c.localita, table.c.provincia, table.c.telefono, table.c.note,
+               table.c.grappa, table.c.extraAltro)
+        .where(table.c.eliminato == False, consegnatario.isnot(None), consegnatario != '')
+        .order_by(consegnatario, table.c.provincia, table.c.cap, table.c.localita, table.c.indirizzo, table.c.civico)
+    ).mappings()
+
+    groups = []
+    for nome, items in groupby(rows, key=lambda row: row['consegnatario']):
+        groups.append((nome, [{
+            'nome': row['nome'] or '',
+            'azienda': row['azienda'] or '',
+            'indirizzo': f"{row['indirizzo'] or ''} {row['civico'] or ''}".strip(),
+            'cap': row['cap'] or '',
+            'localita': row['localita'] or '',
+            'provincia': row['provincia'] or '',
+            'telefono': row['telefono'] or '',
+            'regalo': ' + '.join(filter(None, [regalo if row['grappa'] else '', row['extraAltro'] or ''])),
+            'note': row['note'] or '',
+            'consegnato': ''
+        } for row in items]))
+    return groups
+
+def render_delivery_sheet(nome, rows, formato, titolo):
+    """Genera il foglio di un consegnatario (eseguito nei processi del pool); restituisce (nome file, contenuto)"""
+    filename = 'Consegne_' + re.sub(r'[^A-Za-z0-9]+', '_', nome).strip('_')
+    # Intestazione di zona ripetuta a ogni cambio di località
+    areas = [(area, list(items)) for area, items in
+             groupby(rows, key=lambda row: ' '.join(filter(None, [row['cap'], row['localita'], row['provincia'] and f"({row['provincia']})"])))]
+    if formato == 'pdf':
+        return f'{filename}.pdf', render_delivery_pdf(nome, areas, titolo)
+    return f'{filename}.xlsx', render_delivery_xlsx(nome, areas, titolo)
+
+def render_delivery_xlsx(nome, areas, titolo):
+    """Foglio Excel pronto per la stampa, con una sezione per zona"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill
+
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.title = 'Consegne'
+    worksheet.append([f'{titolo} - {nome}'])
+    worksheet['A1'].font = Font(bold=True, size=14)
+    worksheet.append([header for _, header, _ in SHEET_COLUMNS])
+    for cell in worksheet[2]:
+        cell.font = Font(bold=True)
+
+    area_fill = PatternFill('solid', fgColor='DDDDDD')
+    for area, items in areas:
+        worksheet.append([f'{area or "Senza indirizzo"} ({len(items)})'])
+        for cell in worksheet[worksheet.max_row]:
+            cell.font = Font(bold=True)
+            cell.fill = area_fill
+        for row in items:
+            worksheet.append([row[field] for field, _, _ in SHEET_COLUMNS])
+
+    for index, (_, _, width) in enumerate(SHEET_COLUMNS):
+        worksheet.column_dimensions[chr(ord('A') + index)].width = width
+    worksheet.print_title_rows = '2:2'
+    worksheet.page_setup.orientation = 'landscape'
+    worksheet.page_setup.fitToWidth = 1
+    worksheet.page_setup.fitToHeight = 0
+    worksheet.sheet_properties.pageSetUpPr.fitToPage = True
+
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+def render_delivery_pdf(nome, areas, titolo):
+    """Documento PDF A4 orizzontale con una tabella per zona"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    styles = getSampleStyleSheet()
+    cell_style = styles['BodyText'].clone('cella', fontSize=8, leading=9)
+    total_width = sum(width for _, _, width in SHEET_COLUMNS)
+    column_widths = [width / total_width * 277 * mm for _, _, width in SHEET_COLUMNS]
+    table_style = TableStyle([
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.lightgrey),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP')
+    ])
+
+    story = [Paragraph(f'{titolo} - {nome}', styles['Title'])]
+    for area, items in areas:
+        story.append(Paragraph(f'{area or "Senza indirizzo"} ({len(items)})', styles['Heading3']))
+        data = [[header for _, header, _ in SHEET_COLUMNS]]
+        # Paragraph (lento da impaginare) solo per i testi che non stanno nella colonna
+        data += [[Paragraph(escape_pdf(row[field]), cell_style) if len(row[field]) > width else row[field]
+                  for field, _, width in SHEET_COLUMNS] for row in items]
+        table = Table(data, colWidths=column_widths, repeatRows=1)
+        table.setStyle(table_style)
+        story += [table, Spacer(1, 4 * mm)]
+
+    output = io.BytesIO()
+    document = SimpleDocTemplate(output, pagesize=landscape(A4), leftMargin=10 * mm, rightMargin=10 * mm,
+                                 topMargin=10 * mm, bottomMargin=10 * mm, title=f'{titolo} - {nome}')
+    document.build(story)
+    return output.getvalue()
+
+def escape_pdf(value):
+    """Rende sicuro un testo per i Paragraph di reportlab (che interpretano un sottoinsieme di XML)"""
+    return str(value).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+class ZipStreamBuffer:
+    """Destinazione non ricercabile per zipfile: accumula i byte scritti fino al prossimo invio"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(results, formato, key, tenant):
+    """Costruisce lo ZIP man mano che i fogli sono pronti e lo salva in cache al termine"""
+    buffer = ZipStreamBuffer()
+    parts = []
+    names = set()
+    # Gli xlsx sono già compressi: memorizzarli senza ricomprimerli risparmia CPU
+    compression = zipfile.ZIP_STORED if formato == 'xlsx' else zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        for result in results:
+            filename, content = result if isinstance(result, tuple) else result.result()
+            base, extension = filename.rsplit('.', 1)
+            counter = 2
+            while filename in names:
+                filename = f'{base}_{counter}.{extension}'
+                counter += 1
+            names.add(filename)
+            archive.writestr(filename, content)
+            data = buffer.pop()
+            parts.append(data)
+            yield data
+    parts.append(buffer.pop())
+    yield parts[-1]
+    _sheets_cache[(tenant, formato)] = (key, b''.join(parts))
@@ -1,74 +1,79 @@
 from flask import Blueprint, request, jsonify
-from sqlalchemy import or_
+from sqlalchemy import or_, select, bindparam
 from datetime import datetime
-from models import Contatto, db
+from models import Contatto, ContattoEliminato, db, compute_content_hash, move_contatti, record_changes, HASH_FIELDS
+from instrumentation import timed
+from database import read_only
+from idempotency import idempotent
 
 contatti_bp = Blueprint('contatti', __name__)
 
+# Campi gestiti dal server che il client non può sovrascrivere (il cestino passa dalle sue route)
+SERVER_FIELDS = {'id', 'createdAt', 'lastUpdate', 'eliminato', 'eliminatoIl', 'contentHash', 'version', 'tenantId'}
+WRITABLE_FIELDS = {column.name for column in Contatto.__table__.columns} - SERVER_FIELDS
+
+# Numero massimo di ID per singola clausola IN
+ID_CHUNK_SIZE = 500
+
+# Insiemi di campi per ?fields=, combinabili tra loro e con i nomi dei singoli campi (None: tutti)
+FIELD_PRESETS = {
+    'table': ['tipo', 'nome', 'azienda', 'indirizzo', 'civico', 'cap', 'localita', 'provincia', 'telefono',
+              'email', 'tipologia', 'grappa', 'consegnaSpedizione', 'gls'],
+    'shipping': ['tipo', 'nome', 'azienda', 'indirizzo', 'civico', 'cap', 'localita', 'provincia', 'telefono',
+                 'grappa', 'consegnaSpedizione', 'gls'],
+    'trash': ['tipo', 'nome', 'azienda', 'localita', 'eliminatoIl'],
+    'full': None
+}
+
+# Campi sempre restituiti: identificano il contatto e servono per salvarlo
+REQUIRED_FIELDS = ['id', 'version']
+
 # Carica contatti (clienti o partner)
 @contatti_bp.route('/api/<string:tipo>', methods=['GET'])
+@read_only
 def get_contatti(tipo):
-    """Recupera i contatti in base al tipo (clienti o partner)"""
+    """Recupera i contatti in base al tipo (clienti o partner), limitati ai campi richiesti"""
     include_eliminati = request.args.get('include_eliminati', 'false').lower() == 'true'
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     
-    # Query di base
-    query = Contatto.query.filter_by(tipo=tipo)
-    
-    # Filtra eliminati se richiesto
-    if not include_eliminati:
-        query = query.filter_by(eliminato=False)
-        
-    contatti = query.all()
+    # La tabella principale contiene solo contatti attivi, quelli eliminati sono nell'archivio
+    data = load_fields(Contatto, fields, Contatto.tipo == tipo)
+    if include_eliminati:
+        data += load_fields(ContattoEliminato, fields, ContattoEliminato.tipo == tipo)
     return jsonify({
         'success': True,
-        'data': [contatto.to_dict() for contatto in contatti]
+        'data': data
     })
 
 # Salva contatti (clienti o partner)
 @contatti_bp.route('/api/<string:tipo>', methods=['POST'])
+@idempotent
 def save_contatti(tipo):
-    """Salva l'elenco completo di contatti"""
+    """Salva l'elenco di contatti; vanno nel cestino solo quelli inviati con eliminato=true"""
     data = request.json
     
     try:
-        # Rimuovi tutti i contatti esistenti non eliminati di questo tipo
-        existing = Contatto.query.filter_by(tipo=tipo, eliminato=False).all()
-        existing_ids = {contatto.id for contatto in existing}
+        # I contatti assenti dall'elenco non vengono eliminati: possono essere stati creati
+        # da altri utenti dopo che il client ha caricato l'elenco
+        to_archive = [item for item in data if item.get('id') and item.get('eliminato') in [True, 1, '1']]
+        archive_ids = {item['id'] for item in to_archive}
         
-        # IDs nei nuovi dati
-        new_ids = {item.get('id') for item in data if item.get('id')}
+        # Sposta nel cestino i contatti indicati, se non modificati da altri nel frattempo
+        conflicts = archive_unchanged(to_archive, tipo)
         
-        # Identifica record da eliminare (quelli che esistono ma non sono nei nuovi dati)
-        to_delete_ids = existing_ids - new_ids
+        # Aggiorna o crea i record, verificando la versione di quelli modificati
+        conflicts += apply_changes([item for item in data if item.get('id') not in archive_ids], tipo)
         
-        # Segna come eliminati i record che non sono più nell'elenco
-        for id in to_delete_ids:
-            contatto = Contatto.query.get(id)
-            if contatto:
-                contatto.eliminato = True
-                contatto.eliminatoIl = datetime.utcnow()
-                
-        # Aggiorna o crea nuovi record
-        for item in data:
-            # Verifica se l'ID esiste
-            if item.get('id'):
-                contatto = Contatto.query.get(item['id'])
-                if contatto:
-                    # Aggiorna record esistente
-                    for key, value in item.items():
-                        if key != 'id' and hasattr(contatto, key):
-                            # Gestione speciale per grappa e gls (possono essere "1", 1, o True)
-                            if key in ['grappa', 'gls']:
-                                setattr(contatto, key, value in [True, 1, '1'])
-                            else:
-                                setattr(contatto, key, value)
-                    contatto.lastUpdate = datetime.utcnow()
-                else:
-                    # Crea nuovo contatto con ID specifico
-                    create_contatto(item, tipo)
-            else:
-                # Crea nuovo contatto senza ID
-                create_contatto(item, tipo)
+        # In caso di conflitto non viene salvato niente: il client unisce e reinvia l'elenco
+        if conflicts:
+            db.session.rollback()
+            return conflict_response(conflicts)
         
         db.session.commit()
         
@@ -89,18 +94,13 @@ def save_contatti(tipo):
 # Sposta un contatto negli eliminati
 @contatti_bp.route('/api/move-to-eliminati/<string:tipo>/<int:id>', methods=['POST'])
 def move_to_eliminati(tipo, id):
-    """Segna un contatto come eliminato"""
+    """Sposta un contatto nel cestino"""
     try:
-        contatto = Contatto.query.get(id)
-        if not contatto:
+        if not archive_contatti([id]):
             return jsonify({
                 'success': False,
                 'error': f'Contatto con ID {id} non trovato'
             }), 404
-            
-        # Segna il contatto come eliminato
-        contatto.eliminato = True
-        contatto.eliminatoIl = datetime.utcnow()
         db.session.commit()
         
         return jsonify({'success': True})
@@ -116,16 +116,12 @@ def move_to_eliminati(tipo, id):
 def restore_from_eliminati(id):
     """Ripristina un contatto dagli eliminati"""
     try:
-        contatto = Contatto.query.get(id)
-        if not contatto:
+        # Un contatto già attivo non ha nulla da ripristinare
+        if not restore_contatti([id]) and not db.session.get(Contatto, id):
             return jsonify({
                 'success': False,
                 'error': f'Contatto con ID {id} non trovato'
             }), 404
-            
-        # Ripristina il contatto
-        contatto.eliminato = False
-        contatto.eliminatoIl = None
         db.session.commit()
         
         return jsonify({'success': True})
@@ -152,20 +148,8 @@ def update_bulk(tipo):
         }), 400
         
     try:
-        # Ottieni tutti i contatti corrispondenti
-        contatti = Contatto.query.filter(
-            Contatto.id.in_(ids),
-            Contatto.tipo == tipo
-        ).all()
-        
-        for contatto in contatti:
-            if hasattr(contatto, propertyName):
-                # Gestione speciale per grappa e gls (possono essere "1", 1, o True)
-                if propertyName in ['grappa', 'gls']:
-                    setattr(contatto, propertyName, propertyValue in [True, 1, '1'])
-                else:
-                    setattr(contatto, propertyName, propertyValue)
-                contatto.lastUpdate = datetime.utcnow()
+        # Un UPDATE per blocco di ID, senza caricare i contatti
+        update_property(ids, tipo, propertyName, propertyValue)
         
         db.session.commit()
         
@@ -184,12 +168,21 @@ def update_bulk(tipo):
 
 # Ottieni l'elenco degli eliminati
 @contatti_bp.route('/api/eliminati', methods=['GET'])
+@read_only
 def get_eliminati():
-    """Recupera tutti i contatti eliminati"""
-    contatti = Contatto.query.filter_by(eliminato=True).all()
+    """Recupera tutti i contatti eliminati, limitati ai campi richiesti"""
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    data = load_fields(ContattoEliminato, fields)
     return jsonify({
         'success': True,
-        'data': [contatto.to_dict() for contatto in contatti]
+        'data': data
     })
 
 # Svuota il cestino (elimina definitivamente)
@@ -197,7 +190,8 @@ def get_eliminati():
 def empty_trash():
     """Elimina definitivamente tutti i contatti nel cestino"""
     try:
-        Contatto.query.filter_by(eliminato=True).delete()
+        # L'uscita dalla tabella principale è già stata registrata nel feed al momento dello spostamento
+        ContattoEliminato.query.delete()
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -212,7 +206,7 @@ def empty_trash():
 def delete_permanently(id):
     """Elimina definitivamente un contatto specifico"""
     try:
-        contatto = Contatto.query.get(id)
+        contatto = db.session.get(ContattoEliminato, id) or db.session.get(Contatto, id)
         if not contatto:
             return jsonify({
                 'success': False,
@@ -229,23 +223,210 @@ def delete_permanently(id):
             'error': str(e)
         }), 500
 
+def parse_fields(value):
+    """Traduce il parametro fields (preset e/o campi separati da virgole) nelle colonne da leggere"""
+    all_fields = [column.name for column in Contatto.__table__.columns]
+    if not value:
+        return all_fields
+    
+    requested = set(REQUIRED_FIELDS)
+    unknown = []
+    for name in value.split(','):
+        name = name.strip()
+        if name in FIELD_PRESETS:
+            requested.update(FIELD_PRESETS[name] or all_fields)
+        elif name in all_fields:
+            requested.add(name)
+        elif name:
+            unknown.append(name)
+    if unknown:
+        raise ValueError(f"Campi sconosciuti: {', '.join(unknown)}")
+    
+    # Ordine delle colonne della tabella, come nell'elenco completo
+    return [name for name in all_fields if name in requested]
+
+def load_fields(model, fields, *criteria, session=None):
+    """Legge solo le colonne indicate e le restituisce come dizionari pronti per il JSON"""
+    rows = (session or db.session).query(*[getattr(model, name) for name in fields]).filter(*criteria).all()
+    with timed('serialize'):
+        return [
+            {name: value.isoformat() if isinstance(value, datetime) else value for name, value in zip(fields, row)}
+            for row in rows
+        ]
+
 # Funzione di utilità per creare un contatto
 def create_contatto(data, tipo):
     """Crea un nuovo contatto dal dizionario di dati"""
     contatto = Contatto(tipo=tipo)
     
-    # Imposta gli attributi dal dizionario
-    for key, value in data.items():
-        if hasattr(contatto, key):
-            # Gestione speciale per grappa e gls (possono essere "1", 1, o True)
-            if key in ['grappa', 'gls']:
-                setattr(contatto, key, value in [True, 1, '1'])
-            else:
-                setattr(contatto, key, value)
+    # Imposta gli attributi dal dizionario (l'ID solo se indicato esplicitamente)
+    if data.get('id'):
+        contatto.id = data['id']
+    for key, value in contatto_values(data).items():
+        setattr(contatto, key, value)
     
     # Imposta timestamp di creazione
     contatto.createdAt = datetime.utcnow()
     contatto.lastUpdate = datetime.utcnow()
     
     db.session.add(contatto)
-    return contatto
\ No newline at end of file
+    return contatto
+
+def contatto_values(data):
+    """Estrae dal dizionario i campi modificabili dal client, normalizzando i booleani"""
+    values = {}
+    for key, value in data.items():
+        if key in WRITABLE_FIELDS:
+            # Gestione speciale per grappa e gls (possono essere "1", 1, o True)
+            values[key] = value in [True, 1, '1'] if key in ['grappa', 'gls'] else value
+    return values
+
+def apply_changes(data, tipo):
+    """Aggiorna o crea i contatti inviati; restituisce gli ID in conflitto di versione"""
+    now = datetime.utcnow()
+    
+    # Carica in blocco i contatti esistenti invece di un Contatto.query.get per riga
+    ids = [item['id'] for item in data if item.get('id')]
+    current = {}
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        for contatto in Contatto.query.filter(Contatto.id.in_(ids[start:start + ID_CHUNK_SIZE])):
+            current[contatto.id] = contatto
+    
+    # Contatti spostati nel cestino da un altro utente: l'elenco del client non li ricrea
+    archived = set()
+    missing = [id for id in ids if id not in current]
+    for start in range(0, len(missing), ID_CHUNK_SIZE):
+        archived.update(id for id, in db.session.query(ContattoEliminato.id).filter(
+            ContattoEliminato.id.in_(missing[start:start + ID_CHUNK_SIZE])))
+    
+    conflicts = []
+    updated = []
+    for item in data:
+        contatto = current.get(item.get('id')) if item.get('id') else None
+        if contatto is None:
+            if item.get('id') not in archived:
+                create_contatto(item, tipo)
+            continue
+        
+        # Senza versione (client non aggiornati) vale l'ultima scrittura
+        expected_version = item.get('version') or contatto.version
+        if expected_version != contatto.version:
+            conflicts.append(contatto.id)
+            continue
+        
+        values = contatto_values(item)
+        content_hash = compute_content_hash({**contatto.hash_values(), **values})
+        other_changes = any(getattr(contatto, key) != value for key, value in values.items() if key not in HASH_FIELDS)
+        if content_hash == contatto.contentHash and not other_changes:
+            # Nessuna modifica reale: evita la scrittura
+            continue
+        
+        # Un solo UPDATE condizionato sulla versione: se nel frattempo un altro utente
+        # ha salvato il contatto non viene aggiornata nessuna riga
+        result = db.session.execute(
+            Contatto.__table__.update()
+            .where(Contatto.id == contatto.id, Contatto.version == expected_version)
+            .values(**values, version=expected_version + 1, lastUpdate=now, contentHash=content_hash)
+        )
+        if result.rowcount == 0:
+            conflicts.append(contatto.id)
+        else:
+            updated.append((contatto.id, values.get('tipo', contatto.tipo), 'update'))
+    
+    # Gli UPDATE diretti non passano dall'ORM: registra le modifiche esplicitamente
+    record_changes(updated)
+    return conflicts
+
+def update_property(ids, tipo, property_name, property_value):
+    """Imposta lo stesso valore su più contatti incrementandone la versione"""
+    if property_name not in WRITABLE_FIELDS:
+        return
+    
+    values = contatto_values({property_name: property_value})
+    values['version'] = Contatto.version + 1
+    values['lastUpdate'] = datetime.utcnow()
+    updated = []
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        # Solo i contatti attivi dell'azienda e del tipo indicati: gli altri ID non entrano nel feed
+        matched = [id for id, in db.session.query(Contatto.id).filter(
+            Contatto.id.in_(ids[start:start + ID_CHUNK_SIZE]), Contatto.tipo == tipo)]
+        if matched:
+            db.session.execute(Contatto.__table__.update().where(Contatto.id.in_(matched)).values(**values))
+            updated.extend(matched)
+    
+    record_changes([(id, tipo, 'update') for id in updated])
+    
+    if property_name in HASH_FIELDS:
+        refresh_content_hashes(updated)
+
+def archive_unchanged(items, tipo):
+    """Sposta nel cestino i contatti inviati se la loro versione è ancora quella del client; restituisce gli ID in conflitto"""
+    expected = {item['id']: item.get('version') for item in items}
+    ids = list(expected)
+    conflicts = []
+    unchanged = []
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        rows = db.session.query(Contatto.id, Contatto.version).filter(
+            Contatto.id.in_(ids[start:start + ID_CHUNK_SIZE]), Contatto.tipo == tipo).with_for_update()
+        for row in rows:
+            # Senza versione (client non aggiornati) vale l'ultima scrittura
+            if expected[row.id] and expected[row.id] != row.version:
+                conflicts.append(row.id)
+            else:
+                unchanged.append(row.id)
+    archive_contatti(unchanged)
+    return conflicts
+
+def archive_contatti(ids):
+    """Sposta i contatti indicati nel cestino; restituisce (id, tipo) di quelli spostati"""
+    return transfer_contatti(Contatto, ContattoEliminato, ids, 'delete',
+                             {'eliminato': True, 'eliminatoIl': datetime.utcnow(), 'lastUpdate': datetime.utcnow()})
+
+def restore_contatti(ids):
+    """Riporta i contatti indicati dal cestino alla tabella principale; restituisce (id, tipo) di quelli spostati"""
+    return transfer_contatti(ContattoEliminato, Contatto, ids, 'insert',
+                             {'eliminato': False, 'eliminatoIl': None, 'lastUpdate': datetime.utcnow()})
+
+def transfer_contatti(source, target, ids, operazione, values):
+    """Sposta i contatti esistenti dell'azienda corrente tra tabella principale e archivio, registrandoli nel feed"""
+    moved = []
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        rows = db.session.query(source.id, source.tipo).filter(source.id.in_(ids[start:start + ID_CHUNK_SIZE])).all()
+        if rows:
+            # Solo gli ID letti sopra, già filtrati per azienda
+            move_contatti(source.__table__, target.__table__, source.id.in_([row.id for row in rows]), values)
+            moved.extend(rows)
+    record_changes([(row.id, row.tipo, operazione) for row in moved])
+    return moved
+
+def refresh_content_hashes(ids, table=Contatto.__table__, execution_options=None):
+    """Ricalcola l'hash del contenuto dei contatti modificati con istruzioni SQL dirette"""
+    columns = [table.c[field] for field in HASH_FIELDS]
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        rows = db.session.execute(
+            select(table.c.id, *columns).where(table.c.id.in_(ids[start:start + ID_CHUNK_SIZE])),
+            execution_options=execution_options
+        ).mappings().all()
+        if rows:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values(contentHash=bindparam('row_hash')),
+                [{'row_id': row['id'], 'row_hash': compute_content_hash(row)} for row in rows],
+                execution_options=execution_options
+            )
+
+def backfill_content_hashes():
+    """Calcola l'hash dei contatti di tutte le aziende che non lo hanno ancora (righe precedenti alla colonna)"""
+    options = {'all_tenants': True}
+    for table in [Contatto.__table__, ContattoEliminato.__table__]:
+        ids = list(db.session.execute(select(table.c.id).where(table.c.contentHash.is_(None)),
+                                      execution_options=options).scalars())
+        refresh_content_hashes(ids, table, execution_options=options)
+
+def conflict_response(conflict_ids):
+    """Risposta 409 con la versione attuale dei soli contatti in conflitto"""
+    contatti = Contatto.query.filter(Contatto.id.in_(conflict_ids)).populate_existing().all()
+    return jsonify({
+        'success': False,
+        'error': f'{len(contatti)} contatti sono stati modificati da un altro utente',
+        'conflicts': [contatto.to_dict() for contatto in contatti]
+    }), 409
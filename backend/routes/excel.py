@@ -1,29 +1,53 @@
-from flask import Blueprint, request, jsonify, send_file
-import pandas as pd
-import numpy as np
+from flask import Blueprint, request, jsonify, send_file, current_app
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import io
-import openpyxl
-from openpyxl.workbook import Workbook
 from datetime import datetime
 import json
 import os
-from models import Contatto, db
-from werkzeug.utils import secure_filename
+import time
+import csv
+import codecs
+from functools import lru_cache
+from models import Contatto, db, compute_content_hash, normalize_hash_value
+from metrics import IMPORT_ROWS_PER_SECOND, EXPORT_BUILD_TIME
+from indirizzi import correct_addresses
+from database import read_only
+from admission import limit_concurrency
+from idempotency import idempotent
 
+# pandas, numpy e openpyxl vengono importati solo nelle funzioni che li usano:
+# caricarli all'avvio rallenta il boot e aumenta la memoria di ogni worker
 excel_bp = Blueprint('excel', __name__)
 
 # Configurazione per l'upload di file
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../uploads')
-ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
+ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv', 'ndjson', 'jsonl'}
 
-# Assicurati che la cartella per gli upload esista
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Tipi di contatto ammessi per i fogli importati
+CONTACT_TIPI = ('clienti', 'partner')
+
+# Formati testuali letti riga per riga senza passare da pandas
+TEXT_FORMATS = {'csv': 'csv', 'ndjson': 'ndjson', 'jsonl': 'ndjson'}
+
+# Byte analizzati per riconoscere codifica e dialetto dei CSV
+SNIFF_SIZE = 64 * 1024
+
+# Firme iniziali dei formati Excel: xlsx è un archivio ZIP, xls un documento OLE2
+EXCEL_SIGNATURES = {
+    b'PK\x03\x04': 'openpyxl',
+    b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1': 'xlrd'
+}
+
+# Pool di processi per la lettura dei fogli, creato al primo import multiplo
+_import_pool = None
 
 def allowed_file(filename):
     """Controlla se l'estensione del file è consentita"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 @excel_bp.route('/api/import-excel/<string:tipo>', methods=['POST'])
+@idempotent
+@limit_concurrency
 def import_excel(tipo):
     """Importa dati da un file Excel"""
     if 'file' not in request.files:
@@ -42,163 +66,203 @@ def import_excel(tipo):
     if not allowed_file(file.filename):
         return jsonify({
             'success': False,
-            'message': 'Formato file non supportato. Utilizzare .xlsx o .xls'
+            'message': 'Formato file non supportato. Utilizzare .xlsx, .xls, .csv o .ndjson'
         }), 400
     
+    # Riconosci il formato dai primi byte invece che dall'estensione
+    import_format = detect_import_format(file.stream, file.filename)
+    if import_format is None:
+        return jsonify({
+            'success': False,
+            'message': 'Il file caricato non è un documento Excel valido'
+        }), 400
+    
+    start = time.perf_counter()
     try:
-        # Salva temporaneamente il file
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
-        
-        # Determina quale foglio utilizzare
-        xls = pd.ExcelFile(file_path)
-        sheet_name = determine_sheet_name(xls.sheet_names, tipo)
-        
-        # Leggi il file Excel
-        df = pd.read_excel(file_path, sheet_name=sheet_name)
+        # Leggi e normalizza i dati direttamente dallo stream caricato, senza passare dal disco
+        normalized_data = read_import_records(file.stream, tipo, import_format)
         
-        # Normalizza i dati
-        normalized_data = normalize_excel_data(df, tipo)
+        # Corregge CAP, località e provincia con l'indice dei comuni
+        addresses = {}
+        normalized_data = correct_addresses(normalized_data, addresses)
         
-        # Rimuovi il file temporaneo
-        os.remove(file_path)
+        # Modalità anteprima: calcola le differenze senza scrivere nulla
+        dry_run = request.args.get('dry_run', '0').lower() in ['1', 'true']
         
-        # Carica i dati esistenti
-        existing_data = Contatto.query.filter_by(tipo=tipo, eliminato=False).all()
-        existing_dict = {(c.nome.lower(), c.azienda.lower() if c.azienda else ''): c for c in existing_data if c.nome}
+        report = apply_import(normalized_data, tipo, dry_run=dry_run)
         
-        # Elabora i dati importati
-        new_records = 0
-        updated_records = 0
-        processed_records = []
+        if dry_run:
+            return jsonify({
+                'success': True,
+                'dry_run': True,
+                'message': (f'Anteprima importazione: {len(report["new"])} nuovi record, '
+                            f'{len(report["changed"])} record modificati, {report["unchanged"]} invariati'),
+                'diff': report,
+                'indirizzi': addresses
+            })
         
-        for item in normalized_data:
-            nome = item.get('nome', '').strip()
-            azienda = item.get('azienda', '').strip()
-            
-            if not nome and not azienda:
-                continue
-                
-            key = (nome.lower(), azienda.lower())
-            
-            if key in existing_dict:
-                # Aggiorna record esistente
-                record = existing_dict[key]
-                for field, value in item.items():
-                    if field not in ['id', 'createdAt', 'eliminato', 'eliminatoIl']:
-                        # Gestione speciale per campi booleani
-                        if field in ['grappa', 'gls']:
-                            setattr(record, field, value in [True, 1, '1'])
-                        else:
-                            setattr(record, field, value)
-                record.lastUpdate = datetime.utcnow()
-                updated_records += 1
-                processed_records.append(record.to_dict())
-            else:
-                # Crea nuovo record
-                record = Contatto(tipo=tipo)
-                for field, value in item.items():
-                    if field not in ['id', 'createdAt', 'eliminato', 'eliminatoIl']:
-                        # Gestione speciale per campi booleani
-                        if field in ['grappa', 'gls']:
-                            setattr(record, field, value in [True, 1, '1'])
-                        else:
-                            setattr(record, field, value)
-                record.createdAt = datetime.utcnow()
-                record.lastUpdate = datetime.utcnow()
-                db.session.add(record)
-                new_records += 1
-                
         # Salva le modifiche
         db.session.commit()
+        observe_import(report, time.perf_counter() - start, import_format)
         
         # Ottieni dati aggiornati
         updated_data = Contatto.query.filter_by(tipo=tipo, eliminato=False).all()
         
         return jsonify({
             'success': True,
-            'message': f'Importazione completata: {new_records} nuovi record, {updated_records} record aggiornati',
-            'data': [item.to_dict() for item in updated_data]
+            'message': (f'Importazione completata: {len(report["new"])} nuovi record, '
+                        f'{len(report["changed"])} record aggiornati, {report["unchanged"]} invariati'),
+            'data': [item.to_dict() for item in updated_data],
+            'indirizzi': addresses
         })
         
     except Exception as e:
         db.session.rollback()
-        # Assicurati che il file temporaneo venga eliminato anche in caso di errore
-        if 'file_path' in locals() and os.path.exists(file_path):
-            os.remove(file_path)
+        return jsonify({
+            'success': False,
+            'message': f'Errore durante l\'importazione: {str(e)}'
+        }), 500
+
+@excel_bp.route('/api/import-excel-batch', methods=['POST'])
+@idempotent
+@limit_concurrency
+def import_excel_batch():
+    """Importa più file e fogli in un'unica transazione, assegnando ogni foglio al suo tipo"""
+    import pandas as pd
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({
+            'success': False,
+            'message': 'Nessun file caricato'
+        }), 400
+    
+    start = time.perf_counter()
+    
+    # Tipo da usare per i fogli il cui nome non indica né clienti né partner
+    default_tipo = request.form.get('tipo') or request.args.get('tipo')
+    if default_tipo and default_tipo not in CONTACT_TIPI:
+        return jsonify({
+            'success': False,
+            'message': f'Tipo non valido: {default_tipo} (usare clienti o partner)'
+        }), 400
+    dry_run = request.args.get('dry_run', '0').lower() in ['1', 'true']
+    
+    # Individua i fogli da importare in ogni file
+    tasks = []
+    skipped = []
+    for file in files:
+        engine = detect_import_format(file.stream, file.filename) if allowed_file(file.filename) else None
+        if engine is None:
+            return jsonify({
+                'success': False,
+                'message': f'Il file {file.filename} non è un documento Excel valido'
+            }), 400
+        
+        content = file.stream.read()
+        
+        # I file CSV e NDJSON non hanno fogli: il tipo si ricava dal nome del file
+        if engine in TEXT_FORMATS.values():
+            tipo = determine_sheet_tipo(file.filename, default_tipo)
+            if not tipo:
+                return jsonify({
+                    'success': False,
+                    'message': f'Impossibile determinare il tipo del file {file.filename}: indicare tipo=clienti o tipo=partner'
+                }), 400
+            tasks.append((file.filename, None, tipo, content, engine))
+            continue
+        
+        with pd.ExcelFile(io.BytesIO(content), engine=engine) as xls:
+            sheet_names = xls.sheet_names
+        
+        for sheet_name in sheet_names:
+            tipo = determine_sheet_tipo(sheet_name, default_tipo)
+            if tipo:
+                tasks.append((file.filename, sheet_name, tipo, content, engine))
+            else:
+                skipped.append({'file': file.filename, 'sheet': sheet_name})
+    
+    if not tasks:
+        return jsonify({
+            'success': False,
+            'message': 'Nessun foglio riconosciuto come Clienti o Partner',
+            'skipped': skipped
+        }), 400
+    
+    # Leggi e normalizza i fogli in parallelo (la lettura è limitata dalla CPU)
+    try:
+        if len(tasks) == 1:
+            parsed = [parse_sheet(*tasks[0][1:])]
+        else:
+            pool = get_import_pool(current_app.config.get('IMPORT_WORKERS'))
+            futures = [pool.submit(parse_sheet, sheet_name, tipo, content, engine)
+                       for _, sheet_name, tipo, content, engine in tasks]
+            parsed = [future.result() for future in futures]
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Errore durante la lettura dei fogli: {str(e)}'
+        }), 400
+    
+    try:
+        # Applica tutti i fogli nella stessa transazione
+        sheets = []
+        addresses = {}
+        for (filename, sheet_name, tipo, _, _), normalized_data in zip(tasks, parsed):
+            report = apply_import(correct_addresses(normalized_data, addresses), tipo, dry_run=dry_run)
+            sheets.append({
+                'file': filename,
+                'sheet': sheet_name,
+                'tipo': tipo,
+                'new': len(report['new']),
+                'changed': len(report['changed']),
+                'unchanged': report['unchanged'],
+                'diff': report if dry_run else None
+            })
+        
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
         
+        totals = {key: sum(sheet[key] for sheet in sheets) for key in ['new', 'changed', 'unchanged']}
+        if not dry_run:
+            observe_import(totals, time.perf_counter() - start, 'batch')
+        prefix = 'Anteprima importazione' if dry_run else 'Importazione completata'
+        return jsonify({
+            'success': True,
+            'dry_run': dry_run,
+            'message': (f'{prefix}: {len(sheets)} fogli, {totals["new"]} nuovi record, '
+                        f'{totals["changed"]} record aggiornati, {totals["unchanged"]} invariati'),
+            'totals': totals,
+            'sheets': sheets,
+            'skipped': skipped,
+            'indirizzi': addresses
+        })
+    
+    except Exception as e:
+        db.session.rollback()
         return jsonify({
             'success': False,
             'message': f'Errore durante l\'importazione: {str(e)}'
         }), 500
 
 @excel_bp.route('/api/export-gls', methods=['GET'])
+@limit_concurrency
+@read_only
 def export_gls():
     """Esporta i dati per GLS"""
+    start = time.perf_counter()
     try:
-        # Ottieni tutti i record con GLS=True
-        clienti = Contatto.query.filter_by(tipo='clienti', gls=True, eliminato=False).all()
-        partner = Contatto.query.filter_by(tipo='partner', gls=True, eliminato=False).all()
-        
-        # Unisci i dati
-        all_records = clienti + partner
+        all_records = load_gls_records()
         
         if not all_records:
             return jsonify({
                 'success': False,
                 'message': 'Nessun record da esportare per GLS'
             }), 404
-            
-        # Crea DataFrame per l'export
-        gls_data = []
-        for record in all_records:
-            # Determina il nome del destinatario (priorità all'azienda)
-            nome_destinatario = record.azienda if record.azienda else record.nome
-            
-            # Combina indirizzo e civico
-            indirizzo = f"{record.indirizzo or ''} {record.civico or ''}".strip()
-            
-            gls_data.append({
-                'NOME DESTINATARIO': nome_destinatario,
-                'INDIRIZZO': indirizzo,
-                'LOCALITA\'': record.localita or '',
-                'PROV': record.provincia or '',
-                'CAP': record.cap or '',
-                'TIPO MERCE': 'OMAGGIO NATALIZIO',
-                'COLLI': '1',
-                'NOTE SPEDIZIONE': record.note or '',
-                'RIFERIMENTO MITTENTE': record.nome or '',
-                'TELEFONO': record.telefono or ''
-            })
-            
-        # Crea Excel in memoria
-        output = io.BytesIO()
-        
-        df = pd.DataFrame(gls_data)
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Spedizioni GLS', index=False)
-            
-            # Imposta la larghezza delle colonne
-            worksheet = writer.sheets['Spedizioni GLS']
-            col_widths = {
-                'A': 30,  # NOME DESTINATARIO
-                'B': 40,  # INDIRIZZO
-                'C': 20,  # LOCALITA
-                'D': 5,   # PROV
-                'E': 10,  # CAP
-                'F': 20,  # TIPO MERCE
-                'G': 5,   # COLLI
-                'H': 30,  # NOTE SPEDIZIONE
-                'I': 25,  # RIFERIMENTO MITTENTE
-                'J': 15   # TELEFONO
-            }
-            
-            for col, width in col_widths.items():
-                worksheet.column_dimensions[col].width = width
         
-        # Reimposta il puntatore all'inizio del file
-        output.seek(0)
+        output = build_gls_workbook(all_records)
+        EXPORT_BUILD_TIME.observe(time.perf_counter() - start, export='gls')
         
         # Restituisci il file
         return send_file(
@@ -214,6 +278,270 @@ def export_gls():
             'message': f'Errore durante l\'esportazione: {str(e)}'
         }), 500
 
+def load_gls_records(session=None):
+    """Contatti attivi da spedire con GLS, prima i clienti e poi i partner"""
+    query = (session or db.session).query(Contatto).filter_by(gls=True, eliminato=False)
+    return query.filter_by(tipo='clienti').all() + query.filter_by(tipo='partner').all()
+
+def build_gls_workbook(all_records):
+    """Crea in memoria il file Excel per GLS, con il foglio degli indirizzi da verificare"""
+    import pandas as pd
+    
+    # Corregge CAP, località e provincia prima dell'invio al corriere
+    addresses = {}
+    records = correct_addresses(
+        ({'nome': record.nome, 'azienda': record.azienda, 'gls': True,
+          'cap': record.cap, 'localita': record.localita, 'provincia': record.provincia} for record in all_records),
+        addresses
+    )
+    
+    # Crea DataFrame per l'export
+    gls_data = []
+    for record, address in zip(all_records, records):
+        # Determina il nome del destinatario (priorità all'azienda)
+        nome_destinatario = record.azienda if record.azienda else record.nome
+        
+        # Combina indirizzo e civico
+        indirizzo = f"{record.indirizzo or ''} {record.civico or ''}".strip()
+        
+        gls_data.append({
+            'NOME DESTINATARIO': nome_destinatario,
+            'INDIRIZZO': indirizzo,
+            'LOCALITA\'': address['localita'] or '',
+            'PROV': address['provincia'] or '',
+            'CAP': address['cap'] or '',
+            'TIPO MERCE': 'OMAGGIO NATALIZIO',
+            'COLLI': '1',
+            'NOTE SPEDIZIONE': record.note or '',
+            'RIFERIMENTO MITTENTE': record.nome or '',
+            'TELEFONO': record.telefono or ''
+        })
+        
+    # Crea Excel in memoria
+    output = io.BytesIO()
+    
+    df = pd.DataFrame(gls_data)
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Spedizioni GLS', index=False)
+        
+        # Imposta la larghezza delle colonne
+        worksheet = writer.sheets['Spedizioni GLS']
+        col_widths = {
+            'A': 30,  # NOME DESTINATARIO
+            'B': 40,  # INDIRIZZO
+            'C': 20,  # LOCALITA
+            'D': 5,   # PROV
+            'E': 10,  # CAP
+            'F': 20,  # TIPO MERCE
+            'G': 5,   # COLLI
+            'H': 30,  # NOTE SPEDIZIONE
+            'I': 25,  # RIFERIMENTO MITTENTE
+            'J': 15   # TELEFONO
+        }
+        
+        for col, width in col_widths.items():
+            worksheet.column_dimensions[col].width = width
+        
+        # Indirizzi che non è stato possibile correggere, da controllare prima della spedizione
+        if addresses['da_verificare']:
+            pd.DataFrame(addresses['da_verificare']).to_excel(writer, sheet_name='Da verificare', index=False)
+    
+    # Reimposta il puntatore all'inizio del file
+    output.seek(0)
+    return output
+
+def observe_import(report, seconds, import_format):
+    """Registra la velocità di un'importazione (righe elaborate al secondo)"""
+    rows = sum(len(value) if isinstance(value, list) else value for value in report.values())
+    if rows and seconds > 0:
+        # I motori Excel vengono riportati con l'estensione del file
+        import_format = {'openpyxl': 'xlsx', 'xlrd': 'xls'}.get(import_format, import_format)
+        IMPORT_ROWS_PER_SECOND.observe(rows / seconds, format=import_format)
+
+# Campi che l'importazione non deve mai sovrascrivere
+IMPORT_EXCLUDED_FIELDS = ['id', 'createdAt', 'lastUpdate', 'eliminato', 'eliminatoIl', 'contentHash', 'version', 'tenantId']
+
+def apply_import(normalized_data, tipo, dry_run=False):
+    """Confronta i dati importati con quelli esistenti tramite hash e applica solo le modifiche"""
+    # Carica i dati esistenti
+    existing_data = Contatto.query.filter_by(tipo=tipo, eliminato=False).all()
+    existing_dict = {(c.nome.lower(), c.azienda.lower() if c.azienda else ''): c for c in existing_data if c.nome}
+    
+    report = {'new': [], 'changed': [], 'unchanged': 0}
+    
+    for item in normalized_data:
+        nome = item.get('nome', '').strip()
+        azienda = item.get('azienda', '').strip()
+        
+        if not nome and not azienda:
+            continue
+        
+        # Gestione speciale per campi booleani
+        values = {}
+        for field, value in item.items():
+            if field not in IMPORT_EXCLUDED_FIELDS:
+                values[field] = value in [True, 1, '1'] if field in ['grappa', 'gls'] else value
+        
+        key = (nome.lower(), azienda.lower())
+        
+        if key in existing_dict:
+            record = existing_dict[key]
+            current_values = record.hash_values()
+            current_hash = record.contentHash or compute_content_hash(current_values)
+            
+            # Confronta l'hash del record risultante con quello salvato
+            if compute_content_hash({**current_values, **values}) == current_hash:
+                report['unchanged'] += 1
+                continue
+            
+            report['changed'].append({
+                'id': record.id,
+                'nome': record.nome,
+                'azienda': record.azienda,
+                'changes': {
+                    field: [current_values.get(field), value]
+                    for field, value in values.items()
+                    if field in current_values
+                    and normalize_hash_value(field, current_values[field]) != normalize_hash_value(field, value)
+                }
+            })
+            
+            if not dry_run:
+                # Aggiorna record esistente
+                for field, value in values.items():
+                    setattr(record, field, value)
+                record.lastUpdate = datetime.utcnow()
+        else:
+            report['new'].append(values)
+            
+            if not dry_run:
+                # Crea nuovo record
+                record = Contatto(tipo=tipo)
+                for field, value in values.items():
+                    setattr(record, field, value)
+                record.createdAt = datetime.utcnow()
+                record.lastUpdate = datetime.utcnow()
+                db.session.add(record)
+    
+    return report
+
+def detect_excel_engine(stream):
+    """Determina il motore di lettura pandas in base ai magic bytes del file"""
+    stream.seek(0)
+    header = stream.read(8)
+    stream.seek(0)
+    
+    for signature, engine in EXCEL_SIGNATURES.items():
+        if header.startswith(signature):
+            return engine
+    return None
+
+def detect_import_format(stream, filename):
+    """Determina il formato dell'upload: motore Excel dai magic bytes, altrimenti CSV/NDJSON dall'estensione"""
+    engine = detect_excel_engine(stream)
+    if engine:
+        return engine
+    
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return TEXT_FORMATS.get(extension)
+
+def read_import_records(stream, tipo, import_format):
+    """Restituisce le righe normalizzate di un upload nel formato indicato"""
+    if import_format == 'csv':
+        return normalize_records(iter_csv_rows(stream), tipo)
+    if import_format == 'ndjson':
+        return normalize_records(iter_ndjson_rows(stream), tipo)
+    
+    return normalize_excel_data(read_excel_stream(stream, tipo, import_format), tipo)
+
+def detect_text_encoding(sample):
+    """Riconosce la codifica di un file di testo (BOM, UTF-8 o in alternativa Windows-1252)"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Un carattere multibyte troncato alla fine del campione non è un errore
+        if e.start < len(sample) - 3:
+            return 'cp1252'
+    return 'utf-8'
+
+def iter_csv_rows(stream):
+    """Legge un CSV riga per riga riconoscendo codifica e separatore"""
+    stream.seek(0)
+    sample = stream.read(SNIFF_SIZE)
+    stream.seek(0)
+    
+    encoding = detect_text_encoding(sample)
+    try:
+        dialect = csv.Sniffer().sniff(sample.decode(encoding, errors='ignore'), delimiters=',;\t|')
+    except csv.Error:
+        dialect = csv.excel
+    
+    # Prima di Python 3.11 SpooledTemporaryFile (upload di UploadRequest) non ha readable():
+    # TextIOWrapper avvolge il file sottostante (BytesIO o file temporaneo), nella stessa posizione
+    text = io.TextIOWrapper(getattr(stream, '_file', stream), encoding=encoding, newline='')
+    try:
+        for row in csv.DictReader(text, dialect=dialect):
+            yield row
+    finally:
+        # Non chiudere lo stream sottostante insieme al wrapper
+        text.detach()
+
+def iter_ndjson_rows(stream):
+    """Legge un file NDJSON (un oggetto JSON per riga) riga per riga"""
+    stream.seek(0)
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError(f'Riga {line_number}: atteso un oggetto JSON')
+        yield row
+
+def read_excel_stream(stream, tipo, engine):
+    """Legge il foglio relativo al tipo da uno stream Excel aprendo la cartella una sola volta"""
+    import pandas as pd
+    stream.seek(0)
+    with pd.ExcelFile(stream, engine=engine) as xls:
+        sheet_name = determine_sheet_name(xls.sheet_names, tipo)
+        return xls.parse(sheet_name)
+
+def get_import_pool(max_workers=None):
+    """Restituisce il pool di processi condiviso per la lettura dei fogli Excel"""
+    global _import_pool
+    if _import_pool is None:
+        # spawn evita di duplicare con fork lo stato dei thread del server
+        _import_pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _import_pool
+
+def parse_sheet(sheet_name, tipo, content, engine):
+    """Legge e normalizza un singolo foglio (eseguito nei processi del pool)"""
+    import pandas as pd
+    if engine in TEXT_FORMATS.values():
+        return list(read_import_records(io.BytesIO(content), tipo, engine))
+    
+    with pd.ExcelFile(io.BytesIO(content), engine=engine) as xls:
+        df = xls.parse(sheet_name)
+    return normalize_excel_data(df, tipo)
+
+def determine_sheet_tipo(sheet_name, default_tipo=None):
+    """Determina il tipo di contatto (clienti o partner) dal nome del foglio"""
+    name = sheet_name.lower()
+    if 'client' in name:
+        return 'clienti'
+    if 'partner' in name:
+        return 'partner'
+    return default_tipo
+
 def determine_sheet_name(sheet_names, tipo):
     """Determina quale foglio utilizzare in base al tipo di dati"""
     # Array di possibili nomi di foglio in ordine di priorità
@@ -237,35 +565,37 @@ def determine_sheet_name(sheet_names, tipo):
     # Se non trova corrispondenze, usa il primo foglio
     return sheet_names[0]
 
+# Definisci mappatura delle colonne
+COLUMN_KEY_MAPPING = {
+    'nome': ['nome', 'nome persona', 'nominativo', 'nome_persona', 'nome cliente', 'nome e cognome', 'persona', 'referente', 'nome referente', 'cliente'],
+    'azienda': ['azienda', 'nome azienda', 'società', 'ragione sociale', 'company', 'ditta', 'società cliente', 'societa', 'nome societa', 'società'],
+    'indirizzo': ['indirizzo', 'via', 'strada', 'address', 'via/piazza', 'indirizzo stradale', 'via piazza', 'indirizzo spedizione'],
+    'civico': ['civico', 'numero civico', 'n. civico', 'n.civico', 'n°', 'numero', 'numero indirizzo', 'n. civico', 'num', 'num.'],
+    'cap': ['cap', 'codice postale', 'postal code', 'zip', 'codice avviamento postale', 'c.a.p.', 'c.a.p'],
+    'localita': ['localita', 'località', 'comune', 'città', 'city', 'paese', 'town', 'citta', 'loc', 'loc.'],
+    'provincia': ['provincia', 'prov', 'province', 'pr', 'pr.', 'sigla provincia', 'prov.', 'provincia sigla'],
+    'telefono': ['telefono', 'tel', 'phone', 'cellulare', 'tel.', 'numero telefono', 'cell', 'numero cellulare', 'tel/cell', 'cell.'],
+    'email': ['email', 'e-mail', 'mail', 'posta elettronica', 'indirizzo email', 'e mail', 'posta'],
+    'note': ['note', 'annotazioni', 'commenti', 'notes', 'note aggiuntive', 'note cliente', 'commento'],
+    'tipologia': ['tipologia', 'tipo partner', 'categoria', 'tipo cliente', 'tipo', 'category', 'gruppo'],
+    'grappa': ['grappa', 'regalo grappa', 'omaggio grappa', 'regalo', 'gift', 'presente', 'omaggio', 'dono'],
+    'extraAltro': ['extra/altro', 'extra', 'altro regalo', 'altro omaggio', 'extra regalo', 'regalo extra', 'altro', 'altri regali', 'extra/altri'],
+    'consegnaSpedizione': ['consegna/spedizione', 'consegna', 'consegna a mano', 'incaricato consegna', 'consegnatario', 'deliverer', 'spedizione', 'incaricato', 'consegna spedizione'],
+    'gls': ['gls', 'spedizione gls', 'corriere', 'spedizione', 'shipping', 'courier', 'corriere gls']
+}
+
 def normalize_excel_data(df, tipo):
     """Normalizza i dati del DataFrame"""
+    import numpy as np
     # Converti NaN a stringhe vuote
     df = df.replace({np.nan: ''})
     
     # Converti DataFrame in lista di dizionari
-    data = df.to_dict('records')
-    normalized_data = []
-    
-    # Definisci mappatura delle colonne
-    key_mapping = {
-        'nome': ['nome', 'nome persona', 'nominativo', 'nome_persona', 'nome cliente', 'nome e cognome', 'persona', 'referente', 'nome referente', 'cliente'],
-        'azienda': ['azienda', 'nome azienda', 'società', 'ragione sociale', 'company', 'ditta', 'società cliente', 'societa', 'nome societa', 'società'],
-        'indirizzo': ['indirizzo', 'via', 'strada', 'address', 'via/piazza', 'indirizzo stradale', 'via piazza', 'indirizzo spedizione'],
-        'civico': ['civico', 'numero civico', 'n. civico', 'n.civico', 'n°', 'numero', 'numero indirizzo', 'n. civico', 'num', 'num.'],
-        'cap': ['cap', 'codice postale', 'postal code', 'zip', 'codice avviamento postale', 'c.a.p.', 'c.a.p'],
-        'localita': ['localita', 'località', 'comune', 'città', 'city', 'paese', 'town', 'citta', 'loc', 'loc.'],
-        'provincia': ['provincia', 'prov', 'province', 'pr', 'pr.', 'sigla provincia', 'prov.', 'provincia sigla'],
-        'telefono': ['telefono', 'tel', 'phone', 'cellulare', 'tel.', 'numero telefono', 'cell', 'numero cellulare', 'tel/cell', 'cell.'],
-        'email': ['email', 'e-mail', 'mail', 'posta elettronica', 'indirizzo email', 'e mail', 'posta'],
-        'note': ['note', 'annotazioni', 'commenti', 'notes', 'note aggiuntive', 'note cliente', 'commento'],
-        'tipologia': ['tipologia', 'tipo partner', 'categoria', 'tipo cliente', 'tipo', 'category', 'gruppo'],
-        'grappa': ['grappa', 'regalo grappa', 'omaggio grappa', 'regalo', 'gift', 'presente', 'omaggio', 'dono'],
-        'extraAltro': ['extra/altro', 'extra', 'altro regalo', 'altro omaggio', 'extra regalo', 'regalo extra', 'altro', 'altri regali', 'extra/altri'],
-        'consegnaSpedizione': ['consegna/spedizione', 'consegna', 'consegna a mano', 'incaricato consegna', 'consegnatario', 'deliverer', 'spedizione', 'incaricato', 'consegna spedizione'],
-        'gls': ['gls', 'spedizione gls', 'corriere', 'spedizione', 'shipping', 'courier', 'corriere gls']
-    }
-    
-    for row in data:
+    return list(normalize_records(df.to_dict('records'), tipo))
+
+def normalize_records(rows, tipo):
+    """Normalizza una sequenza di righe (dizionari intestazione -> valore) una alla volta"""
+    for row in rows:
         normalized_row = {
             'tipo': tipo
         }
@@ -283,49 +613,45 @@ def normalize_excel_data(df, tipo):
             for key in sorted(row.keys()):
                 if isinstance(key, str) and key.upper() == key and len(key) <= 2 and col_index < len(column_order):
                     value = row[key]
-                    if value != '':
+                    if value != '' and value is not None:
                         normalized_row[column_order[col_index]] = normalize_value(column_order[col_index], value)
                     col_index += 1
         else:
             # Per tutte le altre colonne, analizza ogni campo
             for original_key, value in row.items():
-                if value == '':
+                if value == '' or value is None or original_key is None:
                     continue
                     
-                # Normalizza la chiave (minuscolo, senza spazi o caratteri speciali)
-                normalized_key = str(original_key).lower().strip().replace('/', ' ').replace('-', ' ').replace('_', ' ').replace('.', ' ')
-                normalized_key = ' '.join(normalized_key.split())
-                
-                # Trova la chiave normalizzata
-                mapped_key = None
-                
-                # Cerca corrispondenza esatta
-                for key, possible_keys in key_mapping.items():
-                    if normalized_key in possible_keys:
-                        mapped_key = key
-                        break
-                
-                # Se non c'è corrispondenza esatta, cerca corrispondenze parziali
-                if not mapped_key:
-                    for key, possible_keys in key_mapping.items():
-                        for possible_key in possible_keys:
-                            if possible_key in normalized_key or normalized_key in possible_key:
-                                mapped_key = key
-                                break
-                        if mapped_key:
-                            break
-                
-                # Usa la chiave mappata o una versione semplificata della chiave originale
-                final_key = mapped_key or normalized_key.replace(' ', '_')
+                # Trova la chiave normalizzata (calcolata una sola volta per intestazione)
+                final_key = map_column_key(original_key)
                 normalized_row[final_key] = normalize_value(final_key, value)
         
         # Aggiungi la riga normalizzata solo se ha campi sufficienti
         if 'nome' in normalized_row or 'azienda' in normalized_row:
             non_empty_fields = sum(1 for v in normalized_row.values() if v)
             if non_empty_fields >= 3:
-                normalized_data.append(normalized_row)
-                
-    return normalized_data
+                yield normalized_row
+
+@lru_cache(maxsize=1024)
+def map_column_key(original_key):
+    """Mappa un'intestazione di colonna sul nome del campo corrispondente"""
+    # Normalizza la chiave (minuscolo, senza spazi o caratteri speciali)
+    normalized_key = str(original_key).lower().strip().replace('/', ' ').replace('-', ' ').replace('_', ' ').replace('.', ' ')
+    normalized_key = ' '.join(normalized_key.split())
+    
+    # Cerca corrispondenza esatta
+    for key, possible_keys in COLUMN_KEY_MAPPING.items():
+        if normalized_key in possible_keys:
+            return key
+    
+    # Se non c'è corrispondenza esatta, cerca corrispondenze parziali
+    for key, possible_keys in COLUMN_KEY_MAPPING.items():
+        for possible_key in possible_keys:
+            if possible_key in normalized_key or normalized_key in possible_key:
+                return key
+    
+    # Usa una versione semplificata della chiave originale
+    return normalized_key.replace(' ', '_')
 
 def normalize_value(field_name, value):
     """Normalizza un valore in base al tipo di campo"""
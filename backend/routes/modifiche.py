@@ -0,0 +1,138 @@
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
+import json
+import math
+import time
+from models import Contatto, ModificaContatto, db, changes_condition
+from sqlalchemy import func, or_
+
+modifiche_bp = Blueprint('modifiche', __name__)
+
+# Massimo numero di modifiche restituite per risposta
+MAX_CHANGES = 5000
+
+# Durata massima di una connessione SSE prima che il client si riconnetta
+SSE_MAX_DURATION = 300
+
+@modifiche_bp.route('/api/changes', methods=['GET'])
+def get_changes():
+    """Restituisce i contatti modificati dopo la sequenza indicata (long-poll o SSE)"""
+    tipo = request.args.get('tipo')
+    since = request.args.get('since', request.headers.get('Last-Event-ID'))
+    
+    # Senza sequenza di partenza restituisci solo quella attuale: il client carica l'elenco
+    # completo dopo averla letta e poi chiede le modifiche successive
+    if since is None:
+        seq = latest_seq()
+        db.session.rollback()
+        return jsonify({'success': True, 'seq': seq, 'changes': [], 'deleted': []})
+    
+    try:
+        since = int(since)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': 'Parametro since non valido'
+        }), 400
+    
+    if request.args.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(stream_changes(since, tipo)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    timeout = long_poll_timeout()
+    if timeout is None:
+        return jsonify({
+            'success': False,
+            'error': 'Parametro timeout non valido'
+        }), 400
+    return jsonify({'success': True, **wait_for_changes(since, tipo, timeout)})
+
+def long_poll_timeout():
+    """Attesa richiesta con ?timeout=, limitata a CHANGES_LONG_POLL_TIMEOUT; None se il valore non è valido"""
+    limit = current_app.config['CHANGES_LONG_POLL_TIMEOUT']
+    try:
+        timeout = float(request.args.get('timeout', limit))
+    except ValueError:
+        return None
+    if not math.isfinite(timeout):
+        return None
+    return max(0.0, min(timeout, limit))
+
+def latest_seq(session=None):
+    """Restituisce l'ultima sequenza registrata"""
+    return (session or db.session).query(func.max(ModificaContatto.id)).scalar() or 0
+
+def wait_for_changes(since, tipo, timeout):
+    """Attende nuove modifiche fino al timeout, interrogando il database a intervalli"""
+    interval = current_app.config['CHANGES_POLL_INTERVAL']
+    deadline = time.monotonic() + timeout
+    while True:
+        result = load_changes(since, tipo)
+        # Chiudi la transazione tra un controllo e l'altro per non trattenere connessione e snapshot
+        db.session.rollback()
+        
+        remaining = deadline - time.monotonic()
+        if result['changes'] or result['deleted'] or result['reset'] or remaining <= 0:
+            return result
+        
+        # Le scritture dello stesso processo risvegliano subito l'attesa, quelle di altri
+        # processi vengono viste al controllo successivo
+        with changes_condition:
+            changes_condition.wait(min(interval, remaining))
+
+def load_changes(since, tipo, session=None):
+    """Legge le modifiche successive alla sequenza e lo stato attuale dei contatti coinvolti"""
+    session = session or db.session
+    query = session.query(ModificaContatto.id, ModificaContatto.contattoId, ModificaContatto.operazione).filter(
+        ModificaContatto.id > since)
+    if tipo:
+        # Le voci di azzeramento (ripristino da backup) valgono per tutti i tipi
+        query = query.filter(or_(ModificaContatto.tipo == tipo, ModificaContatto.operazione == 'reset'))
+    entries = query.order_by(ModificaContatto.id).limit(MAX_CHANGES).all()
+    
+    # Se le voci successive alla sequenza sono già state eliminate dal registro
+    # il client deve ricaricare l'elenco completo
+    oldest = session.query(func.min(ModificaContatto.id)).scalar()
+    if since > 0 and oldest is not None and oldest > since + 1:
+        return {'seq': latest_seq(session), 'changes': [], 'deleted': [], 'reset': True}
+    
+    if not entries:
+        return {'seq': since, 'changes': [], 'deleted': [], 'reset': False}
+    
+    # Dopo un ripristino da backup (voce 'reset') il client deve ricaricare l'elenco completo
+    if any(entry.operazione == 'reset' for entry in entries):
+        return {'seq': latest_seq(session), 'changes': [], 'deleted': [], 'reset': True}
+    
+    # Più modifiche dello stesso contatto si riducono all'ultima, in ordine di sequenza:
+    # un contatto spostato nel cestino e poi ripristinato risulta tra i modificati
+    last_operation = {}
+    for entry in entries:
+        last_operation[entry.contattoId] = entry.operazione
+    deleted = {id for id, operazione in last_operation.items() if operazione == 'delete'}
+    changed_ids = [id for id, operazione in last_operation.items() if operazione != 'delete']
+    contatti = session.query(Contatto).filter(Contatto.id.in_(changed_ids)).all() if changed_ids else []
+    
+    # Contatti modificati che non sono più nella tabella principale
+    deleted |= set(changed_ids) - {contatto.id for contatto in contatti}
+    
+    return {
+        'seq': entries[-1].id,
+        'changes': [contatto.to_dict() for contatto in contatti],
+        'deleted': sorted(deleted),
+        'reset': False
+    }
+
+def stream_changes(since, tipo):
+    """Genera eventi SSE con le modifiche man mano che vengono salvate"""
+    timeout = current_app.config['CHANGES_LONG_POLL_TIMEOUT']
+    deadline = time.monotonic() + SSE_MAX_DURATION
+    
+    # Suggerisci al browser dopo quanto riconnettersi
+    yield 'retry: 2000\n\n'
+    while time.monotonic() < deadline:
+        result = wait_for_changes(since, tipo, min(timeout, deadline - time.monotonic()))
+        if result['changes'] or result['deleted'] or result['reset']:
+            since = result['seq']
+            yield f"id: {since}\ndata: {json.dumps(result)}\n\n"
+        else:
+            # Commento di keep-alive per proxy e bilanciatori
+            yield ': keep-alive\n\n'
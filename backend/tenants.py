@@ -0,0 +1,31 @@
+"""Suddivisione dei dati per azienda: ogni richiesta legge e scrive solo i dati dell'azienda indicata"""
+from flask import g, has_app_context, jsonify, request
+import os
+
+# Azienda dei dati esistenti e delle richieste che non ne indicano una
+DEFAULT_TENANT = 'default'
+
+# Intestazione (o parametro ?tenant= per i link di download) con cui il client sceglie l'azienda
+TENANT_HEADER = 'X-Tenant'
+
+def current_tenant():
+    """Restituisce l'azienda della richiesta o del comando in corso"""
+    if has_app_context():
+        return g.get('tenant', DEFAULT_TENANT)
+    return DEFAULT_TENANT
+
+def init_tenants(app):
+    """Configura le aziende ammesse e ricava l'azienda di ogni richiesta"""
+    # Elenco separato da virgole, es. TENANTS=default,cantina,distilleria
+    tenants = [value.strip().lower() for value in os.environ.get('TENANTS', DEFAULT_TENANT).split(',') if value.strip()]
+    app.config['TENANTS'] = set(tenants)
+    
+    @app.before_request
+    def resolve_tenant():
+        tenant = (request.headers.get(TENANT_HEADER) or request.args.get('tenant') or DEFAULT_TENANT).strip().lower()
+        if tenant not in app.config['TENANTS']:
+            return jsonify({
+                'success': False,
+                'error': f'Azienda sconosciuta: {tenant}'
+            }), 404
+        g.tenant = tenant
@@ -0,0 +1,30 @@
+"""Fixture comuni: app su un database SQLite temporaneo"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """App con tabelle vuote, senza strumentazione e senza limite di scritture"""
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{tmp_path / "test.db"}')
+    monkeypatch.setenv('INSTRUMENTATION_ENABLED', 'false')
+    monkeypatch.setenv('RATE_LIMIT_PER_MINUTE', '0')
+
+    from app import create_app
+    from database import db
+    from models import init_default_settings
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        init_default_settings()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,11 @@
+"""Limite di frequenza delle scritture"""
+
+
+def test_limite_anche_sulle_route_senza_prefisso(app, client):
+    app.config['RATE_LIMIT_PER_MINUTE'] = 1
+    app.config['RATE_LIMIT_BURST'] = 1
+
+    assert client.post('/api/clienti', json=[]).status_code == 200
+    response = client.post('/clienti', json=[])
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
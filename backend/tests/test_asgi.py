@@ -0,0 +1,115 @@
+"""Modalità ASGI: viste asincrone e route Flask pilotate con messaggi ASGI"""
+import asyncio
+import gzip
+import json
+
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+
+async def call(asgi_app, path, query='', headers=None, method='GET', body=b'', until=None):
+    """Esegue una richiesta ASGI; con until il client si disconnette quando il corpo ricevuto lo contiene"""
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(), 'http_version': '1.1',
+        'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    disconnect = asyncio.Event()
+    response = {'body': b''}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {name.decode().lower(): value.decode() for name, value in message['headers']}
+        else:
+            response['body'] += message.get('body', b'')
+            if until and until in response['body']:
+                disconnect.set()
+
+    await asyncio.wait_for(asgi_app(scope, receive, send), 10)
+    return response
+
+
+@pytest.fixture
+def asgi_app(app, client):
+    from asgi import AsyncApp
+
+    app.config['TENANTS'] = {'default', 'altra'}
+    client.post('/api/clienti', json=[{'nome': 'Mario Rossi', 'tipo': 'clienti'}, {'nome': 'Anna Verdi', 'tipo': 'clienti'}])
+    client.post('/api/clienti', json=[{'nome': 'Altra azienda', 'tipo': 'clienti'}], headers={'X-Tenant': 'altra'})
+    asgi_app = AsyncApp(app)
+    yield asgi_app
+    asgi_app.executor.shutdown()
+
+
+def run(asgi_app, coroutine):
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            # Le query interrotte dalla disconnessione (SSE) terminano nel thread di aiosqlite
+            await asyncio.sleep(0.2)
+            for engine in asgi_app.engines.values():
+                await engine.dispose()
+    return asyncio.run(main())
+
+
+def test_elenchi_limitati_all_azienda(asgi_app):
+    async def requests():
+        default = await call(asgi_app, '/api/clienti', 'fields=table')
+        altra = await call(asgi_app, '/api/clienti', headers={'X-Tenant': 'altra'})
+        unknown = await call(asgi_app, '/api/clienti', headers={'X-Tenant': 'boh'})
+        return default, altra, unknown
+
+    default, altra, unknown = run(asgi_app, requests())
+    assert default['status'] == 200
+    assert sorted(item['nome'] for item in json.loads(default['body'])['data']) == ['Anna Verdi', 'Mario Rossi']
+    assert [item['nome'] for item in json.loads(altra['body'])['data']] == ['Altra azienda']
+    assert unknown['status'] == 404
+
+
+def test_backup_in_streaming(asgi_app):
+    async def requests():
+        return (await call(asgi_app, '/api/backup'),
+                await call(asgi_app, '/api/backup', headers={'X-Tenant': 'altra'}),
+                await call(asgi_app, '/api/status'))
+
+    default, altra, status = run(asgi_app, requests())
+    assert default['status'] == 200
+    assert default['headers']['content-type'] == 'application/gzip'
+    content = gzip.decompress(default['body']).decode('utf-8')
+    assert 'Mario Rossi' in content and 'Altra azienda' not in content
+    assert 'Altra azienda' in gzip.decompress(altra['body']).decode('utf-8')
+    # Il posto di import/export viene liberato alla fine dello stream
+    assert json.loads(status['body'])['admission']['importExport'] == 0
+
+
+def test_feed_delle_modifiche_sse(asgi_app):
+    async def requests():
+        return await call(asgi_app, '/api/changes', 'since=0&stream=1', until=b'id: ')
+
+    response = run(asgi_app, requests())
+    assert response['status'] == 200
+    assert response['headers']['content-type'].startswith('text/event-stream')
+    event = response['body'].split(b'data: ', 1)[1].split(b'\n', 1)[0]
+    assert sorted(item['nome'] for item in json.loads(event)['changes']) == ['Anna Verdi', 'Mario Rossi']
+
+
+def test_scrittura_tramite_app_flask(asgi_app):
+    async def requests():
+        body = json.dumps([{'nome': 'Luca Bianchi', 'tipo': 'clienti'}]).encode()
+        saved = await call(asgi_app, '/api/clienti', method='POST', body=body,
+                           headers={'Content-Type': 'application/json', 'X-Tenant': 'altra'})
+        return saved, await call(asgi_app, '/api/clienti', headers={'X-Tenant': 'altra'})
+
+    saved, listed = run(asgi_app, requests())
+    assert saved['status'] == 200
+    assert sorted(item['nome'] for item in json.loads(listed['body'])['data']) == ['Altra azienda', 'Luca Bianchi']
@@ -0,0 +1,21 @@
+"""Chiusura della campagna (/api/campagne/chiusura)"""
+import pytest
+
+
+@pytest.mark.parametrize('anno', ['duemila', '2024.5', 0, [2024]])
+def test_anno_non_valido(client, anno):
+    response = client.post('/api/campagne/chiusura', json={'anno': anno})
+    assert response.status_code == 400
+    assert 'anno non valido' in response.get_json()['error']
+    assert client.get('/api/campagne').get_json()['data'] == []
+
+
+def test_chiusura_e_seconda_chiusura(client):
+    client.post('/api/clienti', json=[{'nome': 'Mario Rossi', 'tipo': 'clienti'}])
+
+    response = client.post('/api/campagne/chiusura', json={'anno': '2024'})
+    assert response.status_code == 200
+    assert response.get_json()['data']['contatti'] == 1
+
+    response = client.post('/api/campagne/chiusura', json={'anno': 2024})
+    assert response.status_code == 409
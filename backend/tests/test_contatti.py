@@ -0,0 +1,55 @@
+"""Salvataggio dell'elenco e aggiornamento multiplo dei contatti"""
+
+
+def load(client):
+    return client.get('/api/clienti').get_json()['data']
+
+
+def test_contatti_assenti_non_vanno_nel_cestino(client):
+    client.post('/api/clienti', json=[{'nome': 'Primo', 'tipo': 'clienti'}])
+    stale = load(client)
+    # Un altro utente crea un contatto dopo il caricamento
+    client.post('/api/clienti', json=[{'nome': 'Secondo', 'tipo': 'clienti'}])
+
+    response = client.post('/api/clienti', json=stale)
+    assert response.status_code == 200
+    assert sorted(contatto['nome'] for contatto in load(client)) == ['Primo', 'Secondo']
+
+
+def test_eliminazione_esplicita_con_versione(client):
+    client.post('/api/clienti', json=[{'nome': 'Primo', 'tipo': 'clienti'}])
+    contatto = load(client)[0]
+
+    response = client.post('/api/clienti', json=[{**contatto, 'eliminato': True}])
+    assert response.status_code == 200
+    assert load(client) == []
+    assert [item['id'] for item in client.get('/api/eliminati').get_json()['data']] == [contatto['id']]
+
+
+def test_conflitto_annulla_tutto_il_salvataggio(client):
+    client.post('/api/clienti', json=[{'nome': 'Primo', 'tipo': 'clienti'}, {'nome': 'Secondo', 'tipo': 'clienti'}])
+    primo, secondo = load(client)
+    client.post('/api/clienti', json=[{**primo, 'note': 'altro utente'}])
+
+    response = client.post('/api/clienti', json=[
+        {**primo, 'note': 'versione vecchia'},
+        {**secondo, 'eliminato': True},
+        {'nome': 'Nuovo', 'tipo': 'clienti'}
+    ])
+    assert response.status_code == 409
+    assert [item['id'] for item in response.get_json()['conflicts']] == [primo['id']]
+    assert sorted(contatto['nome'] for contatto in load(client)) == ['Primo', 'Secondo']
+
+
+def test_aggiornamento_multiplo_registra_solo_i_contatti_aggiornati(client):
+    client.post('/api/clienti', json=[{'nome': 'Primo', 'tipo': 'clienti'}])
+    id = load(client)[0]['id']
+    seq = client.get('/api/changes').get_json()['seq']
+
+    response = client.post('/api/update-bulk/clienti', json={
+        'ids': [id, id + 100], 'propertyName': 'note', 'propertyValue': 'x'
+    })
+    assert response.status_code == 200
+    result = client.get(f'/api/changes?since={seq}&timeout=0').get_json()
+    assert [contatto['id'] for contatto in result['changes']] == [id]
+    assert result['deleted'] == []
@@ -0,0 +1,105 @@
+"""Migrazione dello schema"""
+import io
+
+from sqlalchemy import select
+
+
+def test_migrazione_calcola_gli_hash_mancanti(app, client):
+    from database import db, migrate_db
+    from models import Contatto, ContattoEliminato, compute_content_hash
+
+    app.config['TENANTS'] = {'default', 'altra'}
+    client.post('/api/clienti', json=[{'nome': 'Primo', 'tipo': 'clienti'}])
+    client.post('/api/clienti', json=[{'nome': 'Altra', 'tipo': 'clienti'}], headers={'X-Tenant': 'altra'})
+    client.post('/api/clienti', json=[{'nome': 'Cestino', 'tipo': 'clienti'}])
+    id = [item['id'] for item in client.get('/api/clienti').get_json()['data'] if item['nome'] == 'Cestino'][0]
+    client.post(f'/api/move-to-eliminati/clienti/{id}')
+
+    options = {'all_tenants': True}
+    with app.app_context():
+        # Righe precedenti all'introduzione della colonna
+        for table in [Contatto.__table__, ContattoEliminato.__table__]:
+            db.session.execute(table.update().values(contentHash=None), execution_options=options)
+        db.session.commit()
+
+        migrate_db(force=True)
+
+        for table in [Contatto.__table__, ContattoEliminato.__table__]:
+            rows = db.session.execute(select(table), execution_options=options).mappings().all()
+            assert rows
+            assert all(row['contentHash'] == compute_content_hash(row) for row in rows)
+
+
+# Tabella contatti precedente all'archivio: i contatti eliminati restano con eliminato=1, senza AUTOINCREMENT
+PRE_ARCHIVE_SCHEMA = """
+CREATE TABLE contatti (
+    id INTEGER NOT NULL PRIMARY KEY, tipo VARCHAR(20) NOT NULL, nome VARCHAR(100) NOT NULL, azienda VARCHAR(100),
+    indirizzo VARCHAR(200), civico VARCHAR(20), cap VARCHAR(10), localita VARCHAR(100), provincia VARCHAR(2),
+    telefono VARCHAR(20), email VARCHAR(100), note TEXT, tipologia VARCHAR(50), grappa BOOLEAN, extraAltro TEXT,
+    consegnaSpedizione VARCHAR(100), gls BOOLEAN, eliminato BOOLEAN, eliminatoIl DATETIME,
+    createdAt DATETIME, lastUpdate DATETIME
+)
+"""
+
+
+def test_migrazione_di_un_database_precedente_all_archivio(tmp_path, monkeypatch):
+    import sqlite3
+
+    path = tmp_path / 'vecchio.db'
+    with sqlite3.connect(path) as connection:
+        connection.execute(PRE_ARCHIVE_SCHEMA)
+        connection.executemany(
+            "INSERT INTO contatti (id, tipo, nome, eliminato, eliminatoIl) VALUES (?, 'clienti', ?, ?, ?)",
+            [(1, 'Attivo', 0, None), (2, 'Eliminato', 1, '2024-01-10 10:00:00'), (7, 'Ultimo', 1, None)])
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{path}')
+    monkeypatch.setenv('INSTRUMENTATION_ENABLED', 'false')
+    monkeypatch.setenv('DB_MIGRATE_ON_START', 'false')
+
+    from app import create_app
+    from database import db, migrate_db
+    from models import Contatto, ContattoEliminato
+
+    app = create_app()
+    options = {'all_tenants': True}
+    with app.app_context():
+        migrate_db(force=True)
+
+        active = db.session.execute(select(Contatto.__table__), execution_options=options).mappings().all()
+        archived = db.session.execute(select(ContattoEliminato.__table__), execution_options=options).mappings().all()
+        assert [(row['id'], row['nome']) for row in active] == [(1, 'Attivo')]
+        assert sorted((row['id'], row['nome']) for row in archived) == [(2, 'Eliminato'), (7, 'Ultimo')]
+        assert all(row['eliminato'] for row in archived)
+
+        sql = db.session.execute(db.text("SELECT sql FROM sqlite_master WHERE name = 'contatti'")).scalar()
+        assert 'AUTOINCREMENT' in sql.upper()
+
+        # Gli ID dei contatti archiviati non vengono riassegnati
+        nuovo = Contatto(tipo='clienti', nome='Nuovo')
+        db.session.add(nuovo)
+        db.session.commit()
+        assert nuovo.id == 8
+
+
+def test_ripristino_di_un_backup_precedente_all_archivio(app, client):
+    import gzip
+    import json
+
+    client.post('/api/clienti', json=[{'nome': 'Attivo', 'tipo': 'clienti'}, {'nome': 'Eliminato', 'tipo': 'clienti'}])
+    lines = gzip.decompress(client.get('/api/backup').data).decode('utf-8').splitlines()
+
+    # Nei backup precedenti all'archivio i contatti eliminati sono in contatti con eliminato=true
+    columns = None
+    for position, line in enumerate(lines):
+        value = json.loads(line)
+        if isinstance(value, dict) and 'tabella' in value:
+            columns = value['colonne'] if value['tabella'] == 'contatti' else None
+        elif columns and value[columns.index('nome')] == 'Eliminato':
+            value[columns.index('eliminato')] = True
+            lines[position] = json.dumps(value)
+    backup = gzip.compress('\n'.join(lines).encode('utf-8'))
+
+    response = client.post('/api/backup', data={'file': (io.BytesIO(backup), 'backup.ndjson.gz')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    assert [item['nome'] for item in client.get('/api/clienti').get_json()['data']] == ['Attivo']
+    assert [item['nome'] for item in client.get('/api/eliminati').get_json()['data']] == ['Eliminato']
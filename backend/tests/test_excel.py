@@ -0,0 +1,57 @@
+"""Importazione di file CSV, NDJSON ed Excel"""
+import io
+
+
+def upload(client, url, content, filename, field='file', **data):
+    return client.post(url, data={field: (io.BytesIO(content), filename), **data}, content_type='multipart/form-data')
+
+
+def nomi(client, tipo='clienti'):
+    return sorted(contatto['nome'] for contatto in client.get(f'/api/{tipo}').get_json()['data'])
+
+
+def test_import_csv(client):
+    content = 'Nome;Azienda;Località\nMario Rossi;Rossi srl;Udine\nLuca Bianchi;;Trieste\n'.encode('cp1252')
+    response = upload(client, '/api/import-excel/clienti', content, 'clienti.csv')
+    assert response.status_code == 200, response.get_json()
+    assert nomi(client) == ['Luca Bianchi', 'Mario Rossi']
+
+
+def test_import_csv_oltre_la_soglia_in_memoria(app, client):
+    # Upload riversato su disco: lo stream è un SpooledTemporaryFile già passato al file temporaneo
+    app.config['UPLOAD_SPOOL_MAX_SIZE'] = 64
+    rows = ''.join(f'Contatto {number},Azienda {number}\n' for number in range(50))
+    response = upload(client, '/api/import-excel/clienti', ('Nome,Azienda\n' + rows).encode('utf-8'), 'clienti.csv')
+    assert response.status_code == 200, response.get_json()
+    assert len(nomi(client)) == 50
+
+
+def test_import_ndjson(client):
+    content = '{"Nome": "Mario Rossi", "Azienda": "Rossi srl"}\n\n{"Nome": "Anna Verdi", "Località": "Udine"}\n'.encode('utf-8')
+    response = upload(client, '/api/import-excel/partner', content, 'partner.ndjson')
+    assert response.status_code == 200, response.get_json()
+    assert nomi(client, 'partner') == ['Anna Verdi', 'Mario Rossi']
+
+def test_import_xlsx(client):
+    import pandas as pd
+    output = io.BytesIO()
+    pd.DataFrame([{'Nome': 'Mario Rossi', 'Azienda': 'Rossi srl'}]).to_excel(output, sheet_name='Clienti', index=False)
+    response = upload(client, '/api/import-excel/clienti', output.getvalue(), 'clienti.xlsx')
+    assert response.status_code == 200, response.get_json()
+    assert nomi(client) == ['Mario Rossi']
+
+def test_import_multiplo_con_tipo_non_valido(client):
+    response = upload(client, '/api/import-excel-batch', b'Nome,Azienda\nMario Rossi,Rossi srl\n', 'elenco.csv', field='files', tipo='fornitori')
+    assert response.status_code == 400
+    assert nomi(client) == []
+
+
+def test_import_multiplo_senza_tipo(client):
+    response = upload(client, '/api/import-excel-batch', b'Nome,Azienda\nMario Rossi,Rossi srl\n', 'elenco.csv', field='files')
+    assert response.status_code == 400
+
+
+def test_import_multiplo_con_tipo_predefinito(client):
+    response = upload(client, '/api/import-excel-batch', b'Nome,Azienda\nMario Rossi,Rossi srl\n', 'elenco.csv', field='files', tipo='partner')
+    assert response.status_code == 200, response.get_json()
+    assert nomi(client, 'partner') == ['Mario Rossi']
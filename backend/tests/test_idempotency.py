@@ -0,0 +1,88 @@
+"""Scritture ripetute con Idempotency-Key"""
+import io
+from datetime import datetime, timedelta
+
+CONTATTO = [{'nome': 'Mario Rossi', 'tipo': 'clienti'}]
+
+
+def save(client, key, data=CONTATTO):
+    return client.post('/api/clienti', json=data, headers={'Idempotency-Key': key})
+
+
+def count(client):
+    return len(client.get('/api/clienti').get_json()['data'])
+
+
+def test_ripetizione_restituisce_la_risposta_salvata(client):
+    first = save(client, 'chiave-1')
+    second = save(client, 'chiave-1')
+
+    assert first.status_code == second.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert count(client) == 1
+
+
+def test_stessa_chiave_con_corpo_diverso(client):
+    save(client, 'chiave-1')
+    response = save(client, 'chiave-1', [{'nome': 'Anna Verdi', 'tipo': 'clienti'}])
+    assert response.status_code == 422
+    assert count(client) == 1
+
+
+def test_richiesta_ancora_in_corso(app, client):
+    from database import db
+    from models import RichiestaIdempotente
+    from idempotency import request_fingerprint, reserve_key
+
+    with app.test_request_context('/api/clienti', method='POST', json=CONTATTO):
+        reserve_key('chiave-1', request_fingerprint())
+        db.session.commit()
+
+    response = save(client, 'chiave-1')
+    assert response.status_code == 409
+    assert response.headers['Retry-After'] == '1'
+    assert count(client) == 0
+
+    # Dopo IDEMPOTENCY_LOCK_TIMEOUT la richiesta interrotta può essere ripetuta
+    with app.app_context():
+        db.session.query(RichiestaIdempotente).update(
+            {'createdAt': datetime.utcnow() - timedelta(seconds=app.config['IDEMPOTENCY_LOCK_TIMEOUT'] + 1)})
+        db.session.commit()
+    response = save(client, 'chiave-1')
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert count(client) == 1
+
+
+def test_ripetizione_dopo_un_errore_del_server(client, monkeypatch):
+    import routes.contatti
+
+    apply_changes = routes.contatti.apply_changes
+    monkeypatch.setattr(routes.contatti, 'apply_changes', lambda *args: 1 / 0)
+    assert save(client, 'chiave-1').status_code == 500
+
+    monkeypatch.setattr(routes.contatti, 'apply_changes', apply_changes)
+    response = save(client, 'chiave-1')
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert count(client) == 1
+
+
+def test_ripetizione_dopo_un_rifiuto_per_carico(app, client):
+    content = b'Nome,Azienda\nMario Rossi,Rossi srl\n'
+    headers = {'Idempotency-Key': 'chiave-1'}
+
+    def upload():
+        return client.post('/api/import-excel/clienti', data={'file': (io.BytesIO(content), 'clienti.csv')},
+                           content_type='multipart/form-data', headers=headers)
+
+    app.config.update(HEAVY_MAX_CONCURRENT=0, HEAVY_QUEUE_SIZE=0)
+    assert upload().status_code == 429
+
+    app.config.update(HEAVY_MAX_CONCURRENT=2)
+    response = upload()
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert count(client) == 1
@@ -0,0 +1,15 @@
+"""Normalizzazione di CAP, località e provincia"""
+from indirizzi import normalize_address
+
+
+def test_prefisso_di_un_altra_provincia_non_viene_applicato():
+    assert normalize_address('20099', 'San Giovanni', 'MI') == ('20099', 'San Giovanni', 'MI', None)
+
+
+def test_prefisso_coerente_con_cap_e_provincia():
+    assert normalize_address('33043', 'Cividale', 'UD') == ('33043', 'Cividale del Friuli', 'UD', None)
+
+
+def test_prefisso_non_corregge_il_cap():
+    cap, localita, _, _ = normalize_address('33100', 'Cividale', 'UD')
+    assert (cap, localita) == ('33100', 'Cividale')
@@ -0,0 +1,11 @@
+"""Endpoint /api/metrics"""
+
+
+def test_metriche_limitate_all_azienda(app, client):
+    app.config['TENANTS'] = {'default', 'altra'}
+    client.post('/api/clienti', json=[{'nome': 'Primo', 'tipo': 'clienti'}])
+    client.post('/api/clienti', json=[{'nome': 'Altra', 'tipo': 'clienti'}], headers={'X-Tenant': 'altra'})
+
+    text = client.get('/api/metrics').get_data(as_text=True)
+    assert 'crm_contatti{azienda="default",tipo="clienti",eliminato="false"} 1' in text
+    assert 'altra' not in text
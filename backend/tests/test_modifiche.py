@@ -0,0 +1,49 @@
+"""Feed delle modifiche (/api/changes)"""
+
+
+def create_contatto(client, nome='Mario Rossi'):
+    response = client.post('/api/clienti', json=[{'nome': nome, 'tipo': 'clienti'}])
+    assert response.status_code == 200
+    return client.get('/api/clienti').get_json()['data'][-1]['id']
+
+
+def test_contatto_ripristinato_risulta_modificato(client):
+    id = create_contatto(client)
+    assert client.post(f'/api/move-to-eliminati/clienti/{id}').status_code == 200
+    assert client.post(f'/api/restore-from-eliminati/{id}').status_code == 200
+
+    result = client.get('/api/changes?since=0&timeout=0').get_json()
+    assert result['deleted'] == []
+    assert [contatto['id'] for contatto in result['changes']] == [id]
+
+
+def test_contatto_eliminato_dopo_il_ripristino(client):
+    id = create_contatto(client)
+    client.post(f'/api/move-to-eliminati/clienti/{id}')
+    client.post(f'/api/restore-from-eliminati/{id}')
+    client.post(f'/api/move-to-eliminati/clienti/{id}')
+
+    result = client.get('/api/changes?since=0&timeout=0').get_json()
+    assert result['deleted'] == [id]
+    assert result['changes'] == []
+
+
+def test_azzeramento_dopo_il_ripristino_da_backup(app, client):
+    from database import db
+    from routes.backup import reset_change_feed
+
+    create_contatto(client)
+    with app.app_context():
+        reset_change_feed()
+        db.session.commit()
+
+    for url in ['/api/changes?since=0&timeout=0', '/api/changes?since=0&timeout=0&tipo=clienti']:
+        result = client.get(url).get_json()
+        assert result['reset'] is True
+        assert result['deleted'] == []
+
+
+def test_timeout_non_valido(client):
+    response = client.get('/api/changes?since=0&timeout=abc')
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
@@ -0,0 +1,44 @@
+"""Replica di lettura: una replica che smette di rispondere durante la lettura"""
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def replica(tmp_path, monkeypatch):
+    """Replica SQLite senza tabelle: risponde al controllo ma ogni lettura fallisce"""
+    import database
+
+    path = tmp_path / 'replica.db'
+    sqlite3.connect(path).close()
+    monkeypatch.setenv('DATABASE_REPLICA_URL', f'sqlite:///{path}')
+    monkeypatch.setenv('REPLICA_STICKY_SECONDS', '0')
+    monkeypatch.setattr(database, '_replica_state', {'checked': 0.0, 'healthy': False, 'lag': None, 'error': None})
+
+
+def test_lettura_ripetuta_sul_primario(client):
+    client.post('/api/clienti', json=[{'nome': 'Mario Rossi', 'tipo': 'clienti'}])
+    assert client.get('/api/status').get_json()['replica']['healthy'] is True
+
+    response = client.get('/api/clienti')
+    assert response.status_code == 200
+    assert [item['nome'] for item in response.get_json()['data']] == ['Mario Rossi']
+    assert client.get('/api/status').get_json()['replica']['healthy'] is False
+
+
+def test_lettura_asgi_ripetuta_sul_primario(client):
+    pytest.importorskip('aiosqlite')
+    from asgi import AsyncApp
+    from test_asgi import call, run
+
+    client.post('/api/clienti', json=[{'nome': 'Mario Rossi', 'tipo': 'clienti'}])
+    assert client.get('/api/status').get_json()['replica']['healthy'] is True
+
+    asgi_app = AsyncApp(client.application)
+    try:
+        response = run(asgi_app, call(asgi_app, '/api/clienti'))
+    finally:
+        asgi_app.executor.shutdown()
+    assert response['status'] == 200
+    assert [item['nome'] for item in json.loads(response['body'])['data']] == ['Mario Rossi']
@@ -5,6 +5,8 @@ const apiClient = axios.create({
   baseURL: process.env.REACT_APP_API_URL || '/api',
   headers: {
     'Content-Type': 'application/json',
+    // Azienda di cui leggere e scrivere i dati (backend condiviso da più aziende)
+    ...(process.env.REACT_APP_TENANT ? { 'X-Tenant': process.env.REACT_APP_TENANT } : {}),
   },
 });
 
@@ -17,11 +19,37 @@ apiClient.interceptors.response.use(
   }
 );
 
-// API per il caricamento dei dati
-export const loadData = async (dataType, includeEliminati = false) => {
+// Tentativi per le scritture idempotenti (salvataggio elenco e importazione)
+const MAX_WRITE_ATTEMPTS = 3;
+
+const newIdempotencyKey = () =>
+  (window.crypto?.randomUUID ? window.crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`);
+
+// POST ripetuto con la stessa Idempotency-Key dopo errori di rete, 5xx, 409 (in corso) o 429:
+// il server esegue la scrittura una sola volta e restituisce la stessa risposta ai tentativi successivi
+const postIdempotent = async (url, data, config = {}) => {
+  const headers = { ...config.headers, 'Idempotency-Key': newIdempotencyKey() };
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await apiClient.post(url, data, { ...config, headers });
+    } catch (error) {
+      const status = error.response?.status;
+      const retryable = !error.response || status >= 500 || status === 409 || status === 429;
+      // Un 409 senza Retry-After è un conflitto di versione, non una richiesta in corso
+      if (!retryable || attempt >= MAX_WRITE_ATTEMPTS || (status === 409 && !error.response.headers['retry-after'])) {
+        throw error;
+      }
+      const retryAfter = Number(error.response?.headers['retry-after']) || attempt;
+      await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+    }
+  }
+};
+
+// API per il caricamento dei dati (fields: preset come 'table' o 'shipping' e/o campi separati da virgole)
+export const loadData = async (dataType, includeEliminati = false, fields = null) => {
   try {
     const response = await apiClient.get(`/${dataType}`, {
-      params: { include_eliminati: includeEliminati }
+      params: { include_eliminati: includeEliminati, ...(fields ? { fields } : {}) }
     });
     return response.data;
   } catch (error) {
@@ -36,7 +64,7 @@ export const loadData = async (dataType, includeEliminati = false) => {
 // API per il salvataggio dei dati
 export const saveData = async (dataType, data) => {
   try {
-    const response = await apiClient.post(`/${dataType}`, data);
+    const response = await postIdempotent(`/${dataType}`, data);
     return response.data;
   } catch (error) {
     console.error(`Errore durante il salvataggio dei dati ${dataType}:`, error);
@@ -53,7 +81,7 @@ export const importExcel = async (dataType, file) => {
     const formData = new FormData();
     formData.append('file', file);
     
-    const response = await apiClient.post(`/import-excel/${dataType}`, formData, {
+    const response = await postIdempotent(`/import-excel/${dataType}`, formData, {
       headers: {
         'Content-Type': 'multipart/form-data',
       },
@@ -63,7 +91,7 @@ export const importExcel = async (dataType, file) => {
     console.error(`Errore durante l'importazione Excel:`, error);
     return { 
       success: false, 
-      message: error.response?.data?.message || error.message 
+      message: error.response?.data?.message || error.response?.data?.error || error.message 
     };
   }
 };
@@ -317,7 +317,7 @@ const ClientiPage = () => {
       
       const input = document.createElement('input');
       input.type = 'file';
-      input.accept = '.xlsx,.xls';
+      input.accept = '.xlsx,.xls,.csv,.ndjson,.jsonl';
       
       input.onchange = async (e) => {
         const file = e.target.files[0];
@@ -80,8 +80,8 @@ const Dashboard = () => {
       
       // Carica clienti e partner
       const [clientiResult, partnerResult] = await Promise.all([
-        loadData('clienti'),
-        loadData('partner')
+        loadData('clienti', false, 'table,extraAltro'),
+        loadData('partner', false, 'table,extraAltro')
       ]);
       
       if (clientiResult.success && partnerResult.success) {
@@ -79,7 +79,7 @@ const EliminatiPage = () => {
   const loadEliminati = async () => {
     try {
       setLoading(true);
-      const result = await loadData('eliminati');
+      const result = await loadData('eliminati', false, 'trash');
       
       if (result.success) {
         // Ordina gli eliminati per data di eliminazione (i più recenti prima)
@@ -146,8 +146,8 @@ const SpedizioniPage = () => {
       
       // Carica clienti e partner
       const [clientiResult, partnerResult] = await Promise.all([
-        loadData('clienti'),
-        loadData('partner')
+        loadData('clienti', false, 'shipping'),
+        loadData('partner', false, 'shipping')
       ]);
       
       if (clientiResult.success && partnerResult.success) {